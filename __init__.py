@@ -3,14 +3,47 @@
 # the full copyright notices and license terms.
 from trytond.pool import Pool
 from . import asterisk
+from . import call
+from . import campaign
+from . import cdr
+from . import event
 from . import party
+from . import queue
+from . import recording
+from . import routing
+from . import routes
 from . import user
+from . import wallboard
+
+__all__ = ['register', 'routes']
 
 
 def register():
     Pool.register(
         asterisk.AsteriskConfiguration,
         asterisk.AsteriskConfigurationCompany,
+        asterisk.AsteriskServer,
+        call.Call,
+        call.CallAttempt,
+        call.Cron,
+        cdr.Cdr,
+        cdr.Cron,
+        campaign.Campaign,
+        campaign.CampaignAgent,
+        campaign.CampaignLine,
+        campaign.Cron,
+        event.ChannelEvent,
         party.Party,
+        party.ContactMechanism,
+        party.PhoneBackfillStart,
+        queue.QueueStat,
+        recording.Recording,
+        recording.Cron,
+        routing.RouteRule,
+        user.UserExtension,
         user.User,
+        wallboard.Wallboard,
         module='asterisk', type_='model')
+    Pool.register(
+        party.PhoneBackfill,
+        module='asterisk', type_='wizard')
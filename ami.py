@@ -0,0 +1,709 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import logging
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from trytond.config import config
+
+from . import metrics
+# The protocol is implemented by the transport module
+from .transport import (AMIError, AMIResolveError, AMITimeout, AMIMessage,
+    AMIParser, AMIResolver, AMISession, resolver, TIMEOUT, CONNECT_TIMEOUT,
+    MAX_BACKOFF)
+
+__all__ = ['AMIError', 'AMIResolveError', 'AMITimeout', 'AMIMessage',
+    'AMIParser', 'AMIResolver', 'AMISession', 'AMIDispatcher', 'AMIRingGroup',
+    'AMIEndpoint', 'AMIHealth', 'AMIPool', 'pool', 'resolver']
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = config.getint('asterisk', 'pool_size', default=4)
+KEEPALIVE = config.getint('asterisk', 'keepalive', default=30)
+IDLE_TIMEOUT = config.getint('asterisk', 'idle_timeout', default=300)
+HEALTH_INTERVAL = config.getint('asterisk', 'health_interval', default=10)
+
+
+class AMIDispatcher(object):
+    '''
+    Session reading the AMI messages in a background thread.
+
+    Several threads can send actions concurrently: responses are handed to
+    the waiting thread by ActionID and events carrying an ActionID are passed
+    to the callback registered with the action until it returns True. Other
+    events are passed to the subscribers. The session is reconnected with an
+    exponential backoff when the connection is lost.
+
+    The on_connect callbacks are called with the dispatcher from its thread
+    after each login so they must not wait for a response.
+    '''
+
+    def __init__(self, params, events='call', keepalive=KEEPALIVE,
+            max_backoff=MAX_BACKOFF):
+        self.params = params
+        self.events = events
+        self.keepalive = keepalive
+        self.max_backoff = max_backoff
+        self.session = None
+        self.subscribers = []
+        self.on_connect = []
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopped = False
+        self._waiters = {}
+        self._callbacks = {}
+        self._thread = threading.Thread(target=self._run,
+            name='asterisk-ami-dispatcher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        session = self.session
+        if session:
+            session.close()
+
+    @property
+    def connected(self):
+        return self._ready.is_set()
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    def wait_connected(self, timeout=TIMEOUT):
+        return self._ready.wait(timeout)
+
+    def _run(self):
+        delay = 1
+        while not self._stopped:
+            session = AMISession(*self.params, events=self.events)
+            try:
+                session.connect()
+            except AMIError as e:
+                logger.warning('AMI dispatcher connection to %s:%s failed: %s',
+                    self.params[0], self.params[1], e)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+                continue
+            delay = 1
+            self.session = session
+            self._ready.set()
+            for callback in list(self.on_connect):
+                self._call(callback, self)
+            try:
+                while not self._stopped:
+                    try:
+                        messages = session.receive(timeout=self.keepalive)
+                    except socket.timeout:
+                        with self._lock:
+                            session.write_action('Ping')
+                        continue
+                    for message in messages:
+                        self._dispatch(message)
+            except (socket.error, AMIError) as e:
+                if not self._stopped:
+                    logger.warning('AMI dispatcher connection lost: %s', e)
+            finally:
+                self._ready.clear()
+                self.session = None
+                session.close(logoff=False)
+                self._fail_pending()
+
+    @property
+    def server(self):
+        return '%s:%s' % self.params[:2]
+
+    def _dispatch(self, message):
+        action_id = message.get('ActionID')
+        if message.is_event:
+            metrics.AMI_EVENTS.inc(event=message['Event'], server=self.server)
+        if message.is_response:
+            waiter = self._waiters.pop(action_id, None)
+            if waiter:
+                waiter[1] = message
+                waiter[0].set()
+            return
+        callback = self._callbacks.get(action_id)
+        if callback:
+            if self._call(callback, message):
+                self._callbacks.pop(action_id, None)
+            return
+        for subscriber in list(self.subscribers):
+            self._call(subscriber, message)
+
+    @staticmethod
+    def _call(callback, message):
+        try:
+            return callback(message)
+        except Exception:
+            logger.exception('Error processing AMI message: %s', message)
+            return True
+
+    def _fail_pending(self):
+        waiters, self._waiters = self._waiters, {}
+        for waiter in waiters.values():
+            waiter[0].set()
+        callbacks, self._callbacks = self._callbacks, {}
+        for callback in callbacks.values():
+            self._call(callback, None)
+
+    def send_action(self, action, fields=None, timeout=TIMEOUT,
+            callback=None):
+        """Send the action and return its response.
+        The callback is called with each event of the action and with None if
+        the connection is lost before it returns True."""
+        if not self.wait_connected(timeout):
+            raise AMIError('Not connected to %s:%s' % self.params[:2])
+        with metrics.AMI_DURATION.time(operation=action.lower(),
+                server=self.server):
+            return self._send_action(action, fields, timeout, callback)
+
+    def send_actions(self, actions, timeout=TIMEOUT):
+        '''
+        Send the (action, fields, callback) at once and return their
+        responses in the same order. The response is the AMIError raised for
+        the actions which failed.
+        '''
+        if not self.wait_connected(timeout):
+            raise AMIError('Not connected to %s:%s' % self.params[:2])
+        sent = []
+        for action, fields, callback in actions:
+            try:
+                sent.append(self._write(action, fields, callback))
+            except AMIError as e:
+                sent.append(e)
+        deadline = time.time() + timeout
+        result = []
+        for written in sent:
+            if isinstance(written, AMIError):
+                result.append(written)
+                continue
+            action_id, waiter = written
+            try:
+                result.append(self._wait(action_id, waiter,
+                        max(deadline - time.time(), 0)))
+            except AMIError as e:
+                result.append(e)
+        return result
+
+    def _send_action(self, action, fields, timeout, callback):
+        action_id, waiter = self._write(action, fields, callback)
+        return self._wait(action_id, waiter, timeout)
+
+    def _write(self, action, fields, callback):
+        session = self.session
+        if session is None:
+            raise AMIError('Connection lost to %s:%s' % self.params[:2])
+        action_id = session.next_action_id()
+        waiter = self._waiters[action_id] = [threading.Event(), None]
+        if callback:
+            self._callbacks[action_id] = callback
+        try:
+            with self._lock:
+                session.write_action(action, fields, action_id=action_id)
+        except (socket.error, AttributeError):
+            self._waiters.pop(action_id, None)
+            self._callbacks.pop(action_id, None)
+            raise AMIError('Connection lost to %s:%s' % self.params[:2])
+        return action_id, waiter
+
+    def _wait(self, action_id, waiter, timeout):
+        if not waiter[0].wait(timeout):
+            self._waiters.pop(action_id, None)
+            self._callbacks.pop(action_id, None)
+            metrics.AMI_ERRORS.inc(category='timeout', server=self.server)
+            raise AMITimeout('No response to AMI action %s' % action_id)
+        if waiter[1] is None:
+            raise AMIError('Connection lost to %s:%s' % self.params[:2])
+        if waiter[1].get('Response') == 'Error':
+            # No event follows an error response
+            self._callbacks.pop(action_id, None)
+        return waiter[1]
+
+    def write_action(self, action, fields=None):
+        "Send the action without waiting for its response"
+        session = self.session
+        if not session:
+            return
+        try:
+            with self._lock:
+                return session.write_action(action, fields)
+        except (socket.error, AttributeError) as e:
+            # The session is closed
+            logger.warning('Unable to send AMI action %s: %s', action, e)
+
+
+class AMIRingGroup(object):
+    '''
+    Originate to several channels at once and hang up the other channels as
+    soon as one of them answers.
+
+    The originated channels get a known unique id so their names can be
+    collected from the Newchannel events.
+    '''
+
+    def __init__(self, dispatcher, originates, on_result=None):
+        self.dispatcher = dispatcher
+        self.originates = originates
+        self.on_result = on_result
+        self.winner = None
+        self.responses = {}
+        self._names = {}
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def start(self):
+        self.dispatcher.subscribers.append(self._track)
+        try:
+            for fields in self.originates:
+                channel_id = uuid.uuid4().hex
+                self._channels[channel_id] = dict(fields)['Channel']
+                response = self.dispatcher.send_action('Originate',
+                    fields + [('Async', 'true'), ('ChannelId', channel_id)],
+                    callback=self._callback(channel_id))
+                if not response.success:
+                    self._response(channel_id, response)
+        except AMIError:
+            self._finish()
+            raise
+
+    def _callback(self, channel_id):
+        def callback(message):
+            if (message is not None
+                    and message.get('Event') != 'OriginateResponse'):
+                return False
+            self._response(channel_id, message)
+            return True
+        return callback
+
+    def _track(self, message):
+        if message.get('Event') != 'Newchannel':
+            return
+        channel_id = message.get('Uniqueid')
+        if channel_id not in self._channels:
+            return
+        with self._lock:
+            self._names[channel_id] = message.get('Channel')
+            hangup = self.winner is not None and self.winner != channel_id
+        if hangup:
+            self.dispatcher.write_action('Hangup',
+                [('Channel', self._names[channel_id])])
+
+    def _response(self, channel_id, message):
+        with self._lock:
+            self.responses[channel_id] = message
+            won = (self.winner is None and message is not None
+                and message.get('Response') == 'Success')
+            if won:
+                self.winner = channel_id
+                losers = [n for i, n in self._names.items()
+                    if i != channel_id and i not in self.responses]
+            finished = won or len(self.responses) == len(self._channels)
+        if won:
+            for name in losers:
+                self.dispatcher.write_action('Hangup', [('Channel', name)])
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        if self._done.is_set():
+            return
+        self._done.set()
+        if self.on_result:
+            self.on_result(self.result)
+        if self.winner is None or len(self.responses) == len(self._channels):
+            self._unsubscribe()
+        else:
+            # Keep tracking the channels which still have to be hung up
+            threading.Timer(TIMEOUT, self._unsubscribe).start()
+
+    def _unsubscribe(self):
+        try:
+            self.dispatcher.subscribers.remove(self._track)
+        except ValueError:
+            pass
+
+    @property
+    def channel(self):
+        "The channel which answered"
+        if self.winner:
+            return self._channels[self.winner]
+
+    @property
+    def result(self):
+        "The OriginateResponse of the winner or the last failure"
+        if self.winner:
+            return self.responses[self.winner]
+        for message in reversed(list(self.responses.values())):
+            if message is not None:
+                return message
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+
+class AMIEndpoint(object):
+    'An AMI server which can be used for a configuration'
+    __slots__ = ('key', 'host', 'port', 'login', 'password', 'priority',
+        'weight')
+
+    def __init__(self, key, host, port, login, password, priority=10,
+            weight=1):
+        self.key = key
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.priority = priority
+        self.weight = weight
+
+    @property
+    def params(self):
+        return (self.host, self.port, self.login, self.password)
+
+    def __repr__(self):
+        return '<AMIEndpoint %s:%s>' % (self.host, self.port)
+
+
+class AMIHealth(object):
+    'The health of an endpoint measured by the pool'
+    __slots__ = ('latency', 'failures', 'retry')
+
+    # Weight of the last measure in the average latency
+    alpha = 0.3
+
+    def __init__(self):
+        self.latency = None
+        self.failures = 0
+        self.retry = 0
+
+    @property
+    def available(self):
+        return self.retry <= time.time()
+
+    def success(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+        self.failures = 0
+        self.retry = 0
+
+    def failure(self, max_backoff):
+        "Mark the endpoint as down for an exponential backoff delay"
+        self.retry = time.time() + min(2 ** self.failures, max_backoff)
+        self.failures += 1
+
+
+class AMIPool(object):
+    '''
+    Process wide pool of AMI sessions keyed per endpoint.
+
+    A key is rebuilt when the connection parameters change or when it is
+    invalidated and it is not retried until the backoff delay has elapsed
+    after a failed connection.
+
+    The endpoints passed to select() are checked in the background to measure
+    their latency so the healthiest one is tried first.
+    '''
+
+    def __init__(self, size=POOL_SIZE, keepalive=KEEPALIVE,
+            idle_timeout=IDLE_TIMEOUT, max_backoff=MAX_BACKOFF,
+            health_interval=HEALTH_INTERVAL):
+        self.size = size
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.max_backoff = max_backoff
+        self.health_interval = health_interval
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._params = {}
+        self._health = {}
+        self._endpoints = {}
+        self._in_use = {}
+        self._dispatchers = {}
+        self._thread = None
+        self._health_thread = None
+
+    @contextmanager
+    def session(self, key, host, port, login, password):
+        params = (host, port, login, password)
+        session = self._acquire(key, params)
+        try:
+            yield session
+        except (socket.error, AMIError):
+            self._close(key, session)
+            raise
+        else:
+            self._release(key, params, session)
+
+    @contextmanager
+    def failover_session(self, endpoints):
+        "Yield a session of the first endpoint which can be connected"
+        endpoint, session = self._acquire_any(endpoints)
+        try:
+            yield session
+        except (socket.error, AMIError):
+            self._close(endpoint.key, session)
+            self.failure(endpoint.key)
+            raise
+        else:
+            self._release(endpoint.key, endpoint.params, session)
+
+    def _acquire_any(self, endpoints):
+        errors = []
+        for endpoint in self.select(endpoints):
+            try:
+                return endpoint, self._acquire(endpoint.key, endpoint.params)
+            except AMIError as e:
+                logger.warning('AMI connection to %s failed: %s', endpoint, e)
+                errors.append(e)
+        self._raise(errors)
+
+    @staticmethod
+    def _raise(errors):
+        if not errors:
+            raise AMIError('No Asterisk server configured')
+        if all(isinstance(e, AMIResolveError) for e in errors):
+            raise errors[-1]
+        raise AMIError('; '.join(str(e) for e in errors))
+
+    def health(self, key):
+        "Return the health of the key"
+        with self._lock:
+            health = self._health.get(key)
+            if health is None:
+                health = self._health[key] = AMIHealth()
+            return health
+
+    def failure(self, key):
+        with self._lock:
+            health = self._health.setdefault(key, AMIHealth())
+            health.failure(self.max_backoff)
+
+    def select(self, endpoints):
+        '''
+        Return the endpoints in the order to try them: the available ones by
+        priority then by latency per weight, and the others at the end.
+        '''
+        with self._lock:
+            for endpoint in endpoints:
+                self._endpoints[endpoint.key] = endpoint
+
+            def score(endpoint):
+                health = self._health.get(endpoint.key)
+                latency = health and health.latency or 0
+                return (health is not None and not health.available,
+                    endpoint.priority, latency / max(endpoint.weight, 1))
+            result = sorted(endpoints, key=score)
+        # Resolve the fallback servers before they are needed
+        for endpoint in result[1:]:
+            resolver.prefetch(endpoint.host, endpoint.port)
+        self._start_health_check()
+        return result
+
+    def _acquire(self, key, params):
+        with self._lock:
+            if self._params.get(key) != params:
+                self._discard(key)
+                self._params[key] = params
+            idle = self._idle.setdefault(key, [])
+            session = idle.pop() if idle else None
+            health = self._health.setdefault(key, AMIHealth())
+            available = health.available
+            if session:
+                self._in_use[key] = self._in_use.get(key, 0) + 1
+        if session:
+            return session
+        if not available:
+            raise AMIError('Backing off connection to %s:%s' % params[:2])
+        session = AMISession(*params)
+        start = time.monotonic()
+        try:
+            session.connect()
+        except AMIError:
+            self.failure(key)
+            raise
+        with self._lock:
+            health.success(time.monotonic() - start)
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        self._start_keepalive()
+        return session
+
+    def _close(self, key, session):
+        with self._lock:
+            self._in_use[key] = self._in_use.get(key, 1) - 1
+        session.close(logoff=False)
+
+    def _release(self, key, params, session):
+        with self._lock:
+            self._in_use[key] = self._in_use.get(key, 1) - 1
+            idle = self._idle.setdefault(key, [])
+            if (session.connected
+                    and self._params.get(key) == params
+                    and len(idle) < self.size):
+                idle.append(session)
+                return
+        session.close()
+
+    def dispatcher(self, key, host, port, login, password):
+        "Return the running event dispatcher of the key"
+        params = (host, port, login, password)
+        with self._lock:
+            dispatcher = self._dispatchers.get(key)
+            if dispatcher and dispatcher.params != params:
+                dispatcher.stop()
+                dispatcher = None
+            if not dispatcher:
+                dispatcher = self._dispatchers[key] = AMIDispatcher(params,
+                    keepalive=self.keepalive, max_backoff=self.max_backoff)
+                dispatcher.start()
+        return dispatcher
+
+    def failover_dispatcher(self, endpoints, timeout=CONNECT_TIMEOUT):
+        "Return the dispatcher of the first endpoint which is connected"
+        errors = []
+        for endpoint in self.select(endpoints):
+            with self._lock:
+                available = self._health.setdefault(
+                    endpoint.key, AMIHealth()).available
+            if not available:
+                errors.append(AMIError('Backing off connection to %s:%s'
+                        % endpoint.params[:2]))
+                continue
+            dispatcher = self.dispatcher(endpoint.key, *endpoint.params)
+            if dispatcher.wait_connected(timeout):
+                return dispatcher
+            logger.warning('AMI dispatcher of %s not connected', endpoint)
+            self.failure(endpoint.key)
+            with self._lock:
+                if self._dispatchers.get(endpoint.key) is dispatcher:
+                    del self._dispatchers[endpoint.key]
+            dispatcher.stop()
+            errors.append(AMIError('Unable to connect to %s:%s'
+                    % endpoint.params[:2]))
+        self._raise(errors)
+
+    def occupancy(self):
+        "Return the number of idle and in use sessions per server"
+        result = {}
+        with self._lock:
+            for key, params in self._params.items():
+                server = '%s:%s' % params[:2]
+                for state, count in [
+                        ('idle', len(self._idle.get(key, []))),
+                        ('in_use', self._in_use.get(key, 0)),
+                        ]:
+                    result[(server, state)] = (
+                        result.get((server, state), 0) + count)
+            for dispatcher in self._dispatchers.values():
+                key = (dispatcher.server, 'dispatcher')
+                result[key] = result.get(key, 0) + int(dispatcher.connected)
+        return result
+
+    def _discard(self, key):
+        for session in self._idle.pop(key, []):
+            session.close()
+        dispatcher = self._dispatchers.pop(key, None)
+        if dispatcher:
+            dispatcher.stop()
+        self._params.pop(key, None)
+        self._health.pop(key, None)
+        self._endpoints.pop(key, None)
+        self._in_use.pop(key, None)
+
+    def invalidate(self, key):
+        "Discard the key and the keys starting with it"
+        with self._lock:
+            keys = set(self._params) | set(self._dispatchers) | set(
+                self._endpoints) | set(self._health)
+            for other in keys:
+                if other[:len(key)] == key:
+                    self._discard(other)
+
+    def _start_keepalive(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._keepalive_loop,
+                name='asterisk-ami-keepalive', daemon=True)
+            self._thread.start()
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(self.keepalive)
+            with self._lock:
+                checks = [(k, list(s)) for k, s in self._idle.items()]
+                for key, _ in checks:
+                    self._idle[key] = []
+            now = time.time()
+            for key, sessions in checks:
+                alive = []
+                for session in sessions:
+                    if now - session.last_used > self.idle_timeout:
+                        session.close()
+                        continue
+                    try:
+                        if session.ping():
+                            alive.append(session)
+                            continue
+                    except (socket.error, AMIError):
+                        logger.debug('AMI keepalive failed for %s', key)
+                    session.close(logoff=False)
+                with self._lock:
+                    if key in self._params:
+                        self._idle.setdefault(key, []).extend(alive)
+                    else:
+                        for session in alive:
+                            session.close()
+
+    def _start_health_check(self):
+        with self._lock:
+            if self._health_thread and self._health_thread.is_alive():
+                return
+            self._health_thread = threading.Thread(
+                target=self._health_loop, name='asterisk-ami-health',
+                daemon=True)
+            self._health_thread.start()
+
+    def check(self, endpoint):
+        "Measure the round trip time of a Ping on the endpoint"
+        if not self.health(endpoint.key).available:
+            return
+        try:
+            with self.session(endpoint.key, *endpoint.params) as session:
+                start = time.monotonic()
+                if not session.ping():
+                    raise AMIError('Ping failed')
+                latency = time.monotonic() - start
+        except (socket.error, AMIError) as e:
+            logger.warning('AMI health check of %s failed: %s', endpoint, e)
+            # A failed connection is already recorded
+            if self.health(endpoint.key).available:
+                self.failure(endpoint.key)
+        else:
+            with self._lock:
+                self._health.setdefault(endpoint.key, AMIHealth()).success(
+                    latency)
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            with self._lock:
+                endpoints = list(self._endpoints.values())
+            for endpoint in endpoints:
+                # Keep the addresses fresh so the dials never wait for them
+                resolver.prefetch(endpoint.host, endpoint.port,
+                    margin=self.health_interval)
+                self.check(endpoint)
+
+
+pool = AMIPool()
+metrics.POOL_SESSIONS.function = pool.occupancy
@@ -3,15 +3,111 @@
 #the full copyright notices and license terms.
 from trytond.model import ModelView, ModelSQL, ModelSingleton, fields, Unique
 from trytond.pool import Pool
+from trytond.rpc import RPC
 from trytond.transaction import Transaction
+from trytond.cache import Cache
 import logging
 import socket
 import unicodedata
-import time
+from functools import lru_cache
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from . import ami
+from . import metrics
+from . import recording
+
+__all__ = ['AsteriskConfiguration', 'AsteriskConfigurationCompany',
+    'AsteriskServer']
+
+# Characters removed from the phone numbers before dialing them
+STRIP_CHARS = str.maketrans('', '', ' .()[]-/')
+# Priority of the server of the configuration, the servers with a lower
+# priority are tried first
+PRIORITY = 10
+# The maximum number of calls of dial_many without asynchronous originates
+DIAL_MANY_SYNC_LIMIT = 5
+
+
+class NumberRules(object):
+    'The prefixes of a configuration compiled to reformat numbers'
+    __slots__ = ('country_prefix', 'national_prefix', 'international_prefix',
+        'out_prefix', 'national', 'international', 'national_format_allowed')
+
+    def __init__(self, country_prefix, national_prefix, international_prefix,
+            out_prefix, national_format_allowed):
+        self.country_prefix = country_prefix
+        self.national_prefix = national_prefix
+        self.international_prefix = international_prefix
+        self.out_prefix = out_prefix
+        self.national = out_prefix + national_prefix
+        self.international = out_prefix + international_prefix
+        self.national_format_allowed = national_format_allowed
 
-__all__ = ['AsteriskConfiguration', 'AsteriskConfigurationCompany']
+    @classmethod
+    def get(cls, ast_server):
+        return _number_rules(ast_server.country_prefix or '',
+            ast_server.national_prefix or '',
+            ast_server.international_prefix or '',
+            ast_server.out_prefix or '',
+            bool(ast_server.national_format_allowed))
+
+    def normalize(self, number):
+        "Return the stripped number in international format without '+'"
+        if number[:1] == '+':
+            number = number[1:]
+        elif (self.international_prefix
+                and number.startswith(self.international_prefix)):
+            number = number[len(self.international_prefix):]
+        elif self.national_prefix and number.startswith(self.national_prefix):
+            number = self.country_prefix + number[len(self.national_prefix):]
+        else:
+            number = self.country_prefix + number
+        return number if number.isdigit() else None
+
+    def reformat(self, number, routes=None):
+        '''
+        Return the number to dial and the id of the error message.
+        The route of the number in the route table may block it or replace
+        the out prefix.
+        '''
+        if not number:
+            return None, 'asterisk.invalid_format'
+        number = number.translate(STRIP_CHARS)
+        out_prefix = self.out_prefix
+        national, international = self.national, self.international
+        route = (routes.lookup(number, self.normalize(number))
+            if routes is not None else None)
+        if route:
+            action, route_prefix, exact = route
+            if action == 'block':
+                return None, 'asterisk.blocked_number'
+            if route_prefix is not None:
+                out_prefix = route_prefix
+                national = out_prefix + self.national_prefix
+                international = out_prefix + self.international_prefix
+            if exact:
+                # The short numbers are dialed as is
+                return out_prefix + number, None
+        # International format
+        if number[:1] == '+':
+            number = number.replace('+', '')
+            if not number.isdigit():
+                return None, 'asterisk.invalid_format'
+            if number.startswith(self.country_prefix):
+                # Replace 'my country prefix' by the 'national prefix'
+                return national + number[len(self.country_prefix):], None
+            return international + number, None
+        # National format
+        if not self.national_format_allowed:
+            return None, 'asterisk.invalid_international_format'
+        if not number.isdigit():
+            return None, 'asterisk.invalid_national_format'
+        return out_prefix + number, None
+
+
+@lru_cache(maxsize=64)
+def _number_rules(*args):
+    return NumberRules(*args)
 
 
 class AsteriskConfiguration(ModelSingleton, ModelSQL, ModelView):
@@ -89,24 +185,58 @@ class AsteriskConfiguration(ModelSingleton, ModelSQL, ModelView):
             "it to have a special ring tone for click2dial, for example "
             "you could choose a silent ring tone."),
         'get_fields', setter='set_fields')
+    originate_async = fields.Function(fields.Boolean('Asynchronous originate',
+            help="Queue the calls on the Asterisk server and return "
+            "immediately. The result of each call is recorded on the call "
+            "attempts."),
+        'get_fields', setter='set_fields')
+    max_campaign_calls = fields.Function(fields.Integer(
+            'Max. campaign calls',
+            help="Maximum number of campaign calls ringing at once on the "
+            "Asterisk server."),
+        'get_fields', setter='set_fields')
+    cdr_path = fields.Function(fields.Char('CDR file',
+            help="Path of the Master.csv file written by the cdr_csv module "
+            "of Asterisk. The new records are imported by the scheduled "
+            "action."),
+        'get_fields', setter='set_fields')
+    call_retention = fields.Function(fields.Integer('Call history retention',
+            help="Number of days the calls are kept in the history. The "
+            "older calls are deleted by the scheduled action. Leave empty to "
+            "keep them all."),
+        'get_fields', setter='set_fields')
+    recording_path = fields.Function(fields.Char('Recordings directory',
+            help="Directory where MixMonitor writes the recordings. The new "
+            "recordings are indexed by the scheduled action."),
+        'get_fields', setter='set_fields')
+    recording_format = fields.Function(fields.Selection(
+            recording.FORMATS, 'Recordings format',
+            help="Format to which the recordings are converted in the "
+            "background to use less space. Requires ffmpeg."),
+        'get_fields', setter='set_fields')
+    queue_service_level = fields.Function(fields.Integer(
+            'Queue service level (sec)',
+            help="Maximum waiting time (in seconds) of the calls of the "
+            "queues answered in the service level."),
+        'get_fields', setter='set_fields')
+
+    @classmethod
+    def __setup__(cls):
+        super(AsteriskConfiguration, cls).__setup__()
+        cls.__rpc__.update({
+                'get_metrics': RPC(readonly=True),
+                'dial_many': RPC(readonly=False),
+                })
 
     @classmethod
     def get_fields(cls, configurations, names):
-        res = {}
         ConfigurationCompany = Pool().get('asterisk.configuration.company')
         company_id = Transaction().context.get('company')
         conf_id = configurations[0].id
-        if company_id:
-            confs = ConfigurationCompany.search([
-                ('company', '=', company_id),
-                ], limit=1)
-            for conf in confs:
-                for field_name in names:
-                    value = getattr(conf, field_name)
-                    res[field_name] = {conf_id: value}
-        else:
-            raise UserError('asterisk.not_company')
-        return res
+        if not company_id:
+            raise UserError(gettext('asterisk.not_company'))
+        values = ConfigurationCompany.get_company_values(company_id) or {}
+        return {n: {conf_id: values.get(n)} for n in names}
 
     @classmethod
     def set_fields(cls, configurations, name, value):
@@ -195,10 +325,25 @@ class AsteriskConfiguration(ModelSingleton, ModelSQL, ModelView):
     def default_wait_time():
         return 5
 
+    @staticmethod
+    def default_max_campaign_calls():
+        return 10
+
+    @staticmethod
+    def default_queue_service_level():
+        return 20
+
     @staticmethod
     def unaccent(text):
         return unicodedata.normalize('NFKD', text).encode('ASCII',
-            'ignore')
+            'ignore').decode('ASCII')
+
+    @classmethod
+    def route_table(cls, ast_server):
+        "Return the route table of the configuration or None"
+        RouteRule = Pool().get('asterisk.route.rule')
+        if ast_server.id is not None and ast_server.id >= 0:
+            return RouteRule.get_table(ast_server.id)
 
     @classmethod
     def reformat_number(cls, tryton_number, ast_server):
@@ -207,106 +352,100 @@ class AsteriskConfiguration(ModelSingleton, ModelSQL, ModelView):
         that Asterisk should dial.
         '''
         logger = logging.getLogger('asterisk')
-
-        # Let's call the variable tmp_number now
-        tmp_number = tryton_number
-        logger.debug('Number before reformat = %s' % tmp_number)
-
-        # Check if empty
-        if not tmp_number:
+        ast_number, error = NumberRules.get(ast_server).reformat(tryton_number,
+            cls.route_table(ast_server))
+        if error:
             raise UserError(gettext('asterisk.invalid_phone'),
-                gettext('asterisk.invalid_format'))
+                gettext(error))
+        logger.debug('Number %s reformatted to %s', tryton_number, ast_number)
+        return ast_number
 
-        # First, we remove all stupid characters and spaces
-        for i in [' ', '.', '(', ')', '[', ']', '-', '/']:
-            tmp_number = tmp_number.replace(i, '')
+    @classmethod
+    def reformat_numbers(cls, numbers, ast_server):
+        '''
+        Transform a list of numbers available in Tryton to the numbers that
+        Asterisk should dial.
+        Return a list of (number, error) in the same order where number is
+        None if it is not valid and error is the message explaining why.
+        '''
+        reformat = NumberRules.get(ast_server).reformat
+        routes = cls.route_table(ast_server)
+        messages = {}
+        result = []
+        for number in numbers:
+            ast_number, error = reformat(number, routes)
+            if error:
+                if error not in messages:
+                    messages[error] = gettext(error)
+                error = messages[error]
+            result.append((ast_number, error))
+        return result
 
-        # Before starting to use prefix, we convert empty prefix whose value
-        # is False to an empty string
-        country_prefix = (ast_server.country_prefix or '')
-        national_prefix = (ast_server.national_prefix or '')
-        international_prefix = (ast_server.international_prefix or '')
-        out_prefix = (ast_server.out_prefix or '')
+    @classmethod
+    def normalize_number(cls, number, ast_server=None):
+        '''
+        Return the number in international format without the '+', e.g.
+        '33141981242', or None if it is not a valid phone number.
 
-        # International format
-        if tmp_number[0] == '+':
-            # Remove the starting '+' of the number
-            tmp_number = tmp_number.replace('+', '')
-            logger.debug('Number after removal of special char = %s' %
-                tmp_number)
-
-            # At this stage, 'tmp_number' should only contain digits
-            if not tmp_number.isdigit():
-                raise UserError(gettext('asterisk.invalid_phone'),
-                    gettext('asterisk.invalid_format_msg'))
-
-            logger.debug('Country prefix = ' + country_prefix)
-            if country_prefix == tmp_number[0:len(country_prefix)]:
-                # If the number is a national number,
-                # remove 'my country prefix' and add 'national prefix'
-                tmp_number = (national_prefix) + tmp_number[
-                    len(country_prefix):len(tmp_number)]
-                logger.debug('National prefix = %s - Number with national '
-                    'prefix = %s' % (national_prefix, tmp_number))
-            else:
-                # If the number is an international number,
-                # add 'international prefix'
-                tmp_number = international_prefix + tmp_number
-                logger.debug('International prefix = %s - Number with '
-                    'international prefix = %s' % (international_prefix,
-                        tmp_number))
-        # National format, allowed
-        elif ast_server.national_format_allowed:
-            # No treatment required
-            if not tmp_number.isdigit():
-                raise UserError(gettext('asterisk.invalid_phone'),
-                    gettext('asterisk.invalid_national_format'))
-
-        # National format, disallowed
-        elif not ast_server.national_format_allowed:
-            raise UserError(gettext('asterisk.invalid_phone'),
-                gettext('asterisk.invalid_international_format'))
-        # Add 'out prefix' to all numbers
-        tmp_number = out_prefix + tmp_number
-        logger.debug('Out prefix = %s - Number to be sent to Asterisk = %s' %
-            (out_prefix, tmp_number))
-        return tmp_number
+        The prefixes of the configuration are used to convert the numbers
+        written in national format.
+        '''
+        if not number:
+            return None
+        if ast_server:
+            rules = NumberRules.get(ast_server)
+        else:
+            rules = _number_rules('', '', '', '', False)
+        return rules.normalize(number.translate(STRIP_CHARS))
 
     @classmethod
-    def dial(cls, party, tryton_number):
+    def _dial_user(cls):
         '''
-        Open the socket to the Asterisk Manager Interface (AMI)
-        and send instructions to Dial to Asterisk.
+        Return the user dialing, the Asterisk server of their company and the
+        channels of their phone.
         '''
-        logger = logging.getLogger('asterisk')
-        User = Pool().get('res.user')
+        pool = Pool()
+        User = pool.get('res.user')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
         user_id = Transaction().user
         if user_id == 0 and 'user' in Transaction().context:
             user_id = Transaction().context['user']
         user = User(user_id)
 
-        # Check if the number to dial is not empty
-        if not tryton_number:
-            raise UserError(gettext('asterisk.error'),
-                gettext('asterisk.no_phone_number'))
-
         # We check if the user has an Asterisk server configured
-        if not user.asterisk_server:
+        ast_server = ConfigurationCompany.get_company_configuration(
+            user.company.id if user.company else None)
+        if not ast_server:
             raise UserError(gettext('asterisk.error'),
                 gettext('asterisk.no_asterisk_configuration'))
-        else:
-            ast_server = user.asterisk_server
 
-        # We check if the current user has a chan type
-        if not user.asterisk_chan_type:
+        # We check if the current user has an internal number
+        extensions = user.get_asterisk_extensions(ast_server.company.id)
+        if not extensions:
+            raise UserError(gettext('asterisk.error'),
+                gettext('asterisk.no_internal_phone'))
+
+        # We check if each internal number has a chan type
+        channels = [c for _, c in extensions]
+        if not all(channels):
             raise UserError(gettext('asterisk.error'),
                 gettext('asterisk.no_channel_type'))
+        return user, ast_server, channels
 
-        # We check if the current user has an internal number
-        if not user.internal_number:
+    @classmethod
+    def dial(cls, party, tryton_number):
+        '''
+        Open the socket to the Asterisk Manager Interface (AMI)
+        and send instructions to Dial to Asterisk.
+        '''
+        logger = logging.getLogger('asterisk')
+
+        # Check if the number to dial is not empty
+        if not tryton_number:
             raise UserError(gettext('asterisk.error'),
-                gettext('asterisk.no_internal_phone'))
-        internal_numbers = user.internal_number.replace(" ", "").split(",")
+                gettext('asterisk.no_phone_number'))
+
+        user, ast_server, channels = cls._dial_user()
 
         # The user should also have a CallerID, but in Spain that will
         # be the name of the address that we call.
@@ -315,68 +454,282 @@ class AsteriskConfiguration(ModelSingleton, ModelSQL, ModelView):
             #callerid = Party.search(party).get_name_for_display
             callerid = party.display_name
         else:
-            callerid = user.CallerId
+            callerid = user.callerid
 
         # Convert the phone number in the format that will be sent to Asterisk
         ast_number = cls.reformat_number(tryton_number, ast_server)
-        logger.info('User dialing: channel(s) = %s/%s - Callerid = %s' %
-            (user.asterisk_chan_type, internal_numbers, user.callerid))
+        logger.info('User dialing: channel(s) = %s - Callerid = %s' %
+            (channels, user.callerid))
         logger.info('Asterisk server = %s:%s' %
             (ast_server.ip_address, ast_server.port))
 
-        # Connect to the Asterisk Manager Interface, using IPv6-ready code
-        try:
-            res = socket.getaddrinfo(ast_server.ip_address, ast_server.port,
-                socket.AF_UNSPEC, socket.SOCK_STREAM)
-        except:
-            logger.error("Can't resolve the DNS of the Asterisk server : %s" %
-                str(ast_server.ip_address))
+        ring_all = (user.asterisk_ring_strategy == 'ring_all'
+            and len(channels) > 1)
+        if ast_server.originate_async:
+            strategy = 'async'
+        else:
+            strategy = 'ring_all' if ring_all else 'sequential'
+        with metrics.DIAL_DURATION.time(strategy=strategy):
+            try:
+                if ast_server.originate_async:
+                    result = cls._dial_async(user, party, tryton_number,
+                        ast_number, callerid, channels, ast_server,
+                        ring_all=ring_all)
+                    metrics.DIALS.inc(strategy=strategy, result='queued')
+                    return result
+                elif ring_all:
+                    success = cls._dial_ring_all(ast_number, callerid,
+                        channels, ast_server)
+                else:
+                    success = cls._dial_sequential(ast_number, callerid,
+                        channels, ast_server)
+            except UserError:
+                metrics.DIALS.inc(strategy=strategy, result='error')
+                raise
+        metrics.DIALS.inc(strategy=strategy,
+            result='success' if success else 'failure')
+
+    @classmethod
+    def dial_many(cls, calls):
+        '''
+        Dial the list of (party, number) from the first channel of the user
+        with the originates sent at once on a single AMI session.
+        Return for each call a dictionary with the dialed number and the
+        error, the success of the call or the call attempt when the
+        originates are asynchronous.
+        Without asynchronous originates, only DIAL_MANY_SYNC_LIMIT calls are
+        allowed as each one waits for the user to pick up.
+        '''
+        logger = logging.getLogger('asterisk')
+        pool = Pool()
+        Party = pool.get('party.party')
+        CallAttempt = pool.get('asterisk.call.attempt')
+
+        user, ast_server, channels = cls._dial_user()
+        if (not ast_server.originate_async
+                and len(calls) > DIAL_MANY_SYNC_LIMIT):
             raise UserError(gettext('asterisk.error'),
-                gettext('asterisk.cant_resolve_dns'))
-        for result in res:
-            af, socktype, proto, _, sockaddr = result
-            for internal_number in internal_numbers:
+                gettext('asterisk.dial_many_synchronous',
+                    limit=DIAL_MANY_SYNC_LIMIT))
+        calls = [(Party(p) if isinstance(p, int) else p, n) for p, n in calls]
+        results = []
+        to_dial = []
+        numbers = cls.reformat_numbers([n for _, n in calls], ast_server)
+        for (party, number), (ast_number, error) in zip(calls, numbers):
+            result = {
+                'party': party.id if party else None,
+                'number': number,
+                'dialed_number': ast_number,
+                'error': error,
+                'success': None,
+                'attempt': None,
+                }
+            results.append(result)
+            if not error:
+                callerid = user.callerid or (party.display_name
+                    if party else '')
+                to_dial.append((result, party, callerid))
+        if not to_dial:
+            return results
+
+        strategy = 'async_many' if ast_server.originate_async else 'many'
+        with metrics.DIAL_DURATION.time(strategy=strategy):
+            if ast_server.originate_async:
+                attempts = CallAttempt.create([{
+                            'company': user.company.id,
+                            'user': user.id,
+                            'party': party.id if party else None,
+                            'number': result['number'],
+                            'dialed_number': result['dialed_number'],
+                            'callerid': callerid,
+                            'pending_channels': ','.join(channels[1:]),
+                            } for result, party, callerid in to_dial])
                 try:
-                    sock = socket.socket(af, socktype, proto)
-                    sock.connect(sockaddr)
-                    sock.send('Action: login\r\n')
-                    sock.send('Events: off\r\n')
-                    sock.send('Username: %s\r\n' % str(ast_server.login))
-                    sock.send('Secret: %s\r\n\r\n' % str(ast_server.password))
-                    time.sleep(1)
-                    sock.recv(1024)
-                    sock.send('Action: originate\r\n')
-                    sock.send('Channel: %s/%s\r\n' % (
-                            str(user.asterisk_chan_type),
-                            str(internal_number)))
-                    sock.send('Timeout: %s\r\n' % str(ast_server.wait_time*1000))
-                    sock.send('CallerId: %s\r\n' % cls.unaccent(callerid))
-                    sock.send('Exten: %s\r\n' % str(ast_number))
-                    sock.send('Context: %s\r\n' % str(ast_server.context))
-                    if (ast_server.alert_info and
-                            user.asterisk_chan_type == 'SIP'):
-                        sock.send('Variable: SIPAddHeader=Alert-Info: %s\r\n' %
-                            str(ast_server.alert_info))
-                    sock.send('Priority: %s\r\n\r\n' %
-                        str(ast_server.extension_priority))
-                    time.sleep(1)
-                    response_originate = sock.recv(1024)
-                    sock.send('Action: Logoff\r\n\r\n')
-                    sock.recv(1024)
-                    sock.close()
-                    if "Success" in response_originate:
-                        logger.info("Asterisk Click2Dial from %s to %s "
-                            "success" % (internal_number, ast_number))
-                        break
-                    else:
-                        logger.info("Asterisk Click2Dial from %s to %s failed:"
-                            "\n%s" % (internal_number, ast_number,
-                                response_originate))
-                except:
+                    CallAttempt.originate_many(attempts, channels[0],
+                        ast_server)
+                except ami.AMIError as e:
                     logger.debug("Asterisk Click2dial failed: unable to "
-                        "connect to Asterisk server")
+                        "connect to Asterisk server: %s" % e)
                     raise UserError(gettext('asterisk.error'),
                         gettext('asterisk.connection_failed'))
+                CallAttempt.save(attempts)
+                for (result, _, _), attempt in zip(to_dial, attempts):
+                    result['attempt'] = attempt.id
+                    if attempt.state == 'failed':
+                        result['error'] = attempt.reason
+                    metrics.DIALS.inc(strategy=strategy,
+                        result='error' if result['error'] else 'queued')
+                return results
+
+            actions = [('Originate', cls.originate_fields(channels[0],
+                        result['dialed_number'], callerid, ast_server))
+                for result, _, callerid in to_dial]
+            # Each synchronous originate waits for the user to pick up
+            timeout = len(actions) * (ast_server.wait_time + ami.TIMEOUT)
+            try:
+                with ami.pool.failover_session(
+                        ast_server.get_endpoints()) as session:
+                    responses = session.send_actions(actions,
+                        timeout=timeout)
+            except ami.AMIError as e:
+                logger.debug("Asterisk Click2dial failed: unable to "
+                    "connect to Asterisk server: %s" % e)
+                raise UserError(gettext('asterisk.error'),
+                    gettext('asterisk.connection_failed'))
+        for (result, _, _), response in zip(to_dial, responses):
+            if response is None:
+                result['error'] = gettext('asterisk.connection_failed')
+            else:
+                result['success'] = response.success
+                if not response.success:
+                    result['error'] = response.get('Message')
+            metrics.DIALS.inc(strategy=strategy,
+                result='error' if response is None
+                else 'success' if response.success else 'failure')
+        logger.info("Asterisk Click2Dial from %s to %s numbers" %
+            (channels[0], len(actions)))
+        return results
+
+    @classmethod
+    def _dial_sequential(cls, ast_number, callerid, channels, ast_server):
+        '''
+        Ring the channels one after the other until one of them answers.
+        '''
+        logger = logging.getLogger('asterisk')
+        # Borrow an authenticated session from the healthiest server
+        endpoints = ast_server.get_endpoints()
+        for channel in channels:
+            try:
+                with ami.pool.failover_session(endpoints) as session:
+                    # The response is sent once the channel answers
+                    try:
+                        response_originate = session.originate(
+                            cls.originate_fields(channel, ast_number,
+                                callerid, ast_server),
+                            timeout=ast_server.wait_time + ami.TIMEOUT)
+                    except ami.AMITimeout:
+                        # The channel did not answer, it is not a failure
+                        # of the server
+                        response_originate = None
+            except ami.AMIResolveError as e:
+                logger.error("Can't resolve the DNS of the Asterisk server "
+                    "%s: %s" % (ast_server.ip_address, e))
+                raise UserError(gettext('asterisk.error'),
+                    gettext('asterisk.cant_resolve_dns',
+                        host=ast_server.ip_address))
+            except (socket.error, ami.AMIError) as e:
+                logger.debug("Asterisk Click2dial failed: unable to "
+                    "connect to Asterisk server: %s" % e)
+                raise UserError(gettext('asterisk.error'),
+                    gettext('asterisk.connection_failed'))
+            if response_originate and response_originate.success:
+                logger.info("Asterisk Click2Dial from %s to %s "
+                    "success" % (channel, ast_number))
+                return True
+            else:
+                logger.info("Asterisk Click2Dial from %s to %s failed:"
+                    "\n%s" % (channel, ast_number, response_originate))
+        return False
+
+    @classmethod
+    def _ring_group(cls, ast_number, callerid, channels, ast_server,
+            on_result=None):
+        dispatcher = ami.pool.failover_dispatcher(ast_server.get_endpoints())
+        group = ami.AMIRingGroup(dispatcher, [
+                cls.originate_fields(c, ast_number, callerid, ast_server)
+                for c in channels], on_result=on_result)
+        group.start()
+        return group
+
+    @classmethod
+    def _dial_ring_all(cls, ast_number, callerid, channels, ast_server):
+        '''
+        Ring all the channels at once and wait until one of them answers.
+        '''
+        logger = logging.getLogger('asterisk')
+        try:
+            group = cls._ring_group(ast_number, callerid, channels,
+                ast_server)
+        except ami.AMIError:
+            logger.debug("Asterisk Click2dial failed: unable to "
+                "connect to Asterisk server")
+            raise UserError(gettext('asterisk.error'),
+                gettext('asterisk.connection_failed'))
+        group.wait(ast_server.wait_time + ami.TIMEOUT)
+        if group.channel:
+            logger.info("Asterisk Click2Dial from %s to %s "
+                "success" % (group.channel, ast_number))
+        else:
+            logger.info("Asterisk Click2Dial from %s to %s failed:"
+                "\n%s" % (channels, ast_number, group.result))
+        return bool(group.channel)
+
+    @classmethod
+    def _dial_async(cls, user, party, tryton_number, ast_number, callerid,
+            channels, ast_server, ring_all=False):
+        '''
+        Queue the originate on the Asterisk server and return the call attempt
+        id. The client can poll the attempt for the result.
+        '''
+        logger = logging.getLogger('asterisk')
+        CallAttempt = Pool().get('asterisk.call.attempt')
+
+        attempt, = CallAttempt.create([{
+                    'company': user.company.id,
+                    'user': user.id,
+                    'party': party.id if party else None,
+                    'number': tryton_number,
+                    'dialed_number': ast_number,
+                    'callerid': callerid,
+                    'pending_channels': (
+                        ','.join(channels[1:]) if not ring_all else None),
+                    }])
+        try:
+            if ring_all:
+                attempt.originate_all(channels, ast_server)
+            else:
+                attempt.originate(channels[0], ast_server)
+        except ami.AMIError:
+            logger.debug("Asterisk Click2dial failed: unable to "
+                "connect to Asterisk server")
+            raise UserError(gettext('asterisk.error'),
+                gettext('asterisk.connection_failed'))
+        attempt.save()
+        logger.info("Asterisk Click2Dial from %s to %s queued" %
+            (channels[0], ast_number))
+        return attempt.id
+
+    @classmethod
+    def get_metrics(cls):
+        '''
+        Return the metrics of the AMI operations of the process in the
+        Prometheus text format.
+        '''
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        User = pool.get('res.user')
+        if (Transaction().user
+                and ModelData.get_id('asterisk', 'group_asterisk')
+                not in User.get_groups()):
+            raise UserError(gettext('asterisk.error'),
+                gettext('asterisk.metrics_access_denied'))
+        return metrics.registry.render()
+
+    @classmethod
+    def originate_fields(cls, channel, ast_number, callerid, ast_server):
+        "Return the fields of the Originate action to connect channel"
+        fields = [
+            ('Channel', channel),
+            ('Timeout', ast_server.wait_time * 1000),
+            ('CallerId', cls.unaccent(callerid)),
+            ('Exten', ast_number),
+            ('Context', ast_server.context),
+            ]
+        if ast_server.alert_info and channel.startswith('SIP/'):
+            fields.append(('Variable',
+                    'SIPAddHeader=Alert-Info: %s' % ast_server.alert_info))
+        fields.append(('Priority', ast_server.extension_priority))
+        return fields
 
 
 class AsteriskConfigurationCompany(ModelSQL, ModelView):
@@ -399,6 +752,32 @@ class AsteriskConfigurationCompany(ModelSQL, ModelView):
     wait_time = fields.Integer('Wait time (sec)')
     extension_priority = fields.Integer('Extension priority')
     alert_info = fields.Char('Alert-Info SIP header')
+    originate_async = fields.Boolean('Asynchronous originate')
+    max_campaign_calls = fields.Integer('Max. campaign calls')
+    cdr_path = fields.Char('CDR file')
+    cdr_offset = fields.Integer('CDR offset', readonly=True,
+        help="Position in the CDR file of the last imported record.")
+    cdr_inode = fields.BigInteger('CDR inode', readonly=True,
+        help="Inode of the CDR file of the last imported record.")
+    call_retention = fields.Integer('Call history retention')
+    recording_path = fields.Char('Recordings directory')
+    recording_format = fields.Selection(recording.FORMATS,
+        'Recordings format')
+    recording_mtime = fields.Float('Recordings modification time',
+        readonly=True,
+        help="Modification time of the last indexed recording.")
+    recording_inode = fields.BigInteger('Recordings inode', readonly=True,
+        help="Inode of the last indexed recording.")
+    queue_service_level = fields.Integer('Queue service level (sec)')
+    servers = fields.One2Many('asterisk.configuration.server',
+        'configuration', 'Servers')
+    _configuration_cache = Cache('asterisk.configuration.company',
+        context=False)
+    _servers_cache = Cache('asterisk.configuration.company.servers',
+        context=False)
+    # The fields updated by the imports which do not change the configuration
+    _watermark_fields = {'cdr_offset', 'cdr_inode', 'recording_mtime',
+        'recording_inode'}
 
     @classmethod
     def __setup__(cls):
@@ -408,3 +787,178 @@ class AsteriskConfigurationCompany(ModelSQL, ModelView):
             ('company_uniq', Unique(t, t.company),
                 'There is already one configuration for this company.'),
             ]
+
+    @classmethod
+    def _cached_fields(cls):
+        return [n for n, f in cls._fields.items()
+            if not isinstance(f, fields.Function)
+            and f._type not in {'one2many', 'many2many'}
+            and n not in {'create_uid', 'create_date', 'write_uid',
+                'write_date'} | cls._watermark_fields]
+
+    @classmethod
+    def get_company_values(cls, company_id=None):
+        '''
+        Return a dictionary with the values of the configuration of the
+        company or None. The values are cached until a configuration is
+        modified.
+        '''
+        if company_id is None:
+            company_id = Transaction().context.get('company')
+        if not company_id:
+            return None
+        values = cls._configuration_cache.get(company_id, -1)
+        if values == -1:
+            confs = cls.search([
+                    ('company', '=', company_id),
+                    ], limit=1)
+            if confs:
+                values, = cls.read([confs[0].id], cls._cached_fields())
+            else:
+                values = None
+            cls._configuration_cache.set(company_id, values)
+        return dict(values) if values else None
+
+    @classmethod
+    def get_company_configuration(cls, company_id=None):
+        "Return the configuration of the company or None"
+        values = cls.get_company_values(company_id)
+        if values:
+            return cls(values.pop('id'), **values)
+
+    def get_endpoints(self):
+        '''
+        Return the AMI endpoints of the configuration: its own server and the
+        other servers of the company.
+        '''
+        pool = Pool()
+        Server = pool.get('asterisk.configuration.server')
+        database_name = Transaction().database.name
+        servers = self._servers_cache.get(self.id)
+        if servers is None:
+            # The cache is shared by all the users
+            with Transaction().set_context(_check_access=False):
+                servers = [(s.id, s.ip_address, s.port, s.login, s.password,
+                        s.priority, s.weight)
+                    for s in Server.search([
+                            ('configuration', '=', self.id),
+                            ])]
+            self._servers_cache.set(self.id, servers)
+        endpoints = []
+        if self.ip_address:
+            endpoints.append(ami.AMIEndpoint((database_name, self.id),
+                    self.ip_address, self.port, self.login, self.password,
+                    priority=PRIORITY))
+        for id_, host, port, login, password, priority, weight in servers:
+            endpoints.append(ami.AMIEndpoint((database_name, self.id, id_),
+                    host, port, login or self.login,
+                    password or self.password, priority=priority,
+                    weight=weight))
+        return endpoints
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(AsteriskConfigurationCompany, cls).create(vlist)
+        cls._configuration_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        to_invalidate = []
+        for records, values in zip(actions, actions):
+            # The imports update only their watermark
+            if set(values) - cls._watermark_fields:
+                to_invalidate.extend(records)
+        super(AsteriskConfigurationCompany, cls).write(*args)
+        if to_invalidate:
+            cls._configuration_cache.clear()
+            cls._invalidate_ami_pool(to_invalidate)
+
+    @classmethod
+    def delete(cls, records):
+        cls._invalidate_ami_pool(records)
+        super(AsteriskConfigurationCompany, cls).delete(records)
+        cls._configuration_cache.clear()
+
+    @staticmethod
+    def _invalidate_ami_pool(records):
+        database = Transaction().database.name
+        for record in records:
+            ami.pool.invalidate((database, record.id))
+
+
+class AsteriskServer(ModelSQL, ModelView):
+    'Asterisk Server'
+    __name__ = 'asterisk.configuration.server'
+    configuration = fields.Many2One('asterisk.configuration.company',
+        'Configuration', required=True, ondelete='CASCADE', select=True)
+    name = fields.Char('Asterisk server name')
+    ip_address = fields.Char('Asterisk IP addr. or DNS', required=True)
+    port = fields.Integer('Port', required=True)
+    login = fields.Char('AMI login',
+        help="Leave empty to use the login of the configuration.")
+    password = fields.Char('AMI password',
+        help="Leave empty to use the password of the configuration.")
+    priority = fields.Integer('Priority', required=True,
+        help="The servers with the lowest priority are used first. The "
+        "server of the configuration has a priority of %s." % PRIORITY)
+    weight = fields.Integer('Weight', required=True,
+        help="The servers with the same priority are used in proportion to "
+        "their weight divided by their latency.")
+
+    @classmethod
+    def __setup__(cls):
+        super(AsteriskServer, cls).__setup__()
+        cls._order.insert(0, ('priority', 'ASC'))
+
+    @staticmethod
+    def default_configuration():
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        values = ConfigurationCompany.get_company_values()
+        if values:
+            return values['id']
+
+    @staticmethod
+    def default_port():
+        return 5038
+
+    @staticmethod
+    def default_priority():
+        return 20
+
+    @staticmethod
+    def default_weight():
+        return 1
+
+    @classmethod
+    def create(cls, vlist):
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        records = super(AsteriskServer, cls).create(vlist)
+        ConfigurationCompany._servers_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        actions = iter(args)
+        records = []
+        for servers, values in zip(actions, actions):
+            records.extend(servers)
+        cls._invalidate_ami_pool(records)
+        super(AsteriskServer, cls).write(*args)
+        ConfigurationCompany._servers_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        cls._invalidate_ami_pool(records)
+        super(AsteriskServer, cls).delete(records)
+        ConfigurationCompany._servers_cache.clear()
+
+    @staticmethod
+    def _invalidate_ami_pool(records):
+        database = Transaction().database.name
+        for record in records:
+            ami.pool.invalidate(
+                (database, record.configuration.id, record.id))
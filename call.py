@@ -0,0 +1,352 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import datetime
+import logging
+import queue
+import threading
+import time
+from functools import partial
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from . import ami
+
+__all__ = ['Call', 'CallAttempt', 'Cron']
+
+logger = logging.getLogger(__name__)
+
+# Reason codes of the OriginateResponse event
+ORIGINATE_REASONS = {
+    '0': 'Failure',
+    '1': 'Hangup',
+    '3': 'No answer',
+    '4': 'Answered',
+    '5': 'Busy',
+    '8': 'Congestion',
+    }
+# Seconds between the searches of the attempts not yet committed
+RETRY_DELAY = 0.5
+# Seconds after which the result of an attempt never committed is dropped
+RESULT_EXPIRY = 3600
+
+
+class Call(ModelSQL, ModelView):
+    'Asterisk Call'
+    __name__ = 'asterisk.call'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True)
+    start = fields.DateTime('Start', required=True, readonly=True,
+        select=True)
+    direction = fields.Selection([
+            ('incoming', 'Incoming'),
+            ('outgoing', 'Outgoing'),
+            ], 'Direction', required=True, readonly=True)
+    # The indexes on (party, start) and (user, start) are created by
+    # __register__
+    user = fields.Many2One('res.user', 'User', readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True,
+        context={
+            'company': Eval('company'),
+            },
+        depends=['company'])
+    number = fields.Char('Number', readonly=True)
+    duration = fields.Integer('Duration', readonly=True,
+        help="In seconds, the billable duration of the call.")
+    answered = fields.Boolean('Answered', readonly=True)
+    cdr = fields.Many2One('asterisk.cdr', 'Call Detail Record',
+        readonly=True, ondelete='SET NULL')
+
+    @classmethod
+    def __setup__(cls):
+        super(Call, cls).__setup__()
+        cls._order.insert(0, ('start', 'DESC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(Call, cls).__register__(module_name)
+        table_h = cls.__table_handler__(module_name)
+        # The history of a party or a user is read from the latest calls
+        table_h.index_action(['party', 'start'], 'add')
+        table_h.index_action(['user', 'start'], 'add')
+
+    @classmethod
+    def create_from_cdrs(cls, cdrs, directions):
+        "Create the calls of the CDR linked to a user or a party"
+        vlist = []
+        for cdr, direction in zip(cdrs, directions):
+            if not cdr.start or not (cdr.user or cdr.party):
+                continue
+            vlist.append({
+                    'company': cdr.company.id,
+                    'start': cdr.start,
+                    'direction': direction,
+                    'user': cdr.user.id if cdr.user else None,
+                    'party': cdr.party.id if cdr.party else None,
+                    'number': (cdr.destination if direction == 'outgoing'
+                        else cdr.source),
+                    'duration': cdr.billsec,
+                    'answered': bool(cdr.answer),
+                    'cdr': cdr.id,
+                    })
+        return cls.create(vlist)
+
+    @classmethod
+    def create(cls, vlist):
+        Party = Pool().get('party.party')
+        calls = super(Call, cls).create(vlist)
+        Party.add_asterisk_calls(calls)
+        return calls
+
+    @classmethod
+    def prune(cls, company, before, batch_size=1000, commit=False):
+        '''
+        Delete the calls of the company started before the date by batches.
+        The call summary of the parties is kept.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        count = 0
+        while True:
+            cursor.execute(*table.select(table.id,
+                    where=(table.company == company.id)
+                    & (table.start < before),
+                    order_by=[table.start.asc], limit=batch_size))
+            ids = [i for i, in cursor.fetchall()]
+            if not ids:
+                break
+            cursor.execute(*table.delete(where=table.id.in_(ids)))
+            count += len(ids)
+            if commit:
+                transaction.commit()
+        logger.info('Pruned %s calls of %s', count, company.rec_name)
+        return count
+
+    @classmethod
+    def prune_calls(cls):
+        "Prune the calls older than the retention of their configuration"
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        now = datetime.datetime.utcnow()
+        for configuration in ConfigurationCompany.search([
+                    ('call_retention', '>', 0),
+                    ]):
+            cls.prune(configuration.company,
+                now - datetime.timedelta(days=configuration.call_retention),
+                commit=True)
+
+
+class CallAttempt(ModelSQL, ModelView):
+    'Asterisk Call Attempt'
+    __name__ = 'asterisk.call.attempt'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True)
+    user = fields.Many2One('res.user', 'User', required=True, readonly=True,
+        select=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True,
+        context={
+            'company': Eval('company'),
+            },
+        depends=['company'])
+    number = fields.Char('Number', readonly=True)
+    dialed_number = fields.Char('Dialed number', readonly=True)
+    callerid = fields.Char('Caller ID', readonly=True)
+    channel = fields.Char('Channel', readonly=True)
+    pending_channels = fields.Char('Pending channels', readonly=True,
+        help="Channels to try if the current channel fails.")
+    action_id = fields.Char('Action ID', readonly=True, select=True)
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('success', 'Success'),
+            ('failed', 'Failed'),
+            ], 'State', readonly=True, required=True, select=True)
+    reason = fields.Char('Reason', readonly=True)
+
+    _results = queue.Queue()
+    _writer = None
+    _writer_lock = threading.Lock()
+
+    @classmethod
+    def __setup__(cls):
+        super(CallAttempt, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    def originate(self, channel, ast_server):
+        '''
+        Send an asynchronous Originate to the channel and return immediately.
+        The OriginateResponse event is recorded by a background thread.
+        '''
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration')
+
+        dispatcher = ami.pool.failover_dispatcher(ast_server.get_endpoints())
+        fields = Configuration.originate_fields(channel, self.dialed_number,
+            self.callerid, ast_server)
+        fields.append(('Async', 'true'))
+        callback = partial(self._queue_result,
+            Transaction().database.name, self.id)
+        response = dispatcher.send_action('Originate', fields,
+            callback=callback)
+        self.channel = channel
+        self.action_id = response.get('ActionID')
+        if not response.success:
+            self.state = 'failed'
+            self.reason = response.get('Message')
+        return response
+
+    @classmethod
+    def originate_many(cls, attempts, channel, ast_server):
+        '''
+        Send an asynchronous Originate to the channel for each attempt at
+        once on the same session and return immediately.
+        The OriginateResponse events are recorded by a background thread.
+        '''
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration')
+
+        database_name = Transaction().database.name
+        dispatcher = ami.pool.failover_dispatcher(ast_server.get_endpoints())
+        actions = []
+        for attempt in attempts:
+            fields = Configuration.originate_fields(channel,
+                attempt.dialed_number, attempt.callerid, ast_server)
+            fields.append(('Async', 'true'))
+            actions.append(('Originate', fields,
+                    partial(cls._queue_result, database_name, attempt.id)))
+        responses = dispatcher.send_actions(actions)
+        for attempt, response in zip(attempts, responses):
+            attempt.channel = channel
+            if isinstance(response, ami.AMIError):
+                attempt.state = 'failed'
+                attempt.reason = str(response)
+                continue
+            attempt.action_id = response.get('ActionID')
+            if not response.success:
+                attempt.state = 'failed'
+                attempt.reason = response.get('Message')
+
+    def originate_all(self, channels, ast_server):
+        '''
+        Ring all the channels at once and return immediately.
+        The result of the ring group is recorded by a background thread.
+        '''
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration')
+
+        on_result = partial(self._queue_result,
+            Transaction().database.name, self.id)
+        Configuration._ring_group(self.dialed_number, self.callerid, channels,
+            ast_server, on_result=on_result)
+        self.channel = ','.join(channels)
+
+    @classmethod
+    def _queue_result(cls, database_name, attempt_id, message):
+        if message is not None and message.get('Event') != 'OriginateResponse':
+            return False
+        cls._results.put((database_name, attempt_id, message,
+                time.monotonic()))
+        cls._start_writer()
+        return True
+
+    @classmethod
+    def _start_writer(cls):
+        with cls._writer_lock:
+            if cls._writer and cls._writer.is_alive():
+                return
+            cls._writer = threading.Thread(target=cls._write_results,
+                name='asterisk-call-attempt', daemon=True)
+            cls._writer.start()
+
+    @classmethod
+    def _write_results(cls):
+        # The results of the attempts whose transaction is not yet committed
+        waiting = []
+        retry_at = None
+        while True:
+            timeout = (max(retry_at - time.monotonic(), 0)
+                if waiting else None)
+            try:
+                results = [cls._results.get(timeout=timeout)]
+            except queue.Empty:
+                results = []
+            if waiting and time.monotonic() >= retry_at:
+                results, waiting = waiting + results, []
+            retry = not waiting
+            for result in results:
+                if not cls._write_result(*result):
+                    waiting.append(result)
+            if waiting and retry:
+                retry_at = time.monotonic() + RETRY_DELAY
+
+    @classmethod
+    def _write_result(cls, database_name, attempt_id, message, received):
+        "Record the result and return False if the attempt is not found yet"
+        try:
+            with Transaction().start(database_name, 0):
+                if cls.process_result(attempt_id, message):
+                    return True
+        except Exception:
+            logger.exception('Error recording originate result %s',
+                attempt_id)
+            return True
+        if time.monotonic() - received > RESULT_EXPIRY:
+            logger.warning('Originate result of the call attempt %s dropped '
+                'as the attempt is not found', attempt_id)
+            return True
+        return False
+
+    @classmethod
+    def process_result(cls, attempt_id, message):
+        pool = Pool()
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        attempts = cls.search([('id', '=', attempt_id)])
+        if not attempts:
+            return False
+        attempt, = attempts
+        if message is not None and message.get('Response') == 'Success':
+            attempt.state = 'success'
+            attempt.reason = None
+        else:
+            if message is None:
+                reason = 'Connection lost'
+            else:
+                reason = ORIGINATE_REASONS.get(message.get('Reason'),
+                    message.get('Reason'))
+            attempt.reason = reason
+            channels = (attempt.pending_channels or '').split(',')
+            channel = channels.pop(0)
+            attempt.pending_channels = ','.join(channels)
+            attempt.state = 'failed'
+            if channel:
+                logger.info('Asterisk Click2Dial to %s failed: %s, trying %s',
+                    attempt.dialed_number, reason, channel)
+                with Transaction().set_user(attempt.user.id), \
+                        Transaction().set_context(
+                            company=attempt.company.id):
+                    ast_server = (
+                        ConfigurationCompany.get_company_configuration(
+                            attempt.company.id))
+                    attempt.state = 'pending'
+                    try:
+                        attempt.originate(channel, ast_server)
+                    except ami.AMIError as e:
+                        attempt.state = 'failed'
+                        attempt.reason = str(e)
+        attempt.save()
+        return True
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('asterisk.call|prune_calls', "Prune Asterisk Calls"))
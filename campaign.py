@@ -0,0 +1,348 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import datetime
+import logging
+
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from . import ami
+from . import dialer
+
+__all__ = ['Campaign', 'CampaignAgent', 'CampaignLine', 'CampaignStore',
+    'Cron']
+
+logger = logging.getLogger(__name__)
+
+STATES = {
+    'readonly': Eval('state') != 'draft',
+    }
+# Seconds after the ring timeout from which a line still dialing has been
+# interrupted, as a line is dialed at most for its ring timeout
+DIALING_MARGIN = 60
+DEPENDS = ['state']
+
+
+class Campaign(ModelSQL, ModelView):
+    'Asterisk Campaign'
+    __name__ = 'asterisk.campaign'
+    name = fields.Char('Name', required=True)
+    company = fields.Many2One('company.company', 'Company', required=True,
+        select=True, states=STATES, depends=DEPENDS)
+    trunk = fields.Char('Trunk', required=True,
+        help="Channel used to dial the numbers, e.g. 'SIP/provider'.")
+    calls_per_second = fields.Float('Calls per second', required=True,
+        digits=(16, 2),
+        help="Maximum number of calls started per second on the trunk. "
+        "The campaigns using the same trunk share this limit.")
+    ring_timeout = fields.Integer('Ring timeout (sec)', required=True,
+        help="Amount of time (in seconds) Asterisk will try to reach the "
+        "number before hanging up.")
+    max_abandon_rate = fields.Float('Max. abandon rate', required=True,
+        digits=(16, 4),
+        help="Maximum rate of answered calls which are hung up because no "
+        "agent is free. Less lines are dialed per agent when it is "
+        "exceeded.")
+    callerid = fields.Char('Caller ID')
+    agents = fields.Many2Many('asterisk.campaign-res.user', 'campaign',
+        'user', 'Agents',
+        help="The users to whom the answered calls are sent.")
+    lines = fields.One2Many('asterisk.campaign.line', 'campaign', 'Lines',
+        states=STATES, depends=DEPENDS)
+    state = fields.Selection([
+            ('draft', 'Draft'),
+            ('running', 'Running'),
+            ('paused', 'Paused'),
+            ('done', 'Done'),
+            ], 'State', readonly=True, required=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Campaign, cls).__setup__()
+        cls._buttons.update({
+                'run': {
+                    'invisible': Eval('state') == 'running',
+                    'depends': ['state'],
+                    },
+                'pause': {
+                    'invisible': Eval('state') != 'running',
+                    'depends': ['state'],
+                    },
+                'done': {
+                    'invisible': Eval('state') == 'done',
+                    'depends': ['state'],
+                    },
+                })
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_calls_per_second():
+        return 1
+
+    @staticmethod
+    def default_ring_timeout():
+        return 30
+
+    @staticmethod
+    def default_max_abandon_rate():
+        return 0.03
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @classmethod
+    @ModelView.button
+    def run(cls, campaigns):
+        pool = Pool()
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        for campaign in campaigns:
+            if not ConfigurationCompany.get_company_values(
+                    campaign.company.id):
+                raise UserError(gettext('asterisk.error'),
+                    gettext('asterisk.no_asterisk_configuration'))
+            for agent in campaign.agents:
+                if not agent.get_asterisk_extensions(campaign.company.id):
+                    raise UserError(gettext(
+                            'asterisk.campaign_agent_no_internal_phone',
+                            agent=agent.rec_name,
+                            campaign=campaign.rec_name))
+        cls.write(campaigns, {'state': 'running'})
+
+    @classmethod
+    @ModelView.button
+    def pause(cls, campaigns):
+        cls.write(campaigns, {'state': 'paused'})
+
+    @classmethod
+    @ModelView.button
+    def done(cls, campaigns):
+        cls.write(campaigns, {'state': 'done'})
+
+    @classmethod
+    def run_dialers(cls):
+        "Start the dialer of the servers with running campaigns"
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        database_name = Transaction().database.name
+        campaigns = cls.search([('state', '=', 'running')])
+        for company in {c.company for c in campaigns}:
+            ast_server = ConfigurationCompany.get_company_configuration(
+                company.id)
+            if not ast_server:
+                continue
+            key = (database_name, ast_server.id)
+            with dialer.dialers_lock:
+                running = dialer.dialers.get(key)
+                if running and running.is_alive():
+                    if running.dispatcher.connected:
+                        continue
+                    # Fail over to another server
+                    running.stop()
+                try:
+                    dispatcher = ami.pool.failover_dispatcher(
+                        ast_server.get_endpoints())
+                except ami.AMIError as e:
+                    logger.warning('Unable to start the campaign dialer of '
+                        '%s: %s', company.rec_name, e)
+                    continue
+                store = CampaignStore(database_name, company.id)
+                store.reset_lines()
+                running = dialer.dialers[key] = dialer.Dialer(dispatcher,
+                    store, max_calls=ast_server.max_campaign_calls or 10)
+                running.start()
+            logger.info('Campaign dialer started for %s:%s',
+                *dispatcher.params[:2])
+
+    @classmethod
+    def _reset_lines(cls, company):
+        '''
+        Make the lines interrupted by a restart dialable again.
+        The lines dialed for less than their ring timeout may be dialed by
+        the dialer of another process so they are kept.
+        '''
+        Line = Pool().get('asterisk.campaign.line')
+        now = datetime.datetime.utcnow()
+        lines = []
+        for campaign in cls.search([
+                    ('company', '=', company),
+                    ('state', '=', 'running'),
+                    ]):
+            timeout = datetime.timedelta(
+                seconds=(campaign.ring_timeout or 0) + DIALING_MARGIN)
+            lines.extend(Line.search([
+                        ('campaign', '=', campaign.id),
+                        ('state', '=', 'dialing'),
+                        ['OR',
+                            ('dial_date', '=', None),
+                            ('dial_date', '<', now - timeout),
+                            ],
+                        ]))
+        Line.write(lines, {'state': 'pending'})
+
+
+class CampaignAgent(ModelSQL):
+    'Asterisk Campaign - User'
+    __name__ = 'asterisk.campaign-res.user'
+    campaign = fields.Many2One('asterisk.campaign', 'Campaign',
+        ondelete='CASCADE', select=True, required=True)
+    user = fields.Many2One('res.user', 'User', ondelete='CASCADE',
+        select=True, required=True)
+
+
+class CampaignLine(ModelSQL, ModelView):
+    'Asterisk Campaign Line'
+    __name__ = 'asterisk.campaign.line'
+    campaign = fields.Many2One('asterisk.campaign', 'Campaign',
+        required=True, ondelete='CASCADE', select=True)
+    party = fields.Many2One('party.party', 'Party')
+    number = fields.Char('Number', required=True)
+    dialed_number = fields.Char('Dialed number', readonly=True)
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('dialing', 'Dialing'),
+            ('answered', 'Answered'),
+            ('abandoned', 'Abandoned'),
+            ('failed', 'Failed'),
+            ], 'State', readonly=True, required=True, select=True)
+    reason = fields.Char('Reason', readonly=True)
+    agent = fields.Many2One('res.user', 'Agent', readonly=True)
+    dial_date = fields.DateTime('Dial date', readonly=True)
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @fields.depends('party', 'number')
+    def on_change_party(self):
+        if self.party and not self.number:
+            mechanism = self.party.contact_mechanism_get({'phone', 'mobile'})
+            if mechanism:
+                self.number = mechanism.value
+
+
+class CampaignStore(object):
+    '''
+    Access to the running campaigns of a company from the dialer thread.
+    Each method runs in its own transaction.
+    '''
+
+    def __init__(self, database_name, company):
+        self.database_name = database_name
+        self.company = company
+
+    def _transaction(self):
+        return Transaction().start(self.database_name, 0,
+            context={'company': self.company})
+
+    def campaigns(self):
+        with self._transaction():
+            pool = Pool()
+            Campaign = pool.get('asterisk.campaign')
+            ConfigurationCompany = pool.get('asterisk.configuration.company')
+            ast_server = ConfigurationCompany.get_company_configuration(
+                self.company)
+            if not ast_server:
+                return []
+            result = []
+            for campaign in Campaign.search([
+                        ('company', '=', self.company),
+                        ('state', '=', 'running'),
+                        ]):
+                agents = {}
+                for agent in campaign.agents:
+                    extensions = agent.get_asterisk_extensions(self.company)
+                    if extensions:
+                        agents[agent.id] = extensions[0][0]
+                result.append({
+                        'id': campaign.id,
+                        'trunk': campaign.trunk,
+                        'context': ast_server.context,
+                        'priority': ast_server.extension_priority or 1,
+                        'ring_timeout': campaign.ring_timeout,
+                        'callerid': campaign.callerid,
+                        'calls_per_second': campaign.calls_per_second,
+                        'max_abandon_rate': campaign.max_abandon_rate,
+                        'agents': agents,
+                        })
+            return result
+
+    def reset_lines(self):
+        "Make the interrupted lines dialable again"
+        with self._transaction() as transaction:
+            Campaign = Pool().get('asterisk.campaign')
+            Campaign._reset_lines(self.company)
+            transaction.commit()
+
+    def claim(self, campaign, count):
+        "Reserve the next lines to dial and return their numbers"
+        with self._transaction() as transaction:
+            pool = Pool()
+            Configuration = pool.get('asterisk.configuration')
+            ConfigurationCompany = pool.get('asterisk.configuration.company')
+            Line = pool.get('asterisk.campaign.line')
+            line = Line.__table__()
+            cursor = transaction.connection.cursor()
+            database = transaction.database
+            ast_server = ConfigurationCompany.get_company_configuration(
+                self.company)
+            query = line.select(line.id,
+                where=(line.campaign == campaign)
+                & (line.state == 'pending'),
+                order_by=[line.id.asc], limit=count)
+            # The lines claimed by another dialer are skipped
+            if database.has_select_for():
+                For = database.get_select_for_skip_locked()
+                query.for_ = For('UPDATE')
+            else:
+                Line.lock()
+            cursor.execute(*query)
+            lines = Line.browse([i for i, in cursor])
+            now = datetime.datetime.utcnow()
+            result = []
+            to_write = []
+            numbers = Configuration.reformat_numbers(
+                [l.number for l in lines], ast_server)
+            for line, (number, error) in zip(lines, numbers):
+                if error:
+                    to_write.extend(([line], {
+                                'state': 'failed',
+                                'reason': error,
+                                }))
+                    continue
+                to_write.extend(([line], {
+                            'state': 'dialing',
+                            'dialed_number': number,
+                            'dial_date': now,
+                            }))
+                result.append((line.id, number))
+            if to_write:
+                Line.write(*to_write)
+            transaction.commit()
+        return result
+
+    def record(self, results):
+        "Save the results of the calls"
+        with self._transaction() as transaction:
+            Line = Pool().get('asterisk.campaign.line')
+            to_write = []
+            for line_id, values in results:
+                to_write.extend(([Line(line_id)], values))
+            Line.write(*to_write)
+            transaction.commit()
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('asterisk.campaign|run_dialers', "Run Asterisk Campaigns"))
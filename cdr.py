@@ -0,0 +1,254 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import csv
+import datetime
+import logging
+import os
+
+from dateutil import tz
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+
+__all__ = ['Cdr', 'Cron']
+
+logger = logging.getLogger(__name__)
+
+# Columns of the Master.csv file written by cdr_csv
+CSV_COLUMNS = ['accountcode', 'source', 'destination', 'context', 'callerid',
+    'channel', 'destination_channel', 'last_application', 'last_data',
+    'start', 'answer', 'end', 'duration', 'billsec', 'disposition',
+    'amaflags', 'uniqueid', 'userfield']
+# Keys of the Cdr events sent by cdr_manager
+EVENT_KEYS = {
+    'accountcode': 'AccountCode',
+    'source': 'Source',
+    'destination': 'Destination',
+    'context': 'DestinationContext',
+    'callerid': 'CallerID',
+    'channel': 'Channel',
+    'destination_channel': 'DestinationChannel',
+    'last_application': 'LastApplication',
+    'last_data': 'LastData',
+    'start': 'StartTime',
+    'answer': 'AnswerTime',
+    'end': 'EndTime',
+    'duration': 'Duration',
+    'billsec': 'BillableSeconds',
+    'disposition': 'Disposition',
+    'amaflags': 'AMAFlags',
+    'uniqueid': 'UniqueID',
+    'userfield': 'UserField',
+    }
+
+
+def _extension_user(extensions, number, channel):
+    "Return the user of the number or of the channel like 'SIP/100-0000001'"
+    if number in extensions:
+        return extensions[number]
+    if channel and '/' in channel:
+        return extensions.get(channel.split('/', 1)[1].rsplit('-', 1)[0])
+
+
+class Cdr(ModelSQL, ModelView):
+    'Asterisk Call Detail Record'
+    __name__ = 'asterisk.cdr'
+    configuration = fields.Many2One('asterisk.configuration.company',
+        'Configuration', required=True, readonly=True, ondelete='CASCADE')
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True)
+    accountcode = fields.Char('Account code', readonly=True)
+    source = fields.Char('Source', readonly=True, select=True)
+    destination = fields.Char('Destination', readonly=True, select=True)
+    context = fields.Char('Context', readonly=True)
+    callerid = fields.Char('Caller ID', readonly=True)
+    channel = fields.Char('Channel', readonly=True)
+    destination_channel = fields.Char('Destination channel', readonly=True)
+    last_application = fields.Char('Last application', readonly=True)
+    last_data = fields.Char('Last data', readonly=True)
+    start = fields.DateTime('Start', readonly=True, select=True)
+    answer = fields.DateTime('Answer', readonly=True)
+    end = fields.DateTime('End', readonly=True)
+    duration = fields.Integer('Duration', readonly=True,
+        help="In seconds.")
+    billsec = fields.Integer('Billable duration', readonly=True,
+        help="In seconds.")
+    disposition = fields.Char('Disposition', readonly=True)
+    amaflags = fields.Char('AMA flags', readonly=True)
+    uniqueid = fields.Char('Unique ID', readonly=True, select=True)
+    userfield = fields.Char('User field', readonly=True)
+    user = fields.Many2One('res.user', 'User', readonly=True, select=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True,
+        select=True,
+        context={
+            'company': Eval('company'),
+            },
+        depends=['company'])
+    recordings = fields.One2Many('asterisk.recording', 'cdr', 'Recordings',
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Cdr, cls).__setup__()
+        cls._order.insert(0, ('start', 'DESC'))
+
+    @staticmethod
+    def timezone(configuration):
+        '''
+        Return the timezone of the times written by Asterisk: the one of the
+        company or else the one of the server.
+        '''
+        timezone = configuration.company.timezone
+        return (timezone and tz.gettz(timezone)) or tz.tzlocal()
+
+    @staticmethod
+    def _parse_datetime(value, timezone=None):
+        "Return the naive UTC datetime of the local time value"
+        if not value:
+            return None
+        try:
+            value = datetime.datetime.strptime(value[:19],
+                '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return None
+        if timezone:
+            value = value.replace(tzinfo=timezone).astimezone(
+                tz.tzutc()).replace(tzinfo=None)
+        return value
+
+    @classmethod
+    def _parse(cls, values, timezone=None):
+        "Convert the raw values of a record"
+        for name in ('start', 'answer', 'end'):
+            values[name] = cls._parse_datetime(values.get(name), timezone)
+        for name in ('duration', 'billsec'):
+            try:
+                values[name] = int(values.get(name) or 0)
+            except ValueError:
+                values[name] = None
+        return values
+
+    @classmethod
+    def values_from_row(cls, row, timezone=None):
+        return cls._parse(dict(zip(CSV_COLUMNS, row)), timezone)
+
+    @classmethod
+    def values_from_event(cls, message, timezone=None):
+        return cls._parse({n: message.get(k) for n, k in EVENT_KEYS.items()},
+            timezone)
+
+    @classmethod
+    def store_cdrs(cls, configuration, vlist):
+        '''
+        Create the records from the list of raw values and link them to the
+        user of the extension and to the party of the other number.
+        '''
+        pool = Pool()
+        User = pool.get('res.user')
+        ContactMechanism = pool.get('party.contact_mechanism')
+        Recording = pool.get('asterisk.recording')
+        Call = pool.get('asterisk.call')
+
+        extensions = User.extension_users(configuration.company.id)
+        numbers = {}
+        directions = []
+        for values in vlist:
+            values['configuration'] = configuration.id
+            values['company'] = configuration.company.id
+            user = _extension_user(extensions, values.get('source'),
+                values.get('channel'))
+            if user:
+                number = values.get('destination')
+                directions.append('outgoing')
+            else:
+                user = _extension_user(extensions, values.get('destination'),
+                    values.get('destination_channel'))
+                number = values.get('source')
+                directions.append('incoming')
+            values['user'] = user
+            if number:
+                numbers.setdefault(number, []).append(values)
+        parties = ContactMechanism.match_numbers(list(numbers),
+            ast_server=configuration)
+        for number, party_ids in parties.items():
+            for values in numbers[number]:
+                values['party'] = party_ids[0]
+        cdrs = cls.create(vlist)
+        # The recordings may be indexed before their CDR
+        Recording.link_cdrs(cdrs=cdrs)
+        Call.create_from_cdrs(cdrs, directions)
+        return cdrs
+
+    @staticmethod
+    def _read_lines(file, position):
+        "Yield the complete lines of file and update the position"
+        for line in file:
+            if not line.endswith(b'\n'):
+                # The line is being written by Asterisk
+                break
+            position[0] += len(line)
+            yield line.decode('utf-8', 'replace')
+
+    @classmethod
+    def import_file(cls, configuration, batch_size=1000, commit=False):
+        '''
+        Import the new lines of the CDR file of the configuration from the
+        offset of the previous import.
+        '''
+        pool = Pool()
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        path = configuration.cdr_path
+        if not path or not os.path.exists(path):
+            return 0
+        timezone = cls.timezone(configuration)
+        count = 0
+        with open(path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            offset = configuration.cdr_offset or 0
+            if (stat.st_ino != (configuration.cdr_inode or stat.st_ino)
+                    or stat.st_size < offset):
+                # The file has been rotated
+                offset = 0
+            file.seek(offset)
+            position = [offset]
+            reader = csv.reader(cls._read_lines(file, position))
+            while True:
+                vlist = []
+                for row in reader:
+                    vlist.append(cls.values_from_row(row, timezone))
+                    if len(vlist) >= batch_size:
+                        break
+                if not vlist:
+                    break
+                cls.store_cdrs(configuration, vlist)
+                count += len(vlist)
+                ConfigurationCompany.write([configuration], {
+                        'cdr_offset': position[0],
+                        'cdr_inode': stat.st_ino,
+                        })
+                if commit:
+                    Transaction().commit()
+        logger.info('Imported %s CDR from %s', count, path)
+        return count
+
+    @classmethod
+    def import_cdr(cls):
+        "Import the CDR files of all the configurations"
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        for configuration in ConfigurationCompany.search([
+                    ('cdr_path', '!=', None),
+                    ]):
+            cls.import_file(configuration, commit=True)
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('asterisk.cdr|import_cdr', "Import Asterisk CDR"))
@@ -0,0 +1,366 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''
+Campaign dialer placing the calls of the running campaigns of a server.
+
+The numbers are dialed first and each answered call is redirected to a free
+agent of its campaign. The number of lines dialed per free agent follows the
+live answer rate and is reduced when too many answered calls are abandoned
+because no agent is free.
+'''
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from functools import partial
+
+from .ami import AMIError
+from .call import ORIGINATE_REASONS
+
+__all__ = ['TokenBucket', 'Pacer', 'CampaignRun', 'Dialer', 'dialers']
+
+logger = logging.getLogger(__name__)
+
+# Seconds an answered call waits to be redirected to an agent
+ANSWER_WAIT = 10
+
+
+class TokenBucket(object):
+    'Limit the rate of an operation while allowing short bursts'
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'clock', '_lock')
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        "Take the tokens and return 0 or the seconds to wait for them"
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+
+class Pacer(object):
+    'Compute the number of lines to dial from the last results'
+    __slots__ = ('max_abandon_rate', 'max_ratio', 'min_samples', 'results')
+
+    def __init__(self, max_abandon_rate=0.03, max_ratio=3, window=100,
+            min_samples=10):
+        self.max_abandon_rate = max_abandon_rate
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.results = deque(maxlen=window)
+
+    def record(self, result):
+        "Record the result of a call: answered, abandoned or failed"
+        self.results.append(result)
+
+    @property
+    def abandon_rate(self):
+        abandoned = self.results.count('abandoned')
+        connected = abandoned + self.results.count('answered')
+        return abandoned / connected if connected else 0
+
+    @property
+    def ratio(self):
+        "The number of lines to dial per free agent"
+        if len(self.results) < self.min_samples:
+            return 1
+        connected = len(self.results) - self.results.count('failed')
+        if not connected:
+            return self.max_ratio
+        ratio = len(self.results) / connected
+        abandon_rate = self.abandon_rate
+        if abandon_rate > self.max_abandon_rate:
+            ratio = 1 + (ratio - 1) * self.max_abandon_rate / abandon_rate
+        return min(max(ratio, 1), self.max_ratio)
+
+    def lines(self, free_agents, ringing):
+        "Return the number of lines to dial"
+        return max(0, int(free_agents * self.ratio + 0.5) - ringing)
+
+
+class CampaignRun(object):
+    'The state of a running campaign kept in memory by the dialer'
+    __slots__ = ('id', 'trunk', 'context', 'priority', 'ring_timeout',
+        'callerid', 'calls_per_second', 'agents', 'busy', 'ringing', 'pacer')
+
+    def __init__(self, id, trunk, context, priority=1, ring_timeout=30,
+            callerid=None, calls_per_second=1, max_abandon_rate=0.03,
+            agents=None):
+        self.id = id
+        self.busy = set()
+        self.ringing = 0
+        self.pacer = Pacer(max_abandon_rate)
+        self.update(trunk, context, priority=priority,
+            ring_timeout=ring_timeout, callerid=callerid,
+            calls_per_second=calls_per_second,
+            max_abandon_rate=max_abandon_rate, agents=agents)
+
+    def update(self, trunk, context, priority=1, ring_timeout=30,
+            callerid=None, calls_per_second=1, max_abandon_rate=0.03,
+            agents=None):
+        self.trunk = trunk
+        self.context = context
+        self.priority = priority
+        self.ring_timeout = ring_timeout
+        self.callerid = callerid
+        self.calls_per_second = calls_per_second
+        self.pacer.max_abandon_rate = max_abandon_rate
+        # The extension of each agent
+        self.agents = dict(agents or {})
+
+    @property
+    def free_agents(self):
+        return [a for a in self.agents if a not in self.busy]
+
+    def take_agent(self):
+        "Reserve a free agent and return its id and extension"
+        for agent in self.free_agents:
+            self.busy.add(agent)
+            return agent, self.agents[agent]
+        return None, None
+
+
+class _Call(object):
+    __slots__ = ('run', 'line', 'uniqueid', 'channel', 'agent')
+
+    def __init__(self, run, line, uniqueid):
+        self.run = run
+        self.line = line
+        self.uniqueid = uniqueid
+        self.channel = None
+        self.agent = None
+
+
+class Dialer(object):
+    '''
+    Dial the lines of the running campaigns of a server through its AMI
+    dispatcher.
+
+    The store gives access to the campaigns:
+        campaigns() returns the values of CampaignRun of each campaign,
+        claim(campaign, count) returns a list of (line, number) to dial,
+        record(results) saves a list of (line, values).
+
+    At most max_calls originates are ringing at once and the calls on each
+    trunk are limited by a token bucket.
+    '''
+
+    def __init__(self, dispatcher, store, max_calls=10, interval=1,
+            clock=time.monotonic):
+        self.dispatcher = dispatcher
+        self.store = store
+        self.max_calls = max_calls
+        self.interval = interval
+        self.clock = clock
+        self.campaigns = {}
+        self.calls = {}
+        self.buckets = {}
+        self.results = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def ringing(self):
+        return sum(r.ringing for r in self.campaigns.values())
+
+    def start(self):
+        self.dispatcher.subscribers.append(self._track)
+        self._thread = threading.Thread(target=self._run,
+            name='asterisk-dialer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def is_alive(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set():
+                try:
+                    if not self.step() and not self.calls:
+                        break
+                except Exception:
+                    logger.exception('Error in the campaign dialer')
+                self._stopped.wait(self.interval)
+        finally:
+            self._unsubscribe()
+            self.flush()
+
+    def _unsubscribe(self):
+        try:
+            self.dispatcher.subscribers.remove(self._track)
+        except ValueError:
+            pass
+
+    def sync(self):
+        "Update the running campaigns from the store"
+        campaigns = {c['id']: c for c in self.store.campaigns()}
+        with self._lock:
+            for id_ in set(self.campaigns) - set(campaigns):
+                run = self.campaigns[id_]
+                if not run.ringing and not run.busy:
+                    del self.campaigns[id_]
+                else:
+                    # Let the calls in progress finish
+                    run.agents = {a: run.agents[a] for a in run.busy}
+            for id_, values in campaigns.items():
+                values = values.copy()
+                del values['id']
+                if id_ in self.campaigns:
+                    self.campaigns[id_].update(**values)
+                else:
+                    self.campaigns[id_] = CampaignRun(id_, **values)
+        return campaigns
+
+    def step(self):
+        "Place the calls needed and return if campaigns are running"
+        self.flush()
+        running = self.sync()
+        for id_ in running:
+            run = self.campaigns[id_]
+            with self._lock:
+                count = min(
+                    run.pacer.lines(len(run.free_agents), run.ringing),
+                    self.max_calls - self.ringing)
+            if count <= 0:
+                continue
+            for line, number in self.store.claim(id_, count):
+                if self._stopped.is_set():
+                    self.results.append((line, {'state': 'pending'}))
+                    continue
+                self.originate(run, line, number)
+        return bool(running)
+
+    def flush(self):
+        with self._lock:
+            results, self.results = self.results, []
+        if results:
+            try:
+                self.store.record(results)
+            except Exception:
+                with self._lock:
+                    self.results[:0] = results
+                raise
+
+    def _wait_token(self, run):
+        bucket = self.buckets.get(run.trunk)
+        if bucket is None:
+            bucket = self.buckets[run.trunk] = TokenBucket(
+                run.calls_per_second, clock=self.clock)
+        bucket.rate = run.calls_per_second
+        delay = bucket.consume()
+        while delay and not self._stopped.is_set():
+            self._stopped.wait(delay)
+            delay = bucket.consume()
+
+    def originate(self, run, line, number):
+        self._wait_token(run)
+        call = _Call(run, line, uuid.uuid4().hex)
+        fields = [
+            ('Channel', '%s/%s' % (run.trunk, number)),
+            ('Timeout', run.ring_timeout * 1000),
+            ('Application', 'Wait'),
+            ('Data', ANSWER_WAIT),
+            ('Async', 'true'),
+            ('ChannelId', call.uniqueid),
+            ]
+        if run.callerid:
+            fields.append(('CallerId', run.callerid))
+        with self._lock:
+            self.calls[call.uniqueid] = call
+            run.ringing += 1
+        try:
+            response = self.dispatcher.send_action('Originate', fields,
+                callback=partial(self._response, call))
+        except AMIError as e:
+            self._end(call, 'failed', str(e))
+            return
+        if not response.success:
+            self._end(call, 'failed', response.get('Message'))
+
+    def _end(self, call, state, reason=None):
+        with self._lock:
+            if self.calls.pop(call.uniqueid, None) is None:
+                return
+            call.run.ringing -= 1
+            call.run.pacer.record(state)
+            self.results.append((call.line, {
+                        'state': state,
+                        'reason': reason,
+                        }))
+
+    def _response(self, call, message):
+        if message is not None and message.get('Event') != 'OriginateResponse':
+            return False
+        if message is None:
+            self._end(call, 'failed', 'Connection lost')
+        elif message.get('Response') != 'Success':
+            self._end(call, 'failed', ORIGINATE_REASONS.get(
+                    message.get('Reason'), message.get('Reason')))
+        else:
+            self._answered(call, call.channel or message.get('Channel'))
+        return True
+
+    def _answered(self, call, channel):
+        run = call.run
+        with self._lock:
+            run.ringing -= 1
+            agent, extension = run.take_agent()
+            call.agent = agent
+            state = 'answered' if agent else 'abandoned'
+            run.pacer.record(state)
+            self.results.append((call.line, {
+                        'state': state,
+                        'agent': agent,
+                        'reason': None,
+                        }))
+            if not agent:
+                self.calls.pop(call.uniqueid, None)
+        if agent:
+            self.dispatcher.write_action('Redirect', [
+                    ('Channel', channel),
+                    ('Exten', extension),
+                    ('Context', run.context),
+                    ('Priority', run.priority),
+                    ])
+        else:
+            logger.info('Campaign %s: no free agent for line %s',
+                run.id, call.line)
+            self.dispatcher.write_action('Hangup', [('Channel', channel)])
+
+    def _track(self, message):
+        event = message.get('Event')
+        if event not in {'Newchannel', 'Hangup'}:
+            return
+        with self._lock:
+            call = self.calls.get(message.get('Uniqueid'))
+            if call is None:
+                return
+            if event == 'Newchannel':
+                call.channel = message.get('Channel')
+            elif call.agent is not None:
+                # The agent is free again when the customer hangs up
+                del self.calls[call.uniqueid]
+                call.run.busy.discard(call.agent)
+
+
+# The running dialer of each server
+dialers = {}
+dialers_lock = threading.Lock()
@@ -0,0 +1,65 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.tools import grouped_slice
+
+__all__ = ['ChannelEvent']
+
+
+class ChannelEvent(ModelSQL, ModelView):
+    'Asterisk Channel Event'
+    __name__ = 'asterisk.channel.event'
+    configuration = fields.Many2One('asterisk.configuration.company',
+        'Configuration', required=True, readonly=True, ondelete='CASCADE')
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True)
+    event = fields.Char('Event', required=True, readonly=True)
+    timestamp = fields.DateTime('Timestamp', required=True, readonly=True,
+        select=True)
+    uniqueid = fields.Char('Unique ID', readonly=True, select=True)
+    linkedid = fields.Char('Linked ID', readonly=True, select=True)
+    channel = fields.Char('Channel', readonly=True)
+    channel_state = fields.Char('Channel state', readonly=True)
+    callerid_number = fields.Char('Caller ID number', readonly=True)
+    callerid_name = fields.Char('Caller ID name', readonly=True)
+    exten = fields.Char('Extension', readonly=True)
+    context = fields.Char('Context', readonly=True)
+    cause = fields.Char('Hangup cause', readonly=True)
+    dial_status = fields.Char('Dial status', readonly=True)
+    destination_channel = fields.Char('Destination channel', readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True,
+        context={
+            'company': Eval('company'),
+            },
+        depends=['company'],
+        help="The party of the caller ID number.")
+
+    @classmethod
+    def __setup__(cls):
+        super(ChannelEvent, cls).__setup__()
+        cls._order.insert(0, ('timestamp', 'DESC'))
+
+    @classmethod
+    def store_events(cls, values, batch_size=500):
+        '''
+        Create the events from the list of values received by the listener
+        and link the caller ID numbers to their party.
+        '''
+        numbers = {v['callerid_number'] for v in values
+            if v.get('callerid_number') and v['event'] == 'Newchannel'}
+        parties = cls._lookup_parties(numbers)
+        for value in values:
+            if value['event'] == 'Newchannel':
+                value['party'] = parties.get(value.get('callerid_number'))
+        for sub_values in grouped_slice(values, batch_size):
+            cls.create(list(sub_values))
+
+    @classmethod
+    def _lookup_parties(cls, numbers):
+        "Return a dictionary of party id for each number"
+        ContactMechanism = Pool().get('party.contact_mechanism')
+        matches = ContactMechanism.match_numbers(numbers)
+        return {n: p[0] for n, p in matches.items()}
@@ -0,0 +1,451 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''
+Long running listener of the Asterisk Manager Interface events.
+
+It keeps the state of the channels in memory and stores the call events in
+asterisk.channel.event and the Cdr events in asterisk.cdr with batched
+inserts. The queue events are added to the statistics of asterisk.queue.stat
+with each batch. The users whose extension rings are notified through the bus.
+The wallboard of the agents and queues is sent to the bus as it changes.
+'''
+import asyncio
+import datetime
+import logging
+import os
+import sys
+
+from . import metrics
+from .queue import EVENTS as QUEUE_EVENTS, queue_values
+from .transport import AMITimeout, AsyncAMIClient, async_client
+from .wallboard import (EVENTS as WALLBOARD_EVENTS,
+    INTERVAL as WALLBOARD_INTERVAL, WallboardState)
+
+__all__ = ['ChannelState', 'AsyncAMIClient', 'EventListener', 'main']
+
+logger = logging.getLogger(__name__)
+
+# Classes of the events sent by the Asterisk servers to the listener
+EVENT_CLASSES = 'call,cdr,agent'
+# Seconds between the reloads of the extensions of the users
+EXTENSIONS_INTERVAL = 60
+# Failures to store a batch after which its events are stored one by one
+STORE_RETRIES = 5
+
+
+class ChannelState(object):
+    'The state of a channel kept in memory by the listener'
+    __slots__ = ('uniqueid', 'linkedid', 'channel', 'state',
+        'callerid_number', 'callerid_name', 'exten', 'context', 'start')
+
+    def __init__(self, uniqueid, linkedid=None, channel=None, state=None,
+            callerid_number=None, callerid_name=None, exten=None,
+            context=None, start=None):
+        self.uniqueid = uniqueid
+        self.linkedid = linkedid
+        self.channel = channel
+        self.state = state
+        self.callerid_number = callerid_number
+        self.callerid_name = callerid_name
+        self.exten = exten
+        self.context = context
+        self.start = start
+
+    def update(self, message):
+        self.linkedid = message.get('Linkedid', self.linkedid)
+        self.channel = message.get('Channel', self.channel)
+        self.state = message.get('ChannelStateDesc', self.state)
+        self.callerid_number = message.get('CallerIDNum',
+            self.callerid_number)
+        self.callerid_name = message.get('CallerIDName', self.callerid_name)
+        self.exten = message.get('Exten', self.exten)
+        self.context = message.get('Context', self.context)
+
+
+class EventListener(object):
+    '''
+    Keep the channel states of a server in memory and store its call events
+    in batches.
+
+    The events are buffered until they are stored so none is lost when the
+    connection to Asterisk or to the database is interrupted. A batch which
+    still fails after some retries is stored event by event, dropping the
+    events which can not be stored.
+
+    When the channel of an extension starts ringing, its user is found in the
+    extensions kept in memory and the rings received meanwhile are sent to
+    the bus in one transaction.
+    '''
+    events = {'Newchannel', 'Newstate', 'Hangup', 'DialEnd'}
+
+    def __init__(self, database_name, configuration, company, client,
+            batch_size=500, flush_interval=1,
+            extensions_interval=EXTENSIONS_INTERVAL, wallboard=None,
+            wallboard_interval=WALLBOARD_INTERVAL,
+            store_retries=STORE_RETRIES):
+        self.database_name = database_name
+        self.configuration = configuration
+        self.company = company
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.extensions_interval = extensions_interval
+        self.channels = {}
+        self.buffer = []
+        self.cdrs = []
+        self.queue_events = []
+        # The user id of each extension
+        self.extensions = {}
+        self.rings = []
+        if wallboard is None:
+            wallboard = WallboardState()
+        # The servers of a configuration share its wallboard which is
+        # published by the first listener
+        self.wallboard = wallboard
+        if wallboard.publisher is None:
+            wallboard.publisher = self
+        self.wallboard_interval = wallboard_interval
+        self.store_retries = store_retries
+        self._flush = None
+        self._ring = None
+
+    def on_event(self, message):
+        name = message.get('Event')
+        if name in WALLBOARD_EVENTS:
+            self.wallboard.on_event(message, self.channel_user(message))
+        if name == 'Cdr':
+            self.cdrs.append(message)
+            if len(self.cdrs) >= self.batch_size and self._flush:
+                self._flush.set()
+            return
+        if name in QUEUE_EVENTS:
+            self.queue_events.append(queue_values(message))
+            if len(self.queue_events) >= self.batch_size and self._flush:
+                self._flush.set()
+            return
+        if name not in self.events:
+            return
+        uniqueid = message.get('Uniqueid')
+        channel = self.channels.get(uniqueid)
+        if name == 'Hangup':
+            self.channels.pop(uniqueid, None)
+        elif channel is None:
+            if name != 'Newchannel':
+                return
+            channel = self.channels[uniqueid] = ChannelState(uniqueid,
+                start=datetime.datetime.utcnow())
+        if channel is not None:
+            channel.update(message)
+        if (name == 'Newstate' and channel is not None
+                and message.get('ChannelState') == '5'):
+            self.on_ring(channel, message)
+        self.buffer.append(self.event_values(message))
+        if len(self.buffer) >= self.batch_size and self._flush:
+            self._flush.set()
+
+    def on_ring(self, channel, message):
+        "Queue the notification of the user of the ringing extension"
+        extension = self.channel_extension(channel.channel)
+        user = self.extensions.get(extension)
+        if user is None:
+            return
+        self.rings.append({
+                'user': user,
+                'extension': extension,
+                'uniqueid': message.get('Uniqueid'),
+                'number': message.get('ConnectedLineNum'),
+                'name': message.get('ConnectedLineName'),
+                })
+        if self._ring:
+            self._ring.set()
+
+    def channel_user(self, message):
+        "Return the user of the extension of the channel of the message"
+        return self.extensions.get(
+            self.channel_extension(message.get('Channel')))
+
+    @staticmethod
+    def channel_extension(channel):
+        "Return the extension of a channel name like SIP/100-00000001"
+        if not channel or '/' not in channel:
+            return None
+        return channel.rsplit('-', 1)[0].split('/', 1)[1]
+
+    def event_values(self, message):
+        return {
+            'configuration': self.configuration,
+            'company': self.company,
+            'event': message['Event'],
+            'timestamp': datetime.datetime.utcnow(),
+            'uniqueid': message.get('Uniqueid'),
+            'linkedid': message.get('Linkedid'),
+            'channel': message.get('Channel'),
+            'channel_state': message.get('ChannelStateDesc'),
+            'callerid_number': message.get('CallerIDNum'),
+            'callerid_name': message.get('CallerIDName'),
+            'exten': message.get('Exten'),
+            'context': message.get('Context'),
+            'cause': message.get('Cause-txt'),
+            'dial_status': message.get('DialStatus'),
+            'destination_channel': message.get('DestChannel'),
+            }
+
+    async def on_connect(self, client):
+        "Synchronize the channel states after a (re)connection"
+        active = {}
+        complete = asyncio.get_event_loop().create_future()
+
+        def collect(message):
+            if message.get('Event') == 'CoreShowChannel':
+                state = ChannelState(message.get('Uniqueid'))
+                state.update(message)
+                active[state.uniqueid] = state
+                self.wallboard.on_event(message, self.channel_user(message))
+                return False
+            elif message.get('Event') == 'CoreShowChannelsComplete':
+                complete.set_result(True)
+                return True
+
+        await client.send_action('CoreShowChannels', callback=collect)
+        try:
+            await asyncio.wait_for(complete, client.timeout)
+        except asyncio.TimeoutError:
+            raise AMITimeout('Incomplete list of channels')
+        for uniqueid in set(self.channels) - set(active):
+            state = self.channels.pop(uniqueid)
+            message = {
+                'Event': 'Hangup',
+                'Uniqueid': uniqueid,
+                'Linkedid': state.linkedid,
+                'Channel': state.channel,
+                'Cause-txt': 'Lost during reconnection',
+                }
+            self.buffer.append(self.event_values(message))
+            self.wallboard.on_event(message)
+        for uniqueid, state in active.items():
+            if uniqueid in self.channels:
+                state.start = self.channels[uniqueid].start
+            self.channels[uniqueid] = state
+
+    def store(self, values, cdrs=None, queue_events=None):
+        "Store the values in the database, called in an executor"
+        from trytond.pool import Pool
+        from trytond.transaction import Transaction
+
+        with Transaction().start(self.database_name, 0,
+                context={'company': self.company}):
+            pool = Pool()
+            Event = pool.get('asterisk.channel.event')
+            Cdr = pool.get('asterisk.cdr')
+            QueueStat = pool.get('asterisk.queue.stat')
+            ConfigurationCompany = pool.get('asterisk.configuration.company')
+            configuration = ConfigurationCompany(self.configuration)
+            if values:
+                Event.store_events(values)
+            if cdrs:
+                timezone = Cdr.timezone(configuration)
+                Cdr.store_cdrs(configuration,
+                    [Cdr.values_from_event(m, timezone) for m in cdrs])
+            if queue_events:
+                QueueStat.add_events(configuration, queue_events)
+
+    def load_extensions(self):
+        "Return the user id of each extension, called in an executor"
+        from trytond.pool import Pool
+        from trytond.transaction import Transaction
+
+        with Transaction().start(self.database_name, 0, readonly=True,
+                context={'company': self.company}):
+            User = Pool().get('res.user')
+            return User.extension_users(self.company)
+
+    def notify(self, rings):
+        "Send the rings to the bus, called in an executor"
+        from trytond.pool import Pool
+        from trytond.transaction import Transaction
+
+        with Transaction().start(self.database_name, 0,
+                context={'company': self.company}):
+            User = Pool().get('res.user')
+            User.notify_incoming_calls(rings)
+
+    def publish(self, changes, snapshot, reset=False):
+        "Send the changes of the wallboard to the bus, called in an executor"
+        from trytond.pool import Pool
+        from trytond.transaction import Transaction
+
+        with Transaction().start(self.database_name, 0,
+                context={'company': self.company}):
+            pool = Pool()
+            Wallboard = pool.get('asterisk.wallboard')
+            ConfigurationCompany = pool.get('asterisk.configuration.company')
+            Wallboard.publish(ConfigurationCompany(self.configuration),
+                changes, snapshot, reset=reset)
+
+    async def screen_pop(self):
+        loop = asyncio.get_event_loop()
+        self._ring = asyncio.Event()
+        loaded = None
+        while True:
+            if (loaded is None
+                    or loop.time() - loaded >= self.extensions_interval):
+                try:
+                    self.extensions = await loop.run_in_executor(None,
+                        self.load_extensions)
+                    loaded = loop.time()
+                except Exception:
+                    logger.exception('Unable to load the user extensions')
+            try:
+                await asyncio.wait_for(self._ring.wait(),
+                    self.extensions_interval)
+            except asyncio.TimeoutError:
+                continue
+            self._ring.clear()
+            rings, self.rings = self.rings, []
+            try:
+                await loop.run_in_executor(None, self.notify, rings)
+            except Exception:
+                # The rings are not retried as they would be too late
+                logger.exception('Unable to notify %s incoming calls',
+                    len(rings))
+
+    async def flush(self):
+        loop = asyncio.get_event_loop()
+        self._flush = asyncio.Event()
+        failures = 0
+        while True:
+            try:
+                await asyncio.wait_for(self._flush.wait(),
+                    self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush.clear()
+            if not self.buffer and not self.cdrs and not self.queue_events:
+                continue
+            batch, self.buffer = self.buffer, []
+            cdrs, self.cdrs = self.cdrs, []
+            queue_events, self.queue_events = self.queue_events, []
+            try:
+                await loop.run_in_executor(None, self.store, batch, cdrs,
+                    queue_events)
+            except Exception:
+                logger.exception('Unable to store %s AMI events',
+                    len(batch) + len(cdrs) + len(queue_events))
+                failures += 1
+                if failures < self.store_retries:
+                    self.buffer[:0] = batch
+                    self.cdrs[:0] = cdrs
+                    self.queue_events[:0] = queue_events
+                    await asyncio.sleep(self.flush_interval)
+                    continue
+                # Some events of the batch may be invalid
+                await self.store_each(batch, cdrs, queue_events)
+            failures = 0
+
+    async def store_each(self, batch, cdrs, queue_events):
+        "Store the events one by one and drop those which fail"
+        loop = asyncio.get_event_loop()
+        for args in ([([v], None, None) for v in batch]
+                + [([], [m], None) for m in cdrs]
+                + [([], None, [e]) for e in queue_events]):
+            try:
+                await loop.run_in_executor(None, self.store, *args)
+            except Exception:
+                logger.exception('Dropping the AMI event %s', args)
+
+    async def publish_wallboard(self):
+        loop = asyncio.get_event_loop()
+        wallboard = self.wallboard
+        while True:
+            await asyncio.sleep(self.wallboard_interval)
+            # The changes of all the events received meanwhile are sent at
+            # once
+            reset = wallboard.stale
+            changes = wallboard.changes()
+            if changes is None and not reset:
+                continue
+            try:
+                await loop.run_in_executor(None, self.publish, changes,
+                    wallboard.snapshot(), reset)
+                wallboard.stale = False
+            except Exception:
+                logger.exception('Unable to publish the wallboard')
+                wallboard.stale = True
+
+    async def run(self):
+        tasks = [
+            self.client.run(self.on_event, self.on_connect),
+            self.flush(),
+            self.screen_pop(),
+            ]
+        if self.wallboard.publisher is self:
+            tasks.append(self.publish_wallboard())
+        await asyncio.gather(*tasks)
+
+
+def listeners(database_name, **kwargs):
+    "Return an EventListener for each Asterisk server of the configurations"
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    result = []
+    with Transaction().start(database_name, 0, readonly=True):
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration.company')
+        for configuration in Configuration.search([
+                    ('ip_address', '!=', None),
+                    ]):
+            wallboard = WallboardState()
+            # Each server has its own calls
+            for endpoint in configuration.get_endpoints():
+                client = async_client(*endpoint.params,
+                    events=EVENT_CLASSES)
+                result.append(EventListener(database_name, configuration.id,
+                        configuration.company.id, client,
+                        wallboard=wallboard, **kwargs))
+    return result
+
+
+def main():
+    from trytond import commandline
+    from trytond.config import config
+
+    parser = commandline.get_parser_daemon()
+    parser.description = __doc__
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+        default=500, help="number of events stored per transaction")
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int,
+        help="serve the metrics in the Prometheus format on this port")
+    options = parser.parse_args()
+    configfile = options.configfile and options.configfile[0]
+    if configfile and configfile != os.environ.get('TRYTOND_CONFIG'):
+        # trytond reads some options when imported so the configuration must
+        # be set before this module is imported
+        os.environ['TRYTOND_CONFIG'] = configfile
+        os.execv(sys.argv[0], sys.argv)
+    config.update_etc(options.configfile)
+    commandline.config_log(options)
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    tasks = []
+    for database_name in options.database_names:
+        pool = Pool(database_name)
+        with Transaction().start(database_name, 0, readonly=True):
+            pool.init()
+        tasks.extend(l.run() for l in listeners(database_name,
+                batch_size=options.batch_size))
+    if not tasks:
+        parser.error('No Asterisk server configured')
+
+    if options.metrics_port:
+        metrics.start_exporter(options.metrics_port)
+
+    async def run():
+        await asyncio.gather(*tasks)
+
+    with commandline.pidfile(options):
+        asyncio.run(run())
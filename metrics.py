@@ -0,0 +1,211 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''
+Process wide counters and histograms of the AMI operations rendered in the
+Prometheus text format.
+'''
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Registry', 'registry',
+    'start_exporter']
+
+# Upper bounds in seconds of the buckets of the durations
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+    5, 10)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+        .replace('"', '\\"'))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, _escape(v)) for n, v in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(n, '') for n in self.labelnames)
+
+    def samples(self):
+        "Yield the (suffix, label values, extra labels, value) of the metric"
+        return iter(())
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.type),
+            ]
+        for suffix, values, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                    _format_labels(self.labelnames, values, extra),
+                    _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    'A value which only increases'
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield '', key, (), value
+
+
+class Gauge(Metric):
+    'A value computed by a function when it is rendered'
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.function = function
+
+    def samples(self):
+        "The function returns a dictionary of value per label values"
+        if not self.function:
+            return
+        for key, value in sorted(self.function().items()):
+            yield '', key, (), value
+
+
+class Histogram(Metric):
+    'The distribution of durations in cumulative buckets'
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # The count of each bucket, the +Inf bucket and the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1)
+                counts.append(0.)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        "Observe the duration of the block"
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),),
+                    counts[:-1]):
+                cumulative += count
+                yield '_bucket', key, [('le', _format_value(
+                                float(bound)))], cumulative
+            yield '_count', key, (), cumulative
+            yield '_sum', key, (), counts[-1]
+
+
+class Registry(object):
+    'The metrics of the process'
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        "Return the metrics in the Prometheus text format"
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+
+registry = Registry()
+
+AMI_DURATION = registry.histogram('asterisk_ami_operation_seconds',
+    'Duration of the AMI operations.', ['operation', 'server'])
+AMI_ERRORS = registry.counter('asterisk_ami_errors_total',
+    'Number of AMI errors by category.', ['category', 'server'])
+AMI_EVENTS = registry.counter('asterisk_ami_events_total',
+    'Number of AMI events received.', ['event', 'server'])
+POOL_SESSIONS = registry.gauge('asterisk_ami_pool_sessions',
+    'Number of AMI sessions of the pool.', ['server', 'state'])
+DIAL_DURATION = registry.histogram('asterisk_dial_seconds',
+    'Duration of the click2dial requests.', ['strategy'])
+DIALS = registry.counter('asterisk_dials_total',
+    'Number of click2dial requests by result.', ['strategy', 'result'])
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_exporter(port, host=''):
+    "Serve the metrics over HTTP in a background thread"
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever,
+        name='asterisk-metrics', daemon=True).start()
+    return server
@@ -1,14 +1,271 @@
 #This file is part asterisk module for Tryton.
 #The COPYRIGHT file at the top level of this repository contains
 #the full copyright notices and license terms.
-from trytond.pool import PoolMeta
+from sql import Literal, Null
+from sql.conditionals import Case, Coalesce
+from sql.operators import Like, Or
 
-__all__ = ['Party']
+from trytond import backend
+from trytond.config import config
+from trytond.model import ModelView, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+
+__all__ = ['Party', 'ContactMechanism', 'PhoneBackfillStart',
+    'PhoneBackfill']
+
+PHONE_TYPES = {'phone', 'mobile', 'fax'}
+# Number of trailing digits compared to match numbers stored without the
+# country prefix
+SUFFIX_LENGTH = config.getint('asterisk', 'phone_suffix_length', default=9)
+# Number of calls shown on the party
+CALL_HISTORY = config.getint('asterisk', 'party_call_history', default=20)
 
 
 class Party(metaclass=PoolMeta):
     __name__ = 'party.party'
+    asterisk_last_call = fields.DateTime('Last call', readonly=True)
+    asterisk_call_count = fields.Integer('Calls', readonly=True,
+        help="The number of calls with the party including the calls "
+        "pruned from the history.")
+    asterisk_calls = fields.Function(fields.One2Many('asterisk.call', None,
+            'Latest calls'),
+        'get_asterisk_calls')
+
+    @classmethod
+    def get_asterisk_calls(cls, parties, name):
+        Call = Pool().get('asterisk.call')
+        # Each search reads the latest calls from the (party, start) index
+        return {p.id: [c.id for c in Call.search([
+                        ('party', '=', p.id),
+                        ], order=[('start', 'DESC'), ('id', 'DESC')],
+                    limit=CALL_HISTORY)]
+            for p in parties}
+
+    @classmethod
+    def copy(cls, parties, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('asterisk_last_call', None)
+        default.setdefault('asterisk_call_count', None)
+        return super(Party, cls).copy(parties, default=default)
+
+    @classmethod
+    def add_asterisk_calls(cls, calls):
+        "Add the calls to the summary of their party"
+        transaction = Transaction()
+        table = cls.__table__()
+        cursor = transaction.connection.cursor()
+        summaries = {}
+        for call in calls:
+            if not call.party:
+                continue
+            count, last = summaries.get(call.party.id, (0, call.start))
+            summaries[call.party.id] = (count + 1, max(last, call.start))
+        # The summary is updated in place so the concurrent imports add
+        # their calls without reading it
+        for party_id, (count, last) in summaries.items():
+            cursor.execute(*table.update(
+                    [table.asterisk_call_count, table.asterisk_last_call],
+                    [Coalesce(table.asterisk_call_count, 0) + count,
+                        Case((table.asterisk_last_call == Null, last),
+                            (table.asterisk_last_call < last, last),
+                            else_=table.asterisk_last_call)],
+                    where=table.id == party_id))
+        # Clean the transaction cache like write
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            if cls.__name__ in cache:
+                for party_id in summaries:
+                    cache[cls.__name__].pop(party_id, None)
 
     @property
     def display_name(self):
-        return self.trade_name or self.name or "UNKNOWN NAME"
+        # trade_name is added by an optional module
+        return (getattr(self, 'trade_name', None) or self.name
+            or "UNKNOWN NAME")
+
+    @classmethod
+    def search_by_phone(cls, number):
+        "Return the parties with the phone number, the best matches first"
+        ContactMechanism = Pool().get('party.contact_mechanism')
+        party_ids = ContactMechanism.match_numbers([number]).get(number, [])
+        return cls.browse(party_ids)
+
+
+class ContactMechanism(metaclass=PoolMeta):
+    __name__ = 'party.contact_mechanism'
+    asterisk_number = fields.Char('Asterisk number', readonly=True,
+        select=True,
+        help="The phone number in international format without '+'.")
+    asterisk_number_reversed = fields.Char('Asterisk number reversed',
+        readonly=True, select=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(ContactMechanism, cls).__register__(module_name)
+        if backend.name == 'postgresql':
+            # Allow LIKE 'prefix%' to use the index whatever the collation
+            cursor = Transaction().connection.cursor()
+            cursor.execute('CREATE INDEX IF NOT EXISTS '
+                '"party_contact_mechanism_asterisk_reversed_pattern" '
+                'ON "%s" ("asterisk_number_reversed" varchar_pattern_ops)'
+                % cls._table)
+
+    @classmethod
+    def _format_values(cls, mechanisms):
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        ast_server = ConfigurationCompany.get_company_configuration()
+        for mechanism in mechanisms:
+            number = mechanism.get_asterisk_number(ast_server)
+            if number != mechanism.asterisk_number:
+                mechanism.asterisk_number = number
+                mechanism.asterisk_number_reversed = (
+                    number[::-1] if number else None)
+        super(ContactMechanism, cls)._format_values(mechanisms)
+
+    def get_asterisk_number(self, ast_server):
+        Configuration = Pool().get('asterisk.configuration')
+        if self.type not in PHONE_TYPES:
+            return None
+        return Configuration.normalize_number(self.value, ast_server)
+
+    @classmethod
+    def backfill_asterisk_numbers(cls, mechanisms):
+        "Update the normalized numbers of the mechanisms in one query"
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ast_server = ConfigurationCompany.get_company_configuration()
+        numbers = {}
+        for sub_ids in grouped_slice([m.id for m in mechanisms]):
+            cursor.execute(*table.select(table.id, table.type, table.value,
+                    table.asterisk_number,
+                    where=table.id.in_(list(sub_ids))))
+            for id_, type_, value, current in cursor:
+                number = cls(type=type_, value=value).get_asterisk_number(
+                    ast_server)
+                if number != current:
+                    numbers[id_] = number
+        for sub_ids in grouped_slice(list(numbers)):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.update(
+                    [table.asterisk_number, table.asterisk_number_reversed],
+                    [Case(*((table.id == i, numbers[i]) for i in sub_ids)),
+                        Case(*((table.id == i,
+                                    numbers[i][::-1] if numbers[i] else None)
+                                for i in sub_ids))],
+                    where=table.id.in_(sub_ids)))
+
+    @classmethod
+    def match_numbers(cls, numbers, ast_server=None):
+        '''
+        Return a dictionary with the list of party ids for each number.
+
+        Numbers are matched exactly on their normalized form and, if not
+        found, on their last digits to find the numbers stored without the
+        country prefix.
+        '''
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if ast_server is None:
+            ast_server = ConfigurationCompany.get_company_configuration()
+        normalized = {}
+        for number in numbers:
+            value = Configuration.normalize_number(number, ast_server)
+            if value:
+                normalized.setdefault(value, []).append(number)
+
+        result = {}
+
+        def add(value, party_id):
+            for number in normalized.get(value, []):
+                parties = result.setdefault(number, [])
+                if party_id not in parties:
+                    parties.append(party_id)
+
+        for sub_values in grouped_slice(list(normalized)):
+            cursor.execute(*table.select(
+                    table.asterisk_number, table.party,
+                    where=table.asterisk_number.in_(list(sub_values))
+                    & (table.active == Literal(True)),
+                    order_by=[table.sequence.asc, table.id.asc]))
+            for value, party_id in cursor:
+                add(value, party_id)
+
+        suffixes = {}
+        for value in normalized:
+            if (normalized[value][0] not in result
+                    and len(value) >= SUFFIX_LENGTH):
+                suffixes.setdefault(
+                    value[::-1][:SUFFIX_LENGTH], []).append(value)
+        for sub_suffixes in grouped_slice(list(suffixes)):
+            sub_suffixes = list(sub_suffixes)
+            # Each LIKE can use the index on the reversed numbers
+            cursor.execute(*table.select(
+                    table.asterisk_number_reversed, table.party,
+                    where=Or([Like(table.asterisk_number_reversed, s + '%')
+                            for s in sub_suffixes])
+                    & (table.active == Literal(True)),
+                    order_by=[table.sequence.asc, table.id.asc]))
+            for reversed_number, party_id in cursor:
+                for value in suffixes.get(
+                        reversed_number[:SUFFIX_LENGTH], []):
+                    add(value, party_id)
+        return result
+
+
+class PhoneBackfillStart(ModelView):
+    'Phone Backfill Start'
+    __name__ = 'asterisk.phone.backfill.start'
+    batch_size = fields.Integer('Batch size', required=True,
+        help="Number of contact mechanisms processed at once.")
+
+    @staticmethod
+    def default_batch_size():
+        return 1000
+
+
+class PhoneBackfill(Wizard):
+    'Phone Backfill'
+    __name__ = 'asterisk.phone.backfill'
+    start = StateView('asterisk.phone.backfill.start',
+        'asterisk.phone_backfill_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Update', 'backfill', 'tryton-ok', default=True),
+            ])
+    backfill = StateTransition()
+
+    def transition_backfill(self):
+        pool = Pool()
+        ContactMechanism = pool.get('party.contact_mechanism')
+        table = ContactMechanism.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        # Each batch is updated by a queue task in its own transaction
+        last_id = 0
+        while True:
+            cursor.execute(*table.select(table.id,
+                    where=(table.id > last_id)
+                    & (table.type.in_(list(PHONE_TYPES))
+                        | (table.asterisk_number != Null)),
+                    order_by=table.id.asc,
+                    limit=self.start.batch_size))
+            ids = [i for i, in cursor]
+            if not ids:
+                break
+            with transaction.set_context(queue_name='asterisk'):
+                ContactMechanism.__queue__.backfill_asterisk_numbers(
+                    ContactMechanism.browse(ids))
+            last_id = ids[-1]
+        return 'end'
@@ -0,0 +1,176 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''
+State of the extensions of the Asterisk servers kept in memory.
+
+A tracker loads the state of all the hints with one ExtensionStateList when
+its dispatcher logs in and follows the ExtensionStatus and DeviceStateChange
+events after that, so the state of any number of extensions is read without
+asking the server.
+
+The trackers are started in the background so reading the presences never
+waits for an unreachable server.
+'''
+import logging
+import threading
+
+from . import ami
+
+__all__ = ['PRESENCES', 'ExtensionStates', 'tracker', 'trackers']
+
+logger = logging.getLogger(__name__)
+
+PRESENCES = [
+    (None, ''),
+    ('idle', 'Idle'),
+    ('ringing', 'Ringing'),
+    ('in_use', 'In use'),
+    ('on_hold', 'On hold'),
+    ('busy', 'Busy'),
+    ('unavailable', 'Unavailable'),
+    ]
+
+# The presence of the Status of the ExtensionStatus events
+EXTENSION_STATUS = {
+    '-2': 'unavailable',
+    '-1': 'unavailable',
+    '0': 'idle',
+    '1': 'in_use',
+    '2': 'busy',
+    '4': 'unavailable',
+    '8': 'ringing',
+    '9': 'in_use',
+    '16': 'on_hold',
+    '17': 'on_hold',
+    }
+# The presence of the State of the DeviceStateChange events
+DEVICE_STATE = {
+    'NOT_INUSE': 'idle',
+    'INUSE': 'in_use',
+    'BUSY': 'busy',
+    'INVALID': 'unavailable',
+    'UNAVAILABLE': 'unavailable',
+    'RINGING': 'ringing',
+    'RINGINUSE': 'in_use',
+    'ONHOLD': 'on_hold',
+    }
+# The presence shown for a user with several numbers
+PRIORITY = ['in_use', 'on_hold', 'ringing', 'busy', 'idle', 'unavailable']
+
+# Seconds the first lookup waits for the initial states
+SNAPSHOT_TIMEOUT = 1
+
+
+class ExtensionStates(object):
+    'The state of the extensions and devices of a server'
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.extensions = {}
+        self.devices = {}
+        self._loaded = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.dispatcher.subscribers.append(self._on_event)
+        self.dispatcher.on_connect.append(self._snapshot)
+        if self.dispatcher.connected:
+            self._snapshot(self.dispatcher)
+
+    def stop(self):
+        for callbacks, callback in [
+                (self.dispatcher.subscribers, self._on_event),
+                (self.dispatcher.on_connect, self._snapshot),
+                ]:
+            try:
+                callbacks.remove(callback)
+            except ValueError:
+                pass
+
+    @property
+    def alive(self):
+        return not self.dispatcher.stopped
+
+    def _snapshot(self, dispatcher):
+        # The ExtensionStatus events of the list are passed to the
+        # subscribers like the other events
+        dispatcher.write_action('ExtensionStateList')
+
+    def _on_event(self, message):
+        event = message.get('Event')
+        if event == 'ExtensionStatus':
+            with self._lock:
+                self.extensions[message.get('Exten')] = (
+                    EXTENSION_STATUS.get(message.get('Status')))
+        elif event == 'DeviceStateChange':
+            with self._lock:
+                self.devices[message.get('Device')] = (
+                    DEVICE_STATE.get(message.get('State')))
+        elif event == 'ExtensionStateListComplete':
+            self._loaded.set()
+
+    def wait_loaded(self, timeout=SNAPSHOT_TIMEOUT):
+        return self._loaded.wait(timeout)
+
+    def get(self, extensions):
+        '''
+        Return the presence of a phone with the extensions, a list of number
+        and channel. The state of the device of the channel is used for the
+        numbers without hint.
+        '''
+        presences = set()
+        with self._lock:
+            for number, channel in extensions:
+                presence = self.extensions.get(number)
+                if presence is None and channel:
+                    presence = self.devices.get(channel)
+                if presence:
+                    presences.add(presence)
+        for presence in PRIORITY:
+            if presence in presences:
+                return presence
+
+
+# The tracker of each configuration
+trackers = {}
+# The configurations whose tracker is being started
+starting = set()
+trackers_lock = threading.Lock()
+
+
+def _start(key, endpoints):
+    "Start the tracker of the configuration key once its states are loaded"
+    running = None
+    try:
+        dispatcher = ami.pool.failover_dispatcher(endpoints)
+        running = ExtensionStates(dispatcher)
+        running.start()
+        running.wait_loaded()
+    except ami.AMIError as e:
+        logger.warning('Unable to track the presences of %s: %s',
+            key, e)
+    finally:
+        with trackers_lock:
+            if running:
+                trackers[key] = running
+            starting.discard(key)
+
+
+def tracker(key, endpoints):
+    '''
+    Return the running tracker of the configuration key or None while it is
+    started in the background
+    '''
+    with trackers_lock:
+        running = trackers.get(key)
+        if running and running.alive:
+            return running
+        if running:
+            running.stop()
+            del trackers[key]
+        if key not in starting:
+            starting.add(key)
+            threading.Thread(target=_start, args=(key, endpoints),
+                name='asterisk-presence', daemon=True).start()
+    return None
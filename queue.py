@@ -0,0 +1,256 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import datetime
+
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+__all__ = ['QueueStat']
+
+# Minutes of the intervals of the statistics
+INTERVAL = config.getint('asterisk', 'queue_interval', default=15)
+# Seconds of waiting of the calls answered in the service level
+SERVICE_LEVEL = 20
+# The queue events of the Asterisk Manager Interface added to the statistics.
+# QueueCallerLeave is not needed as the callers leaving the queue are counted
+# by AgentConnect or QueueCallerAbandon.
+EVENTS = {'QueueCallerJoin', 'QueueCallerAbandon', 'AgentConnect',
+    'AgentComplete'}
+COUNTERS = ['calls', 'answered', 'abandoned', 'answered_in_time',
+    'wait_time', 'handle_time', 'completed']
+
+
+def interval_start(timestamp, interval=INTERVAL):
+    "Return the start of the interval of the timestamp"
+    minutes = timestamp.hour * 60 + timestamp.minute
+    minutes -= minutes % interval
+    return timestamp.replace(hour=minutes // 60, minute=minutes % 60,
+        second=0, microsecond=0)
+
+
+def _seconds(value):
+    try:
+        return max(int(value or 0), 0)
+    except ValueError:
+        return 0
+
+
+def _ratio(numerator, denominator):
+    if not denominator:
+        return None
+    return numerator / denominator
+
+
+class QueueStat(ModelSQL, ModelView):
+    'Asterisk Queue Statistic'
+    __name__ = 'asterisk.queue.stat'
+    configuration = fields.Many2One('asterisk.configuration.company',
+        'Configuration', required=True, readonly=True, ondelete='CASCADE')
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True)
+    queue = fields.Char('Queue', required=True, readonly=True, select=True)
+    agent = fields.Many2One('res.user', 'Agent', readonly=True, select=True,
+        help="The statistics of the whole queue if empty.")
+    start = fields.DateTime('Start', required=True, readonly=True,
+        select=True, help="The start of the interval.")
+    calls = fields.Integer('Calls', readonly=True,
+        help="The calls which joined the queue.")
+    answered = fields.Integer('Answered', readonly=True)
+    abandoned = fields.Integer('Abandoned', readonly=True)
+    answered_in_time = fields.Integer('Answered in service level',
+        readonly=True)
+    wait_time = fields.Integer('Wait time', readonly=True,
+        help="In seconds, the total of the answered and abandoned calls.")
+    max_wait_time = fields.Integer('Max. wait time', readonly=True,
+        help="In seconds.")
+    handle_time = fields.Integer('Handle time', readonly=True,
+        help="In seconds, the total of the completed calls.")
+    completed = fields.Integer('Completed', readonly=True)
+    average_wait_time = fields.Function(fields.Float('Average wait time',
+            digits=(16, 1), help="In seconds."),
+        'get_rates')
+    average_handle_time = fields.Function(fields.Float(
+            'Average handle time', digits=(16, 1), help="In seconds."),
+        'get_rates')
+    abandon_rate = fields.Function(fields.Float('Abandon rate',
+            digits=(16, 4)),
+        'get_rates')
+    service_level = fields.Function(fields.Float('Service level',
+            digits=(16, 4),
+            help="The rate of the calls answered in the service level of "
+            "the configuration."),
+        'get_rates')
+
+    @classmethod
+    def __setup__(cls):
+        super(QueueStat, cls).__setup__()
+        cls._order.insert(0, ('start', 'DESC'))
+        cls._order.insert(1, ('queue', 'ASC'))
+        cls.__rpc__.update({
+                'get_summary': RPC(readonly=True),
+                })
+
+    @staticmethod
+    def rates(values):
+        "Return the rates of a dictionary of counters"
+        offered = values['answered'] + values['abandoned']
+        return {
+            'average_wait_time': _ratio(values['wait_time'], offered),
+            'average_handle_time': _ratio(values['handle_time'],
+                values['completed']),
+            'abandon_rate': _ratio(values['abandoned'], values['calls']),
+            'service_level': _ratio(values['answered_in_time'], offered),
+            }
+
+    @classmethod
+    def get_rates(cls, stats, names):
+        result = {n: {} for n in names}
+        for stat in stats:
+            rates = cls.rates({n: getattr(stat, n) or 0 for n in COUNTERS})
+            for name in names:
+                result[name][stat.id] = rates[name]
+        return result
+
+    @staticmethod
+    def agent_extension(interface):
+        '''
+        Return the extension of a queue member interface like SIP/100 or
+        Local/100@from-queue/n
+        '''
+        if not interface or '/' not in interface:
+            return None
+        return interface.split('/', 1)[1].split('@', 1)[0].split('/', 1)[0]
+
+    @classmethod
+    def add_events(cls, configuration, values):
+        '''
+        Add the queue events received by the listener to the statistics of
+        their interval. Each value has the event, its timestamp, the queue,
+        the interface of the agent and the hold and talk times.
+        '''
+        pool = Pool()
+        User = pool.get('res.user')
+        transaction = Transaction()
+
+        extensions = User.extension_users(configuration.company.id)
+        service_level = configuration.queue_service_level or SERVICE_LEVEL
+        buckets = {}
+
+        def bucket(queue, agent, timestamp):
+            key = (queue, agent, interval_start(timestamp))
+            if key not in buckets:
+                buckets[key] = dict.fromkeys(COUNTERS + ['max_wait_time'], 0)
+            return buckets[key]
+
+        for value in values:
+            queue = value.get('queue')
+            event = value['event']
+            if not queue or event not in EVENTS:
+                continue
+            timestamp = value['timestamp']
+            counters = [bucket(queue, None, timestamp)]
+            if event in {'AgentConnect', 'AgentComplete'}:
+                agent = extensions.get(
+                    cls.agent_extension(value.get('interface')))
+                if agent:
+                    counters.append(bucket(queue, agent, timestamp))
+            hold_time = _seconds(value.get('hold_time'))
+            for counter in counters:
+                if event == 'QueueCallerJoin':
+                    counter['calls'] += 1
+                elif event in {'QueueCallerAbandon', 'AgentConnect'}:
+                    if event == 'AgentConnect':
+                        counter['answered'] += 1
+                        if hold_time <= service_level:
+                            counter['answered_in_time'] += 1
+                    else:
+                        counter['abandoned'] += 1
+                    counter['wait_time'] += hold_time
+                    counter['max_wait_time'] = max(
+                        counter['max_wait_time'], hold_time)
+                elif event == 'AgentComplete':
+                    counter['completed'] += 1
+                    counter['handle_time'] += _seconds(
+                        value.get('talk_time'))
+        if not buckets:
+            return []
+
+        # The listeners of the servers of a configuration may add to the
+        # same intervals
+        transaction.database.lock(transaction.connection, cls._table)
+        existing = {}
+        for stat in cls.search([
+                    ('configuration', '=', configuration.id),
+                    ('queue', 'in', list({k[0] for k in buckets})),
+                    ('start', 'in', list({k[2] for k in buckets})),
+                    ]):
+            existing[(stat.queue, stat.agent.id if stat.agent else None,
+                    stat.start)] = stat
+        stats, to_write, to_create = [], [], []
+        for key, counters in buckets.items():
+            stat = existing.get(key)
+            if stat:
+                values = {n: (getattr(stat, n) or 0) + counters[n]
+                    for n in COUNTERS}
+                values['max_wait_time'] = max(stat.max_wait_time or 0,
+                    counters['max_wait_time'])
+                to_write.extend(([stat], values))
+                stats.append(stat)
+            else:
+                queue, agent, start = key
+                values = counters.copy()
+                values.update({
+                        'configuration': configuration.id,
+                        'company': configuration.company.id,
+                        'queue': queue,
+                        'agent': agent,
+                        'start': start,
+                        })
+                to_create.append(values)
+        if to_write:
+            cls.write(*to_write)
+        if to_create:
+            stats.extend(cls.create(to_create))
+        return stats
+
+    @classmethod
+    def summary(cls, stats):
+        '''
+        Return the counters and the rates of the statistics added by queue
+        and agent
+        '''
+        result = {}
+        for stat in stats:
+            key = (stat.queue, stat.agent.id if stat.agent else None)
+            values = result.setdefault(key, dict.fromkeys(
+                    COUNTERS + ['max_wait_time'], 0))
+            for name in COUNTERS:
+                values[name] += getattr(stat, name) or 0
+            values['max_wait_time'] = max(values['max_wait_time'],
+                stat.max_wait_time or 0)
+        for values in result.values():
+            values.update(cls.rates(values))
+        return result
+
+    @classmethod
+    def get_summary(cls, domain):
+        "Return the summary of each queue and agent of the statistics"
+        return [{'queue': q, 'agent': a, **v}
+            for (q, a), v in cls.summary(cls.search(domain)).items()]
+
+
+def queue_values(message, timestamp=None):
+    "Return the values of a queue event used by QueueStat.add_events"
+    return {
+        'event': message['Event'],
+        'timestamp': timestamp or datetime.datetime.utcnow(),
+        'queue': message.get('Queue'),
+        'uniqueid': message.get('Uniqueid'),
+        'interface': message.get('Interface') or message.get('MemberName'),
+        'hold_time': message.get('HoldTime'),
+        'talk_time': message.get('TalkTime'),
+        }
@@ -0,0 +1,331 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import datetime
+import logging
+import mimetypes
+import mmap
+import os
+import re
+import shutil
+import subprocess
+import time
+import wave
+
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, Unique, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['Recording', 'Cron']
+
+logger = logging.getLogger(__name__)
+
+# Extensions of the files written by MixMonitor
+EXTENSIONS = {'.wav', '.wav49', '.gsm', '.ogg', '.mp3', '.sln'}
+# The Asterisk unique id in the file names like out-100-1614592800.1.wav
+UNIQUEID = re.compile(r'(\d{9,}\.\d+)')
+# Seconds without modification before a recording is indexed as it may still
+# be written by MixMonitor
+SETTLE_TIME = 10
+# Seconds before the watermark from which the directories are scanned again
+# as they may contain recordings longer than that
+DIRECTORY_MARGIN = 24 * 60 * 60
+# Bytes read from the memory map at once
+CHUNK_SIZE = 64 * 1024
+FFMPEG = config.get('asterisk', 'ffmpeg', default='ffmpeg')
+TRANSCODE_TIMEOUT = 600
+FORMATS = [
+    (None, ''),
+    ('ogg', 'Ogg Vorbis'),
+    ('mp3', 'MP3'),
+    ]
+
+
+def chunks(path, start=0, stop=None, size=CHUNK_SIZE):
+    '''
+    Yield the content of the file from start to stop by chunks read from a
+    memory map, so the file is never loaded whole in memory.
+    '''
+    with open(path, 'rb') as file:
+        length = os.fstat(file.fileno()).st_size
+        stop = length if stop is None else min(stop, length)
+        if start >= stop:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset in range(start, stop, size):
+                yield data[offset:min(offset + size, stop)]
+
+
+def _scan_directory(path, since):
+    '''
+    Yield the entries of the files under path skipping the leaf directories
+    not modified since the timestamp. The other directories are always
+    scanned as creating a file in a subdirectory does not change their
+    modification time.
+    '''
+    try:
+        entries = list(os.scandir(path))
+    except OSError as e:
+        logger.warning('Unable to scan the recordings of %s: %s', path, e)
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                # A directory without subdirectory has 2 links on most
+                # filesystems
+                if stat.st_nlink != 2 or stat.st_mtime >= since:
+                    yield from _scan_directory(entry.path, since)
+            elif (entry.is_file()
+                    and os.path.splitext(entry.name)[1].lower()
+                    in EXTENSIONS):
+                yield entry
+        except OSError:
+            # The file has been removed meanwhile
+            continue
+
+
+def _duration(path):
+    "Return the duration in seconds of a WAV file from its header"
+    try:
+        with wave.open(path, 'rb') as audio:
+            return audio.getnframes() / audio.getframerate()
+    except (wave.Error, EOFError, OSError, ZeroDivisionError):
+        return None
+
+
+class Recording(ModelSQL, ModelView):
+    'Asterisk Recording'
+    __name__ = 'asterisk.recording'
+    configuration = fields.Many2One('asterisk.configuration.company',
+        'Configuration', required=True, readonly=True, ondelete='CASCADE')
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True)
+    name = fields.Char('Name', required=True, readonly=True)
+    path = fields.Char('Path', required=True, readonly=True)
+    inode = fields.BigInteger('Inode', readonly=True)
+    size = fields.BigInteger('Size', readonly=True, help="In bytes.")
+    modified = fields.DateTime('Modified', readonly=True, select=True)
+    duration = fields.Float('Duration', digits=(16, 1), readonly=True,
+        help="In seconds.")
+    format = fields.Char('Format', readonly=True)
+    uniqueid = fields.Char('Unique ID', readonly=True, select=True)
+    cdr = fields.Many2One('asterisk.cdr', 'Call Detail Record',
+        readonly=True, ondelete='SET NULL', select=True)
+    user = fields.Many2One('res.user', 'User', readonly=True, select=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True,
+        select=True,
+        context={
+            'company': Eval('company'),
+            },
+        depends=['company'])
+
+    @classmethod
+    def __setup__(cls):
+        super(Recording, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('path_uniq', Unique(t, t.configuration, t.path),
+                'The recording is already indexed.'),
+            ]
+        cls._order.insert(0, ('modified', 'DESC'))
+
+    @property
+    def mimetype(self):
+        return mimetypes.guess_type(self.path)[0] or 'application/octet-stream'
+
+    def read_chunk(self, offset=0, size=CHUNK_SIZE):
+        "Return size bytes of the audio from offset"
+        return b''.join(chunks(self.path, offset, offset + size))
+
+    @classmethod
+    def values_from_file(cls, configuration, path, stat):
+        name = os.path.basename(path)
+        match = UNIQUEID.search(name)
+        format_ = os.path.splitext(name)[1][1:].lower()
+        return {
+            'configuration': configuration.id,
+            'company': configuration.company.id,
+            'name': name,
+            'path': path,
+            'inode': stat.st_ino,
+            'size': stat.st_size,
+            'modified': datetime.datetime.utcfromtimestamp(stat.st_mtime),
+            'duration': _duration(path) if format_ == 'wav' else None,
+            'format': format_,
+            'uniqueid': match.group(1) if match else None,
+            }
+
+    @classmethod
+    def scan(cls, configuration, batch_size=1000, settle_time=SETTLE_TIME,
+            commit=False):
+        '''
+        Index the recordings of the directory of the configuration modified
+        after the mtime and inode watermark of the previous scan.
+        '''
+        pool = Pool()
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        path = configuration.recording_path
+        if not path or not os.path.isdir(path):
+            return 0
+        watermark = (configuration.recording_mtime or 0,
+            configuration.recording_inode or 0)
+        settled = time.time() - settle_time
+        files = []
+        for entry in _scan_directory(path, watermark[0] - DIRECTORY_MARGIN):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            key = (stat.st_mtime, stat.st_ino)
+            # The watermark must not pass the recordings still written
+            if watermark < key and stat.st_mtime <= settled:
+                files.append((key, entry.path, stat))
+        files.sort()
+
+        count = 0
+        for sub_files in grouped_slice(files, batch_size):
+            sub_files = list(sub_files)
+            existing = {r.path: r for r in cls.search([
+                        ('configuration', '=', configuration.id),
+                        ('path', 'in', [f[1] for f in sub_files]),
+                        ])}
+            to_create, to_write = [], []
+            for key, file_path, stat in sub_files:
+                values = cls.values_from_file(configuration, file_path, stat)
+                if file_path in existing:
+                    to_write.extend(([existing[file_path]], {
+                                n: values[n] for n in ['inode', 'size',
+                                    'modified', 'duration']}))
+                else:
+                    to_create.append(values)
+            if to_write:
+                cls.write(*to_write)
+            if to_create:
+                cls.link_cdrs(cls.create(to_create))
+            count += len(to_create)
+            mtime, inode = sub_files[-1][0]
+            ConfigurationCompany.write([configuration], {
+                    'recording_mtime': mtime,
+                    'recording_inode': inode,
+                    })
+            if commit:
+                Transaction().commit()
+        logger.info('Indexed %s recordings from %s', count, path)
+        return count
+
+    @classmethod
+    def link_cdrs(cls, recordings=None, cdrs=None):
+        '''
+        Link the recordings to the CDR with their unique id and to the user
+        and party of the CDR.
+        If recordings is None, the recordings without CDR of the cdrs are
+        searched.
+        '''
+        Cdr = Pool().get('asterisk.cdr')
+        if recordings is None:
+            uniqueids = {c.uniqueid for c in cdrs if c.uniqueid}
+            if not uniqueids:
+                return
+            recordings = cls.search([
+                    ('cdr', '=', None),
+                    ('uniqueid', 'in', list(uniqueids)),
+                    ])
+        recordings = [r for r in recordings if r.uniqueid]
+        if not recordings:
+            return
+        if cdrs is None:
+            cdrs = Cdr.search([
+                    ('uniqueid', 'in', list({r.uniqueid for r in recordings})),
+                    ])
+        cdrs = {(c.configuration.id, c.uniqueid): c for c in cdrs}
+        to_write = []
+        for recording in recordings:
+            cdr = cdrs.get((recording.configuration.id, recording.uniqueid))
+            if cdr:
+                to_write.extend(([recording], {
+                            'cdr': cdr.id,
+                            'user': cdr.user.id if cdr.user else None,
+                            'party': cdr.party.id if cdr.party else None,
+                            }))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def scan_recordings(cls):
+        "Index the recordings of all the configurations"
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        for configuration in ConfigurationCompany.search([
+                    ('recording_path', '!=', None),
+                    ]):
+            cls.scan(configuration, commit=True)
+
+    @classmethod
+    def transcode(cls, recordings, format_, commit=False):
+        '''
+        Convert the recordings to the format with ffmpeg.
+        The original files are removed only when the new path is committed.
+        '''
+        ffmpeg = shutil.which(FFMPEG)
+        if not ffmpeg:
+            logger.warning('Unable to transcode the recordings: '
+                '%s not found', FFMPEG)
+            return []
+        result = []
+        for recording in recordings:
+            source = recording.path
+            target = '%s.%s' % (os.path.splitext(source)[0], format_)
+            try:
+                subprocess.run([ffmpeg, '-nostdin', '-loglevel', 'error',
+                        '-y', '-i', source, target],
+                    check=True, timeout=TRANSCODE_TIMEOUT,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                stat = os.stat(target)
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning('Unable to transcode %s: %s', source, e)
+                if os.path.exists(target):
+                    os.remove(target)
+                continue
+            cls.write([recording], {
+                    'name': os.path.basename(target),
+                    'path': target,
+                    'inode': stat.st_ino,
+                    'size': stat.st_size,
+                    'format': format_,
+                    })
+            result.append(recording)
+            if commit:
+                Transaction().commit()
+                os.remove(source)
+        return result
+
+    @classmethod
+    def transcode_recordings(cls, batch_size=100):
+        "Transcode the recordings to the format of their configuration"
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        for configuration in ConfigurationCompany.search([
+                    ('recording_format', '!=', None),
+                    ]):
+            recordings = cls.search([
+                    ('configuration', '=', configuration.id),
+                    ('format', '!=', configuration.recording_format),
+                    ], order=[('modified', 'ASC')], limit=batch_size)
+            cls.transcode(recordings, configuration.recording_format,
+                commit=True)
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('asterisk.recording|scan_recordings',
+                    "Scan Asterisk Recordings"),
+                ('asterisk.recording|transcode_recordings',
+                    "Transcode Asterisk Recordings"),
+                ])
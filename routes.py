@@ -0,0 +1,68 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+from http import HTTPStatus
+
+from werkzeug.exceptions import abort
+
+from trytond.protocols.wrappers import (Response, with_pool,
+    with_transaction)
+from trytond.transaction import Transaction
+from trytond.wsgi import app
+
+from .recording import chunks
+
+# Maximum bytes sent for a range request so the players ask the next ones
+MAX_RANGE = 1024 * 1024
+
+
+@app.route('/<database_name>/asterisk/recording/<int:recording_id>',
+    methods={'GET', 'HEAD'})
+@with_pool
+@with_transaction(user='request')
+def recording(request, pool, recording_id):
+    '''
+    Serve the audio of the recording supporting range requests so it is
+    played while it is downloaded.
+    '''
+    ModelAccess = pool.get('ir.model.access')
+    Recording = pool.get('asterisk.recording')
+    if not Transaction().user:
+        abort(HTTPStatus.UNAUTHORIZED)
+    if not ModelAccess.check(Recording.__name__, 'read', raise_exception=False):
+        abort(HTTPStatus.FORBIDDEN)
+    # The rules are applied only when checking the access
+    with Transaction().set_context(_check_access=True):
+        recordings = Recording.search([('id', '=', recording_id)])
+        if not recordings:
+            abort(HTTPStatus.NOT_FOUND)
+        recording, = recordings
+        path = recording.path
+        mimetype = recording.mimetype
+    try:
+        with open(path, 'rb') as file:
+            length = file.seek(0, 2)
+    except OSError:
+        abort(HTTPStatus.NOT_FOUND)
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Type': mimetype,
+        }
+    start, stop, status = 0, length, HTTPStatus.OK
+    if request.range:
+        range_ = request.range.range_for_length(length)
+        if range_ is None:
+            headers['Content-Range'] = 'bytes */%s' % length
+            return Response(status=HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers=headers)
+        start, stop = range_
+        stop = min(stop, start + MAX_RANGE)
+        status = HTTPStatus.PARTIAL_CONTENT
+        headers['Content-Range'] = 'bytes %s-%s/%s' % (
+            start, stop - 1, length)
+    headers['Content-Length'] = str(stop - start)
+    if request.method == 'HEAD':
+        return Response(status=status, headers=headers)
+    return Response(chunks(path, start, stop), status=status,
+        headers=headers, direct_passthrough=True)
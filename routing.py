@@ -0,0 +1,183 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import uuid
+
+from trytond.cache import Cache
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model import ModelView, ModelSQL, Unique, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+
+__all__ = ['RouteRule']
+
+# The route table of each configuration with the token of its cache
+_tables = {}
+
+
+class RouteTable(object):
+    '''
+    The route rules of a configuration compiled in a trie of the prefixes
+    and a dictionary of the exact numbers.
+    A route is a tuple of the action, the out prefix and if it is exact. The
+    out prefix is None to use the one of the configuration.
+    '''
+    __slots__ = ('root', 'numbers')
+
+    def __init__(self, rules=()):
+        self.root = {}
+        self.numbers = {}
+        for kind, prefix, action, out_prefix in rules:
+            if kind == 'number':
+                self.numbers[prefix] = (action, out_prefix, True)
+            else:
+                node = self.root
+                for digit in prefix:
+                    node = node.setdefault(digit, {})
+                node[None] = (action, out_prefix, False)
+
+    def match(self, number):
+        "Return the route of the longest prefix of the number or None"
+        route = None
+        node = self.root
+        for digit in number:
+            node = node.get(digit)
+            if node is None:
+                break
+            route = node.get(None, route)
+        return route
+
+    def lookup(self, number, international):
+        '''
+        Return the route of the number as dialed or of the longest prefix of
+        its international format
+        '''
+        route = self.numbers.get(number)
+        if route is None and international:
+            route = self.match(international)
+        return route
+
+
+class RouteRule(ModelSQL, ModelView):
+    'Asterisk Route Rule'
+    __name__ = 'asterisk.route.rule'
+    configuration = fields.Many2One('asterisk.configuration.company',
+        'Configuration', required=True, ondelete='CASCADE', select=True)
+    name = fields.Char('Name', required=True)
+    kind = fields.Selection([
+            ('prefix', 'Prefix'),
+            ('number', 'Number'),
+            ], 'Match', required=True,
+        help="Prefix: the numbers starting with the prefix in international "
+        "format, the longest prefix is used.\n"
+        "Number: the number as dialed, like the emergency or short numbers.")
+    prefix = fields.Char('Prefix', required=True,
+        help="The digits in international format without '+', e.g. '34' "
+        "or '3491', or the number as dialed, e.g. '112'.")
+    action = fields.Selection([
+            ('route', 'Route'),
+            ('block', 'Block'),
+            ], 'Action', required=True)
+    no_out_prefix = fields.Boolean('No out prefix',
+        states={
+            'invisible': Eval('action') != 'route',
+            },
+        depends=['action'],
+        help="Dial the numbers without any out prefix.")
+    out_prefix = fields.Char('Out prefix',
+        states={
+            'invisible': (Eval('action') != 'route')
+            | Eval('no_out_prefix', False),
+            },
+        depends=['action', 'no_out_prefix'],
+        help="Prefix to dial instead of the out prefix of the configuration "
+        "to use the trunk of the route. Leave empty to use the out prefix "
+        "of the configuration.")
+    _table_cache = Cache('asterisk.route.rule.table', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(RouteRule, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('prefix_uniq', Unique(t, t.configuration, t.kind, t.prefix),
+                'There is already a route rule for this prefix.'),
+            ]
+        cls._order.insert(0, ('prefix', 'ASC'))
+
+    @staticmethod
+    def default_configuration():
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        values = ConfigurationCompany.get_company_values()
+        if values:
+            return values['id']
+
+    @staticmethod
+    def default_kind():
+        return 'prefix'
+
+    @staticmethod
+    def default_action():
+        return 'route'
+
+    @staticmethod
+    def default_no_out_prefix():
+        return False
+
+    @property
+    def route_out_prefix(self):
+        "The out prefix of the route or None to use the one of the server"
+        if self.no_out_prefix:
+            return ''
+        return self.out_prefix or None
+
+    @classmethod
+    def validate(cls, rules):
+        super(RouteRule, cls).validate(rules)
+        for rule in rules:
+            rule.check_digits()
+
+    def check_digits(self):
+        if (not self.prefix.isdigit()
+                or (self.out_prefix and not self.out_prefix.isdigit())):
+            raise UserError(gettext('asterisk.route_rule_digits',
+                    rule=self.rec_name))
+
+    @classmethod
+    def get_table(cls, configuration_id):
+        '''
+        Return the route table of the configuration.
+        The table is shared by the transactions so it must not be modified.
+        It is compiled again when a rule is modified in any process.
+        '''
+        key = (Transaction().database.name, configuration_id)
+        token = cls._table_cache.get(configuration_id)
+        cached = _tables.get(key)
+        if token is not None and cached and cached[0] == token:
+            return cached[1]
+        table = RouteTable((r.kind, r.prefix, r.action, r.route_out_prefix)
+            for r in cls.search([
+                    ('configuration', '=', configuration_id),
+                    ]))
+        token = uuid.uuid4().hex
+        cls._table_cache.set(configuration_id, token)
+        _tables[key] = (token, table)
+        return table
+
+    @classmethod
+    def create(cls, vlist):
+        rules = super(RouteRule, cls).create(vlist)
+        cls._table_cache.clear()
+        return rules
+
+    @classmethod
+    def write(cls, *args):
+        super(RouteRule, cls).write(*args)
+        cls._table_cache.clear()
+
+    @classmethod
+    def delete(cls, rules):
+        super(RouteRule, cls).delete(rules)
+        cls._table_cache.clear()
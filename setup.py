@@ -89,12 +89,17 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         ],
     license='GPL-3',
     install_requires=requires,
+    extras_require={
+        'ari': ['aiohttp'],
+        },
     dependency_links=dependency_links,
     zip_safe=False,
     entry_points="""
     [trytond.modules]
     %s = trytond.modules.%s
-    """ % (MODULE, MODULE),
+    [console_scripts]
+    trytond-asterisk-listener = trytond.modules.%s.listener:main
+    """ % (MODULE, MODULE, MODULE),
     test_suite='tests',
     test_loader='trytond.test_loader:Loader',
     tests_require=tests_require,
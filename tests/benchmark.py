@@ -0,0 +1,270 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Benchmarks of the click2dial and event hot paths against the fake AMI server.
+
+    python -m trytond.modules.asterisk.tests.benchmark --output result.json
+
+The results are written as JSON so they can be compared between revisions:
+the originate latency percentiles, the originates per second for each number
+of concurrent users, the numbers reformatted per second without and with
+route rules and the AMI events ingested per second by the listener.
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+from trytond.modules.asterisk import ami
+from trytond.modules.asterisk.asterisk import NumberRules
+from trytond.modules.asterisk.listener import AsyncAMIClient, EventListener
+from trytond.modules.asterisk.routing import RouteTable
+from .fake_ami import FakeAMIServer
+
+__all__ = ['run', 'main']
+
+ORIGINATE = [
+    ('Channel', 'SIP/100'),
+    ('Timeout', 30000),
+    ('CallerId', 'Benchmark'),
+    ('Exten', '600100200'),
+    ('Context', 'from-internal'),
+    ('Priority', 1),
+    ]
+NUMBERS = ['+33 1 41 98 12 42', '+34 (600) 10-02-00', '01.41.98.12.42',
+    '0141981242', '01 41 98 12 4X']
+
+
+def summary(latencies):
+    "Return the mean and the percentiles in milliseconds of the latencies"
+    if not latencies:
+        return {}
+    values = sorted(latencies)
+    result = {'mean_ms': sum(values) / len(values) * 1000}
+    for point in (50, 90, 99):
+        index = min(len(values) - 1, int(len(values) * point / 100))
+        result['p%s_ms' % point] = values[index] * 1000
+    result['max_ms'] = values[-1] * 1000
+    return result
+
+
+class ServerThread(object):
+    'Run a fake AMI server in the event loop of a thread'
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+
+    def __enter__(self):
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            FakeAMIServer(**self.kwargs).start(), self.loop).result(5)
+        return self.server
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(
+            self.server.stop(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def _originates(pool, endpoint, count, latencies, errors):
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            with pool.failover_session([endpoint]) as session:
+                response = session.originate(ORIGINATE)
+        except ami.AMIError:
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - start)
+        if not response.success:
+            errors.append(1)
+
+
+def bench_originate(port, count, users=1, pool_size=ami.POOL_SIZE):
+    '''
+    Originate count calls per user from concurrent threads through the
+    session pool like the sequential click2dial.
+    '''
+    pool = ami.AMIPool(size=pool_size, health_interval=3600)
+    endpoint = ami.AMIEndpoint(('benchmark', users), '127.0.0.1', port,
+        'tryton', 'secret')
+    latencies, errors = [], []
+    # Warm up the pool like a running server
+    _originates(pool, endpoint, 1, [], [])
+    threads = [threading.Thread(target=_originates,
+            args=(pool, endpoint, count, latencies, errors))
+        for _ in range(users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    pool.invalidate(('benchmark',))
+    result = {
+        'users': users,
+        'originates': count * users,
+        'errors': len(errors),
+        'seconds': elapsed,
+        'originates_per_second': count * users / elapsed,
+        }
+    result.update(summary(latencies))
+    return result
+
+
+def bench_reformat(count, routes=0):
+    "Reformat count numbers in one batch with a table of route rules"
+    rules = NumberRules.get(SimpleNamespace(country_prefix='33',
+            national_prefix='0', international_prefix='00', out_prefix='',
+            national_format_allowed=True))
+    table = RouteTable(('prefix', '%s%s' % (33 + i % 60, i), 'route',
+            str(i % 10)) for i in range(routes)) if routes else None
+    numbers = (NUMBERS * (count // len(NUMBERS) + 1))[:count]
+    start = time.perf_counter()
+    result = [rules.reformat(n, table) for n in numbers]
+    elapsed = time.perf_counter() - start
+    return {
+        'numbers': count,
+        'routes': routes,
+        'errors': sum(1 for _, e in result if e),
+        'seconds': elapsed,
+        'numbers_per_second': count / elapsed,
+        }
+
+
+def bench_events(count):
+    "Send count call events to the listener and measure its ingest rate"
+
+    class Listener(EventListener):
+        received = 0
+
+        def on_event(self, message):
+            super(Listener, self).on_event(message)
+            self.received += 1
+            if self.received >= count:
+                self.done.set()
+
+        def store(self, values, cdrs=None, queue_events=None):
+            pass
+
+        def load_extensions(self):
+            return {}
+
+    async def run():
+        server = await FakeAMIServer().start()
+        client = AsyncAMIClient('127.0.0.1', server.port, 'tryton',
+            'secret')
+        listener = Listener('benchmark', 1, 1, client, batch_size=count + 1,
+            flush_interval=3600)
+        listener.done = asyncio.Event()
+        task = asyncio.ensure_future(listener.run())
+        await asyncio.wait_for(client.connected.wait(), 5)
+        # Let the listener load the channels
+        await asyncio.sleep(0.1)
+        start = time.perf_counter()
+        for i in range(count // 2):
+            uniqueid = '1.%s' % i
+            server.emit('Newchannel', Uniqueid=uniqueid,
+                Channel='SIP/100-%08x' % i, ChannelStateDesc='Ring',
+                CallerIDNum='600100200', Exten='100',
+                Context='from-internal')
+            server.emit('Hangup', Uniqueid=uniqueid,
+                Channel='SIP/100-%08x' % i, Cause='16')
+            if not i % 100:
+                await asyncio.sleep(0)
+        await asyncio.wait_for(listener.done.wait(), 60)
+        elapsed = time.perf_counter() - start
+        client.stop()
+        task.cancel()
+        await server.stop()
+        return {
+            'events': listener.received,
+            'buffered': len(listener.buffer),
+            'seconds': elapsed,
+            'events_per_second': listener.received / elapsed,
+            }
+
+    count -= count % 2
+    return asyncio.run(run())
+
+
+def run(originates=200, users=(1, 4, 16), numbers=100000, routes=10000,
+        events=20000, latency=0, jitter=0, failure_rate=0, seed=None,
+        pool_size=ami.POOL_SIZE):
+    "Run all the benchmarks and return their results"
+    parameters = dict(originates=originates, users=list(users),
+        numbers=numbers, routes=routes, events=events, latency=latency,
+        jitter=jitter, failure_rate=failure_rate, seed=seed,
+        pool_size=pool_size)
+    results = {}
+    with ServerThread(latency=latency, jitter=jitter,
+            failure_rate=failure_rate, seed=seed) as server:
+        results['originate'] = bench_originate(server.port, originates,
+            pool_size=pool_size)
+        results['concurrency'] = [
+            bench_originate(server.port, originates // n or 1, users=n,
+                pool_size=pool_size)
+            for n in users]
+    results['reformat'] = bench_reformat(numbers)
+    results['reformat_routes'] = bench_reformat(numbers, routes)
+    results['events'] = bench_events(events)
+    return {
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'results': results,
+        }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--originates', type=int, default=200,
+        help="number of originates of the latency benchmark")
+    parser.add_argument('--users', default='1,4,16',
+        help="comma separated numbers of concurrent users")
+    parser.add_argument('--numbers', type=int, default=100000,
+        help="number of phone numbers to reformat")
+    parser.add_argument('--routes', type=int, default=10000,
+        help="number of route rules used to reformat the numbers")
+    parser.add_argument('--events', type=int, default=20000,
+        help="number of events sent to the listener")
+    parser.add_argument('--latency', type=float, default=0,
+        help="seconds the fake server waits before each response")
+    parser.add_argument('--jitter', type=float, default=0,
+        help="maximum random seconds added to the latency")
+    parser.add_argument('--failure-rate', dest='failure_rate', type=float,
+        default=0, help="rate of actions failing on the fake server")
+    parser.add_argument('--seed', type=int,
+        help="seed of the random latencies and failures")
+    parser.add_argument('--pool-size', dest='pool_size', type=int,
+        default=ami.POOL_SIZE, help="number of idle AMI sessions kept")
+    parser.add_argument('--output', '-o',
+        help="file to write the JSON results, the standard output if empty")
+    options = parser.parse_args(args)
+
+    result = run(originates=options.originates,
+        users=[int(u) for u in options.users.split(',') if u],
+        numbers=options.numbers, routes=options.routes,
+        events=options.events,
+        latency=options.latency, jitter=options.jitter,
+        failure_rate=options.failure_rate, seed=options.seed,
+        pool_size=options.pool_size)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(result, output, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
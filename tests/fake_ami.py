@@ -0,0 +1,206 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Fake Asterisk Manager Interface server to test the AMI clients.
+'''
+import asyncio
+import functools
+import random
+
+from trytond.modules.asterisk.ami import AMIParser
+
+
+class FakeAMIServer(object):
+    '''
+    asyncio server answering the AMI actions used by the module.
+
+    Each action but the login is answered after latency seconds plus a random
+    delay up to jitter seconds, and fails with an Error response with a
+    probability of failure_rate.
+    '''
+    banner = 'Asterisk Call Manager/5.0.1'
+
+    def __init__(self, login='tryton', password='secret', latency=0,
+            jitter=0, failure_rate=0, seed=None):
+        self.login = login
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self.channels = {}
+        self.actions = []
+        # The Reason of the OriginateResponse of each dialed channel
+        self.originate_reasons = {}
+        # The seconds before each dialed channel answers
+        self.answer_delays = {}
+        # The Status of the hint of each extension
+        self.extension_states = {}
+        self._sequence = 0
+        self.port = None
+        self._server = None
+        self._writers = set()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.disconnect()
+        self._server.close()
+        await self._server.wait_closed()
+
+    def disconnect(self):
+        for writer in list(self._writers):
+            writer.close()
+        self._writers.clear()
+
+    @property
+    def clients(self):
+        return len(self._writers)
+
+    def emit(self, event, **values):
+        "Send the event to all the connected clients"
+        values = dict(Event=event, **values)
+        for writer in self._writers:
+            self._send(writer, values)
+
+    @staticmethod
+    def _send(writer, values):
+        frame = ''.join('%s: %s\r\n' % i for i in values.items()) + '\r\n'
+        writer.write(frame.encode('utf-8'))
+
+    async def _handle(self, reader, writer):
+        writer.write(('%s\r\n' % self.banner).encode('utf-8'))
+        parser = AMIParser()
+        parser.banner = ''
+        logged = False
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for action in parser.feed(data):
+                    self.actions.append(action)
+                    name = action.get('Action', '').lower()
+                    if name == 'login':
+                        logged = (action.get('Username') == self.login
+                            and action.get('Secret') == self.password)
+                        if logged:
+                            self._writers.add(writer)
+                    elif not logged:
+                        self._respond(writer, action, 'Error',
+                            Message='Permission denied')
+                        continue
+                    else:
+                        delay = self.latency + self._random.uniform(
+                            0, self.jitter)
+                        if delay:
+                            await asyncio.sleep(delay)
+                        if self._random.random() < self.failure_rate:
+                            self._respond(writer, action, 'Error',
+                                Message='Simulated failure')
+                            continue
+                    method = getattr(self, 'action_%s' % name, None)
+                    if method:
+                        method(writer, action)
+                    else:
+                        self._respond(writer, action, 'Success')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def _respond(self, writer, action, response, **values):
+        self._send(writer, dict(Response=response,
+                ActionID=action.get('ActionID', ''), **values))
+
+    def action_login(self, writer, action):
+        if writer in self._writers:
+            self._respond(writer, action, 'Success',
+                Message='Authentication accepted')
+        else:
+            self._respond(writer, action, 'Error',
+                Message='Authentication failed')
+
+    def action_ping(self, writer, action):
+        self._respond(writer, action, 'Success', Ping='Pong')
+
+    def action_coreshowchannels(self, writer, action):
+        self._respond(writer, action, 'Success', EventList='start')
+        for uniqueid, channel in self.channels.items():
+            self._send(writer, dict(Event='CoreShowChannel',
+                    ActionID=action.get('ActionID', ''), Uniqueid=uniqueid,
+                    Channel=channel))
+        self._send(writer, dict(Event='CoreShowChannelsComplete',
+                ActionID=action.get('ActionID', ''), EventList='Complete',
+                ListItems=len(self.channels)))
+
+    def action_extensionstatelist(self, writer, action):
+        self._respond(writer, action, 'Success', EventList='start')
+        for exten, status in self.extension_states.items():
+            self._send(writer, dict(Event='ExtensionStatus',
+                    ActionID=action.get('ActionID', ''), Exten=exten,
+                    Context='ext-local', Hint='SIP/%s' % exten,
+                    Status=status))
+        self._send(writer, dict(Event='ExtensionStateListComplete',
+                ActionID=action.get('ActionID', ''), EventList='Complete',
+                ListItems=len(self.extension_states)))
+
+    def set_extension_state(self, exten, status):
+        self.extension_states[exten] = status
+        self.emit('ExtensionStatus', Exten=exten, Context='ext-local',
+            Hint='SIP/%s' % exten, Status=status)
+
+    def action_originate(self, writer, action):
+        reason = self.originate_reasons.get(action.get('Channel'), '4')
+        if action.get('Async', '').lower() != 'true':
+            # The synchronous originate answers once the channel is up
+            if reason == '4':
+                respond = functools.partial(self._respond, writer, action,
+                    'Success', Message='Originate successfully queued')
+            else:
+                respond = functools.partial(self._respond, writer, action,
+                    'Error', Message='Originate failed')
+            asyncio.get_event_loop().call_later(
+                self.answer_delays.get(action.get('Channel'), 0), respond)
+            return
+        self._respond(writer, action, 'Success',
+            Message='Originate successfully queued')
+        uniqueid = action.get('ChannelId', '')
+        if uniqueid:
+            self._sequence += 1
+            # The technology and the peer of the dial string
+            peer = '/'.join(action.get('Channel', '').split('/')[:2])
+            name = '%s-%08x' % (peer, self._sequence)
+            self.emit('Newchannel', Uniqueid=uniqueid, Channel=name)
+            self.channels[uniqueid] = name
+
+        def respond():
+            result = reason
+            if uniqueid and uniqueid not in self.channels:
+                # Hung up while ringing
+                result = '1'
+            elif result != '4':
+                self.channels.pop(uniqueid, None)
+            self._send(writer, dict(Event='OriginateResponse',
+                    ActionID=action.get('ActionID', ''),
+                    Response='Success' if result == '4' else 'Failure',
+                    Channel=action.get('Channel'), Reason=result,
+                    Uniqueid=uniqueid))
+        asyncio.get_event_loop().call_later(
+            self.answer_delays.get(action.get('Channel'), 0), respond)
+
+    def action_hangup(self, writer, action):
+        for uniqueid, name in list(self.channels.items()):
+            if name == action.get('Channel'):
+                del self.channels[uniqueid]
+                self._respond(writer, action, 'Success',
+                    Message='Channel Hungup')
+                self.emit('Hangup', Uniqueid=uniqueid, Channel=name,
+                    Cause='16')
+                return
+        self._respond(writer, action, 'Error', Message='No such channel')
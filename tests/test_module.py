@@ -1,14 +1,1956 @@
 
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import asyncio
+import datetime
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import wave
+from unittest import mock
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from sql import Null
+
+from trytond.modules.company.tests import (CompanyTestMixin, create_company,
+    set_company)
+from trytond.exceptions import UserError
+from trytond.model.exceptions import AccessError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 
 
 class AsteriskTestCase(CompanyTestMixin, ModuleTestCase):
     'Test Asterisk module'
     module = 'asterisk'
 
+    def test_ami_parser(self):
+        'Test AMI parser'
+        from trytond.modules.asterisk.ami import AMIParser
+
+        parser = AMIParser()
+        self.assertEqual(parser.feed(b'Asterisk Call Manager/5.0'), [])
+        self.assertEqual(parser.feed(b'.1\r\nResponse: Success\r\nAction'),
+            [])
+        self.assertEqual(parser.banner, 'Asterisk Call Manager/5.0.1')
+        messages = parser.feed(b'ID: 1-1\r\nMessage: Authentication '
+            b'accepted\r\n\r\nEvent: FullyBooted\r\n\r\n')
+        self.assertEqual(len(messages), 2)
+        response, event = messages
+        self.assertTrue(response.is_response)
+        self.assertTrue(response.success)
+        self.assertEqual(response['ActionID'], '1-1')
+        self.assertTrue(event.is_event)
+        self.assertEqual(event['Event'], 'FullyBooted')
+
+    def test_event_listener(self):
+        'Test event listener against fake AMI server'
+        from trytond.modules.asterisk.listener import (AsyncAMIClient,
+            EventListener)
+        from .fake_ami import FakeAMIServer
+
+        stored = []
+        rings = []
+        published = []
+
+        class Listener(EventListener):
+            def store(self, values, cdrs=None, queue_events=None):
+                stored.extend(values)
+
+            def load_extensions(self):
+                return {'100': 10}
+
+            def notify(self, values):
+                rings.extend(values)
+
+            def publish(self, changes, snapshot, reset=False):
+                published.append((changes, snapshot, reset))
+
+        async def run():
+            server = await FakeAMIServer().start()
+            server.channels['1.2'] = 'SIP/200-00000002'
+            client = AsyncAMIClient('127.0.0.1', server.port, 'tryton',
+                'secret', max_backoff=0.1)
+            listener = Listener('db', 1, 1, client, flush_interval=0.05,
+                wallboard_interval=0.05)
+            task = asyncio.ensure_future(listener.run())
+            await asyncio.wait_for(client.connected.wait(), 5)
+            await asyncio.sleep(0.1)
+            server.emit('Newchannel', Uniqueid='1.1', Channel='SIP/100-1',
+                ChannelStateDesc='Ring', CallerIDNum='600100200')
+            server.emit('Newstate', Uniqueid='1.1', ChannelState='5',
+                ChannelStateDesc='Ringing', ConnectedLineNum='600100200')
+            server.emit('Newstate', Uniqueid='1.1', ChannelStateDesc='Up')
+            await asyncio.sleep(0.1)
+            self.assertEqual([(r['user'], r['number']) for r in rings],
+                [(10, '600100200')])
+            self.assertEqual(set(listener.channels), {'1.1', '1.2'})
+            self.assertEqual(listener.channels['1.1'].state, 'Up')
+            self.assertTrue(published[0][2])
+            agent = published[-1][1]['agents'][10]
+            self.assertEqual((agent['state'], agent['number']),
+                ('talking', '600100200'))
+
+            # Channels hung up while disconnected are closed on reconnection
+            del server.channels['1.2']
+            server.disconnect()
+            await asyncio.sleep(0.2)
+            await asyncio.wait_for(client.connected.wait(), 5)
+            server.emit('Hangup', Uniqueid='1.1', Channel='SIP/100-1')
+            await asyncio.sleep(0.2)
+            self.assertEqual(listener.channels, {})
+            self.assertEqual(published[-1][0], {'agents': {10: None}})
+            self.assertEqual(published[-1][1], {'agents': {}, 'queues': {}})
+
+            client.stop()
+            task.cancel()
+            await server.stop()
+
+        asyncio.run(run())
+        self.assertEqual([v['event'] for v in stored],
+            ['Newchannel', 'Newstate', 'Newstate', 'Hangup', 'Hangup'])
+
+    @with_transaction()
+    def test_search_by_phone(self):
+        'Test search party by phone'
+        pool = Pool()
+        Party = pool.get('party.party')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+
+        company = create_company()
+        with set_company(company):
+            ConfigurationCompany.create([{
+                        'company': company.id,
+                        'country_prefix': '33',
+                        'national_prefix': '0',
+                        'international_prefix': '00',
+                        }])
+            party1, party2 = Party.create([{
+                        'name': 'Party 1',
+                        'contact_mechanisms': [('create', [{
+                                        'type': 'phone',
+                                        'value': '01 41 98 12 42',
+                                        }])],
+                        }, {
+                        'name': 'Party 2',
+                        'contact_mechanisms': [('create', [{
+                                        'type': 'mobile',
+                                        'value': '+34 (600) 10-02-00',
+                                        }])],
+                        }])
+            mechanism, = party1.contact_mechanisms
+            self.assertEqual(mechanism.asterisk_number, '33141981242')
+            self.assertEqual(mechanism.asterisk_number_reversed,
+                '24218914133')
+
+            self.assertEqual(Party.search_by_phone('+33141981242'), [party1])
+            self.assertEqual(Party.search_by_phone('0033 1 41 98 12 42'),
+                [party1])
+            self.assertEqual(Party.search_by_phone('0034600100200'),
+                [party2])
+            # Match on the last digits
+            self.assertEqual(Party.search_by_phone('+1 600100200'), [party2])
+            self.assertEqual(Party.search_by_phone('0141981243'), [])
+
+    @with_transaction()
+    def test_configuration_cache(self):
+        'Test company configuration cache'
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+
+        company = create_company()
+        with set_company(company):
+            self.assertIsNone(
+                ConfigurationCompany.get_company_configuration())
+            conf, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'ip_address': 'pbx.example.com',
+                        'port': 5038,
+                        }])
+
+            ast_server = ConfigurationCompany.get_company_configuration()
+            self.assertEqual(ast_server.id, conf.id)
+            self.assertEqual(ast_server.ip_address, 'pbx.example.com')
+            self.assertEqual(ast_server.port, 5038)
+
+            ConfigurationCompany.write([conf], {'port': 5039})
+            self.assertEqual(
+                Configuration.get_fields([Configuration(1)],
+                    ['port', 'ip_address']), {
+                    'port': {1: 5039},
+                    'ip_address': {1: 'pbx.example.com'},
+                    })
+
+    @with_transaction()
+    def test_reformat_numbers(self):
+        'Test reformat numbers'
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+
+        ast_server = ConfigurationCompany(country_prefix='33',
+            national_prefix='0', international_prefix='00', out_prefix='9',
+            national_format_allowed=True)
+        self.assertEqual(
+            Configuration.reformat_number('+33 1 41 98 12 42', ast_server),
+            '90141981242')
+        result = Configuration.reformat_numbers([
+                '+33 1 41 98 12 42',
+                '+34 (600) 10-02-00',
+                '01.41.98.12.42',
+                '01 41 98 12 4X',
+                '',
+                ], ast_server)
+        self.assertEqual([n for n, _ in result], [
+                '90141981242', '90034600100200', '90141981242', None, None])
+        self.assertEqual([bool(e) for _, e in result],
+            [False, False, False, True, True])
+
+        ast_server.national_format_allowed = False
+        (number, error), = Configuration.reformat_numbers(['0141981242'],
+            ast_server)
+        self.assertIsNone(number)
+        self.assertTrue(error)
+
+    @with_transaction()
+    def test_import_cdr(self):
+        'Test import CDR file'
+        pool = Pool()
+        Cdr = pool.get('asterisk.cdr')
+        Party = pool.get('party.party')
+        User = pool.get('res.user')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+
+        company = create_company()
+        with set_company(company):
+            user, = User.create([{
+                        'name': 'Agent',
+                        'login': 'agent',
+                        'internal_number': '100, 101',
+                        }])
+            party, = Party.create([{
+                        'name': 'Customer',
+                        'contact_mechanisms': [('create', [{
+                                        'type': 'phone',
+                                        'value': '+34 600 100 200',
+                                        }])],
+                        }])
+            fd, path = tempfile.mkstemp(suffix='.csv')
+            self.addCleanup(os.remove, path)
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'country_prefix': '34',
+                        'international_prefix': '00',
+                        'cdr_path': path,
+                        }])
+            outgoing = ('"","101","600100200","from-internal",'
+                '"""Agent"" <101>","SIP/101-00000001","SIP/trunk-00000002",'
+                '"Dial","SIP/trunk/600100200","2021-03-01 10:00:00",'
+                '"2021-03-01 10:00:05","2021-03-01 10:01:05",65,60,'
+                '"ANSWERED","DOCUMENTATION","1614592800.1",""\n')
+            incoming = ('"","600100200","100","from-trunk","",'
+                '"SIP/trunk-00000003","SIP/100-00000004","Dial","SIP/100",'
+                '"2021-03-01 11:00:00","","2021-03-01 11:00:20",20,0,'
+                '"NO ANSWER","DOCUMENTATION","1614596400.3",""\n')
+            with os.fdopen(fd, 'w') as file:
+                file.write(outgoing)
+                # A line being written is imported by the next run
+                file.write(incoming[:20])
+
+            self.assertEqual(Cdr.import_file(configuration), 1)
+            with open(path, 'a') as file:
+                file.write(incoming[20:])
+            configuration = ConfigurationCompany(configuration.id)
+            self.assertEqual(Cdr.import_file(configuration, batch_size=1), 1)
+            configuration = ConfigurationCompany(configuration.id)
+            self.assertEqual(Cdr.import_file(configuration), 0)
+
+            cdr1, cdr2 = Cdr.search([], order=[('start', 'ASC')])
+            self.assertEqual(cdr1.user, user)
+            self.assertEqual(cdr1.party, party)
+            self.assertEqual(cdr1.billsec, 60)
+            self.assertEqual(cdr1.disposition, 'ANSWERED')
+            self.assertEqual(cdr2.user, user)
+            self.assertEqual(cdr2.party, party)
+            self.assertIsNone(cdr2.answer)
+
+    def test_token_bucket(self):
+        'Test token bucket'
+        from trytond.modules.asterisk.dialer import TokenBucket
+
+        now = [0]
+        bucket = TokenBucket(2, capacity=2, clock=lambda: now[0])
+        self.assertEqual(bucket.consume(), 0)
+        self.assertEqual(bucket.consume(), 0)
+        self.assertEqual(bucket.consume(), 0.5)
+        now[0] = 0.5
+        self.assertEqual(bucket.consume(), 0)
+        now[0] = 10
+        self.assertEqual(bucket.consume(2), 0)
+
+    def test_pacer(self):
+        'Test pacer'
+        from trytond.modules.asterisk.dialer import Pacer
+
+        pacer = Pacer(max_abandon_rate=0.1, min_samples=10)
+        self.assertEqual(pacer.lines(2, 0), 2)
+        for _ in range(5):
+            pacer.record('answered')
+            pacer.record('failed')
+        # Half the calls are answered
+        self.assertEqual(pacer.ratio, 2)
+        self.assertEqual(pacer.lines(2, 1), 3)
+        for _ in range(5):
+            pacer.record('abandoned')
+            pacer.record('failed')
+        self.assertEqual(pacer.abandon_rate, 0.5)
+        self.assertLess(pacer.ratio, 1.5)
+
+    def test_campaign_dialer(self):
+        'Test campaign dialer against fake AMI server'
+        from trytond.modules.asterisk.ami import AMIDispatcher
+        from trytond.modules.asterisk.dialer import Dialer
+        from .fake_ami import FakeAMIServer
+
+        class Store(object):
+            pending = ['600100001', '600100002', '600100003']
+            results = {}
+
+            def campaigns(self):
+                return [{
+                        'id': 1,
+                        'trunk': 'SIP/trunk',
+                        'context': 'from-internal',
+                        'calls_per_second': 100,
+                        'agents': {10: '100'},
+                        }]
+
+            def claim(self, campaign, count):
+                lines = self.pending[:count]
+                del self.pending[:count]
+                return [(n, n) for n in lines]
+
+            def record(self, results):
+                for line, values in results:
+                    self.results.setdefault(line, {}).update(values)
+
+        def wait(condition):
+            end = time.time() + 5
+            while not condition() and time.time() < end:
+                time.sleep(0.01)
+            self.assertTrue(condition())
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = asyncio.run_coroutine_threadsafe(
+            FakeAMIServer().start(), loop).result(5)
+        server.originate_reasons['SIP/trunk/600100002'] = '5'
+        dispatcher = AMIDispatcher(('127.0.0.1', server.port, 'tryton',
+                'secret'), max_backoff=0.1)
+        dispatcher.start()
+        store = Store()
+        dialer = Dialer(dispatcher, store)
+        dispatcher.subscribers.append(dialer._track)
+        try:
+            dialer.step()
+            wait(lambda: not dialer.ringing)
+            # The only agent is busy
+            dialer.step()
+            dialer.flush()
+            self.assertEqual(store.results, {
+                    '600100001': {
+                        'state': 'answered', 'agent': 10, 'reason': None},
+                    })
+            wait(lambda: any(a['Action'] == 'Redirect'
+                    for a in server.actions))
+            redirect, = [a for a in server.actions
+                if a['Action'] == 'Redirect']
+            self.assertEqual(redirect['Exten'], '100')
+            self.assertTrue(redirect['Channel'].startswith('SIP/trunk-'))
+
+            # The agent is free when the customer hangs up
+            dispatcher.write_action('Hangup', [
+                    ('Channel', redirect['Channel'])])
+            wait(lambda: not dialer.calls)
+            dialer.step()
+            wait(lambda: not dialer.ringing)
+            dialer.step()
+            wait(lambda: not dialer.ringing)
+            dialer.flush()
+            self.assertEqual(store.results['600100002']['state'], 'failed')
+            self.assertEqual(store.results['600100002']['reason'], 'Busy')
+            self.assertEqual(store.results['600100003']['state'], 'answered')
+        finally:
+            dispatcher.stop()
+            asyncio.run_coroutine_threadsafe(server.stop(), loop).result(5)
+            loop.call_soon_threadsafe(loop.stop)
+
+    @with_transaction()
+    def test_campaign(self):
+        'Test campaign'
+        pool = Pool()
+        Campaign = pool.get('asterisk.campaign')
+        Line = pool.get('asterisk.campaign.line')
+        Party = pool.get('party.party')
+        User = pool.get('res.user')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+
+        company = create_company()
+        with set_company(company):
+            ConfigurationCompany.create([{
+                        'company': company.id,
+                        'country_prefix': '34',
+                        }])
+            agent, = User.create([{
+                        'name': 'Agent',
+                        'login': 'agent',
+                        }])
+            campaign, = Campaign.create([{
+                        'name': 'Campaign',
+                        'trunk': 'SIP/trunk',
+                        'agents': [('add', [agent.id])],
+                        }])
+            party, = Party.create([{
+                        'name': 'Customer',
+                        'contact_mechanisms': [('create', [{
+                                        'type': 'mobile',
+                                        'value': '+34 600 100 200',
+                                        }])],
+                        }])
+            line = Line(campaign=campaign, party=party)
+            line.on_change_party()
+            self.assertEqual(line.number, '+34 600 100 200')
+            line.save()
+
+            with self.assertRaises(UserError):
+                Campaign.run([campaign])
+            agent.internal_number = '100'
+            agent.save()
+            Campaign.run([campaign])
+            self.assertEqual(campaign.state, 'running')
+
+    def test_failover(self):
+        'Test failover between AMI servers'
+        import socket
+        from trytond.modules.asterisk.ami import AMIEndpoint, AMIPool
+        from .fake_ami import FakeAMIServer
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = asyncio.run_coroutine_threadsafe(
+            FakeAMIServer().start(), loop).result(5)
+        # A port without server
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        closed_port = sock.getsockname()[1]
+        sock.close()
+
+        down = AMIEndpoint(('db', 1), '127.0.0.1', closed_port, 'tryton',
+            'secret', priority=1)
+        up = AMIEndpoint(('db', 1, 2), '127.0.0.1', server.port, 'tryton',
+            'secret', priority=2)
+        slow = AMIEndpoint(('db', 1, 3), '127.0.0.1', server.port, 'tryton',
+            'secret', priority=2, weight=2)
+        pool = AMIPool(health_interval=3600)
+        try:
+            self.assertEqual(pool.select([up, down]), [down, up])
+            with pool.failover_session([up, down]) as session:
+                self.assertTrue(session.ping())
+            self.assertFalse(pool.health(down.key).available)
+            self.assertEqual(pool.select([down, up]), [up, down])
+
+            pool.health(up.key).latency = 0.01
+            pool.health(slow.key).latency = 0.03
+            # The latency is divided by the weight
+            self.assertEqual(pool.select([slow, up]), [up, slow])
+            pool.check(up)
+            self.assertTrue(pool.health(up.key).available)
+
+            dispatcher = pool.failover_dispatcher([down, up])
+            self.assertEqual(dispatcher.params[1], server.port)
+
+            # Invalidating a configuration discards all its servers
+            pool.invalidate(('db', 1))
+            self.assertTrue(pool.health(down.key).available)
+            self.assertTrue(dispatcher._stopped)
+        finally:
+            asyncio.run_coroutine_threadsafe(server.stop(), loop).result(5)
+            loop.call_soon_threadsafe(loop.stop)
+
+    @with_transaction()
+    def test_configuration_endpoints(self):
+        'Test configuration endpoints'
+        pool = Pool()
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        Server = pool.get('asterisk.configuration.server')
+
+        company = create_company()
+        with set_company(company):
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'ip_address': 'pbx1.example.com',
+                        'port': 5038,
+                        'login': 'tryton',
+                        'password': 'secret',
+                        }])
+            server, = Server.create([{
+                        'ip_address': 'pbx2.example.com',
+                        'priority': 20,
+                        'weight': 2,
+                        }])
+            self.assertEqual(server.configuration, configuration)
+
+            ast_server = ConfigurationCompany.get_company_configuration()
+            primary, other = ast_server.get_endpoints()
+            self.assertEqual(primary.params,
+                ('pbx1.example.com', 5038, 'tryton', 'secret'))
+            self.assertEqual(other.params,
+                ('pbx2.example.com', 5038, 'tryton', 'secret'))
+            self.assertEqual(other.weight, 2)
+            self.assertEqual(other.key[1:], (configuration.id, server.id))
+
+            Server.write([server], {'login': 'backup'})
+            primary, other = ast_server.get_endpoints()
+            self.assertEqual(other.login, 'backup')
+
+    def test_metrics(self):
+        'Test metrics'
+        from trytond.modules.asterisk import metrics
+        from trytond.modules.asterisk.ami import AMIEndpoint, AMIPool
+        from .fake_ami import FakeAMIServer
+
+        registry = metrics.Registry()
+        counter = registry.counter('calls_total', 'Calls.', ['result'])
+        histogram = registry.histogram('call_seconds', 'Calls.', [],
+            buckets=[0.1, 1])
+        counter.inc(result='success')
+        counter.inc(2, result='success')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(registry.render().splitlines(), [
+                '# HELP calls_total Calls.',
+                '# TYPE calls_total counter',
+                'calls_total{result="success"} 3',
+                '# HELP call_seconds Calls.',
+                '# TYPE call_seconds histogram',
+                'call_seconds_bucket{le="0.1"} 1',
+                'call_seconds_bucket{le="1"} 2',
+                'call_seconds_bucket{le="+Inf"} 3',
+                'call_seconds_count 3',
+                'call_seconds_sum 5.55',
+                ])
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = asyncio.run_coroutine_threadsafe(
+            FakeAMIServer().start(), loop).result(5)
+        name = '127.0.0.1:%s' % server.port
+        endpoint = AMIEndpoint(('db', 1), '127.0.0.1', server.port, 'tryton',
+            'secret')
+        wrong = AMIEndpoint(('db', 2), '127.0.0.1', server.port, 'tryton',
+            'wrong')
+        pool = AMIPool(health_interval=3600)
+        try:
+            with pool.failover_session([endpoint]) as session:
+                self.assertTrue(session.ping())
+                self.assertEqual(pool.occupancy()[(name, 'in_use')], 1)
+            self.assertEqual(pool.occupancy()[(name, 'idle')], 1)
+            self.assertEqual(metrics.AMI_DURATION.count(
+                    operation='ping', server=name), 1)
+            self.assertEqual(metrics.AMI_DURATION.count(
+                    operation='login', server=name), 1)
+            with self.assertRaises(Exception):
+                with pool.failover_session([wrong]):
+                    pass
+            self.assertEqual(metrics.AMI_ERRORS.value(
+                    category='authentication', server=name), 1)
+        finally:
+            pool.invalidate(('db',))
+            asyncio.run_coroutine_threadsafe(server.stop(), loop).result(5)
+            loop.call_soon_threadsafe(loop.stop)
+
+    def test_resolver(self):
+        'Test DNS resolver cache'
+        import socket
+        from trytond.modules.asterisk.ami import AMIResolver, AMIResolveError
+
+        now = [0]
+        calls = []
+        answers = {'pbx.example.com': '192.0.2.1'}
+
+        def getaddrinfo(host, port, family, type_):
+            calls.append(host)
+            if host not in answers:
+                raise socket.gaierror('Name or service not known')
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                    (answers[host], port))]
+
+        resolver = AMIResolver(ttl=60, negative_ttl=5,
+            getaddrinfo=getaddrinfo, clock=lambda: now[0])
+
+        def address():
+            return resolver.resolve('pbx.example.com', 5038)[0][4][0]
+
+        self.assertEqual(address(), '192.0.2.1')
+        self.assertEqual(address(), '192.0.2.1')
+        self.assertEqual(calls, ['pbx.example.com'])
+
+        # The expired addresses are used while they are resolved again
+        answers['pbx.example.com'] = '192.0.2.2'
+        now[0] = 61
+        self.assertEqual(address(), '192.0.2.1')
+        for _ in range(100):
+            if address() == '192.0.2.2':
+                break
+            time.sleep(0.01)
+        self.assertEqual(address(), '192.0.2.2')
+
+        # The last known addresses are kept when the resolver fails
+        del answers['pbx.example.com']
+        resolver.refresh('pbx.example.com', 5038)
+        self.assertEqual(address(), '192.0.2.2')
+
+        # The failures are cached
+        with self.assertRaises(AMIResolveError):
+            resolver.resolve('unknown.example.com', 5038)
+        with self.assertRaises(AMIResolveError):
+            resolver.resolve('unknown.example.com', 5038)
+        self.assertEqual(calls.count('unknown.example.com'), 1)
+        now[0] += 6
+        answers['unknown.example.com'] = '192.0.2.3'
+        self.assertEqual(
+            resolver.resolve('unknown.example.com', 5038)[0][4][0],
+            '192.0.2.3')
+
+    @with_transaction()
+    def test_presence(self):
+        'Test presence of the users'
+        from trytond.modules.asterisk import ami, presence
+        from .fake_ami import FakeAMIServer
+        pool = Pool()
+        User = pool.get('res.user')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = asyncio.run_coroutine_threadsafe(
+            FakeAMIServer().start(), loop).result(5)
+        server.extension_states.update({'100': '1', '101': '0'})
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        self.addCleanup(lambda: asyncio.run_coroutine_threadsafe(
+                server.stop(), loop).result(5))
+
+        company = create_company()
+        with set_company(company):
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'ip_address': '127.0.0.1',
+                        'port': server.port,
+                        'login': 'tryton',
+                        'password': 'secret',
+                        }])
+            self.addCleanup(presence.trackers.clear)
+            self.addCleanup(ami.pool.invalidate,
+                (Transaction().database.name, configuration.id))
+            user1, user2, user3 = User.create([{
+                        'name': 'Agent 1',
+                        'login': 'agent1',
+                        'internal_number': '100',
+                        'asterisk_chan_type': 'SIP',
+                        }, {
+                        'name': 'Agent 2',
+                        'login': 'agent2',
+                        'internal_number': '101, 102',
+                        'asterisk_chan_type': 'SIP',
+                        }, {
+                        'name': 'Agent 3',
+                        'login': 'agent3',
+                        }])
+
+            # The presences are unknown until the tracker is started
+            expected = {
+                user1.id: 'in_use',
+                user2.id: 'idle',
+                user3.id: None,
+                }
+            end = time.time() + 5
+            while (User.get_presences([user1.id, user2.id, user3.id])
+                    != expected and time.time() < end):
+                time.sleep(0.01)
+            self.assertEqual(User.get_presences(
+                    [user1.id, user2.id, user3.id]), expected)
+
+            # The events update the states without asking the server
+            actions = len(server.actions)
+            loop.call_soon_threadsafe(server.set_extension_state, '100', '0')
+            loop.call_soon_threadsafe(lambda: server.emit(
+                    'DeviceStateChange', Device='SIP/102', State='RINGING'))
+            end = time.time() + 5
+            while (User.get_presences([user1.id, user2.id])
+                    != {user1.id: 'idle', user2.id: 'ringing'}
+                    and time.time() < end):
+                time.sleep(0.01)
+            self.assertEqual(User(user1.id).asterisk_presence, 'idle')
+            self.assertEqual(User(user2.id).asterisk_presence, 'ringing')
+            self.assertEqual(len(server.actions), actions)
+
+    @with_transaction()
+    def test_dial(self):
+        'Test click2dial against fake AMI server'
+        from trytond.modules.asterisk import ami
+        from trytond.modules.asterisk.asterisk import DIAL_MANY_SYNC_LIMIT
+        from .fake_ami import FakeAMIServer
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        Party = pool.get('party.party')
+        User = pool.get('res.user')
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = asyncio.run_coroutine_threadsafe(
+            FakeAMIServer().start(), loop).result(5)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        self.addCleanup(lambda: asyncio.run_coroutine_threadsafe(
+                server.stop(), loop).result(5))
+
+        company = create_company()
+        with set_company(company):
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'ip_address': '127.0.0.1',
+                        'port': server.port,
+                        'login': 'tryton',
+                        'password': 'secret',
+                        'context': 'from-internal',
+                        'wait_time': 15,
+                        'extension_priority': 1,
+                        'country_prefix': '34',
+                        'international_prefix': '00',
+                        }])
+            self.addCleanup(ami.pool.invalidate,
+                (Transaction().database.name, configuration.id))
+            user, = User.create([{
+                        'name': 'Agent',
+                        'login': 'agent',
+                        'internal_number': '100, 101',
+                        'asterisk_chan_type': 'SIP',
+                        'company': company.id,
+                        'companies': [('add', [company.id])],
+                        }])
+            party, = Party.create([{'name': 'Customer'}])
+
+            # The first number is busy
+            server.originate_reasons['SIP/100'] = '5'
+            with Transaction().set_user(user.id):
+                Configuration.dial(party, '+34 600 100 200')
+            originates = [a for a in server.actions
+                if a['Action'] == 'Originate']
+            self.assertEqual([a['Exten'] for a in originates],
+                ['600100200', '600100200'])
+            self.assertEqual([a['Channel'] for a in originates],
+                ['SIP/100', 'SIP/101'])
+
+            with Transaction().set_user(user.id):
+                with self.assertRaises(UserError):
+                    Configuration.dial(party, '')
+
+            # The originates of many numbers are sent at once
+            del server.originate_reasons['SIP/100']
+            del server.actions[:]
+            with Transaction().set_user(user.id):
+                results = Configuration.dial_many([
+                        (party.id, '+34 600 100 200'),
+                        (party, ''),
+                        (None, '+34 600 100 201'),
+                        ])
+            self.assertEqual([r['dialed_number'] for r in results],
+                ['600100200', None, '600100201'])
+            self.assertEqual([r['success'] for r in results],
+                [True, None, True])
+            self.assertEqual([bool(r['error']) for r in results],
+                [False, True, False])
+            self.assertEqual([a['Exten'] for a in server.actions
+                    if a['Action'] == 'Originate'],
+                ['600100200', '600100201'])
+
+            # Without asynchronous originates only a few numbers are dialed
+            with Transaction().set_user(user.id):
+                with self.assertRaises(UserError):
+                    Configuration.dial_many([(party, '+34 600 100 200')]
+                        * (DIAL_MANY_SYNC_LIMIT + 1))
+
+            dispatcher = ami.pool.failover_dispatcher(
+                configuration.get_endpoints())
+            responses = dispatcher.send_actions([
+                    ('Ping', None, None),
+                    ('Originate', [('Channel', 'SIP/100')], None),
+                    ])
+            self.assertEqual([r.success for r in responses], [True, True])
+
+    def test_benchmark(self):
+        'Test benchmark suite'
+        from .benchmark import run
+
+        result = run(originates=20, users=[1, 2], numbers=100, routes=1000,
+            events=100, latency=0.001, jitter=0.001, failure_rate=0.1, seed=1)
+        results = result['results']
+        self.assertEqual(results['originate']['originates'], 20)
+        self.assertGreater(results['originate']['errors'], 0)
+        self.assertLess(results['originate']['errors'], 20)
+        self.assertGreaterEqual(results['originate']['p99_ms'],
+            results['originate']['p50_ms'])
+        self.assertEqual([r['users'] for r in results['concurrency']],
+            [1, 2])
+        self.assertEqual(results['reformat']['numbers'], 100)
+        self.assertEqual(results['reformat_routes']['routes'], 1000)
+        self.assertEqual(results['events']['events'], 100)
+
+    @with_transaction()
+    def test_incoming_call_messages(self):
+        'Test incoming call messages'
+        pool = Pool()
+        Party = pool.get('party.party')
+        User = pool.get('res.user')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+
+        company = create_company()
+        with set_company(company):
+            ConfigurationCompany.create([{
+                        'company': company.id,
+                        'country_prefix': '34',
+                        'international_prefix': '00',
+                        }])
+            party, = Party.create([{
+                        'name': 'Customer',
+                        'contact_mechanisms': [('create', [{
+                                        'type': 'phone',
+                                        'value': '+34 600 100 200',
+                                        }])],
+                        }])
+            (channel1, message1), (channel2, message2) = (
+                User.incoming_call_messages([{
+                            'user': 10,
+                            'number': '600100200',
+                            }, {
+                            'user': 11,
+                            'number': '600999999',
+                            'name': 'Unknown',
+                            }]))
+            self.assertEqual(channel1, 'user:10')
+            self.assertEqual(message1['asterisk_call']['party'], party.id)
+            self.assertEqual(message1['asterisk_call']['party_name'],
+                'Customer')
+            self.assertIn('Customer', message1['title'])
+            self.assertEqual(channel2, 'user:11')
+            self.assertIsNone(message2['asterisk_call']['party'])
+            self.assertIn('Unknown', message2['title'])
+
+    @with_transaction()
+    def test_queue_stat(self):
+        'Test queue statistics'
+        pool = Pool()
+        QueueStat = pool.get('asterisk.queue.stat')
+        User = pool.get('res.user')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        from trytond.modules.asterisk.queue import queue_values
+
+        company = create_company()
+        with set_company(company):
+            user, = User.create([{
+                        'name': 'Agent',
+                        'login': 'agent',
+                        'internal_number': '100',
+                        }])
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'queue_service_level': 20,
+                        }])
+
+            def events(minute, *messages):
+                timestamp = datetime.datetime(2020, 1, 1, 10, minute, 30)
+                return [queue_values(dict(m, Queue='sales'), timestamp)
+                    for m in messages]
+
+            QueueStat.add_events(configuration, events(1,
+                    {'Event': 'QueueCallerJoin'},
+                    {'Event': 'QueueCallerJoin'},
+                    {'Event': 'AgentConnect', 'Interface': 'SIP/100',
+                        'HoldTime': '10'},
+                    ))
+            # The next batch is added to the same interval
+            QueueStat.add_events(configuration, events(14,
+                    {'Event': 'QueueCallerAbandon', 'HoldTime': '30'},
+                    {'Event': 'AgentComplete',
+                        'Interface': 'Local/100@from-queue/n',
+                        'HoldTime': '10', 'TalkTime': '120'},
+                    ) + events(16,
+                    {'Event': 'QueueCallerJoin'},
+                    ))
+
+            stats = QueueStat.search([])
+            self.assertEqual(len(stats), 3)
+            queue, = [s for s in stats if not s.agent
+                and s.start.minute == 0]
+            self.assertEqual(queue.calls, 2)
+            self.assertEqual(queue.answered, 1)
+            self.assertEqual(queue.abandoned, 1)
+            self.assertEqual(queue.max_wait_time, 30)
+            self.assertEqual(queue.average_wait_time, 20)
+            self.assertEqual(queue.average_handle_time, 120)
+            self.assertEqual(queue.abandon_rate, 0.5)
+            self.assertEqual(queue.service_level, 0.5)
+            agent, = [s for s in stats if s.agent]
+            self.assertEqual(agent.agent, user)
+            self.assertEqual((agent.answered, agent.completed), (1, 1))
+            self.assertEqual(agent.service_level, 1)
+
+            summary = QueueStat.summary(stats)
+            self.assertEqual(summary[('sales', None)]['calls'], 3)
+            self.assertEqual(summary[('sales', user.id)]['handle_time'],
+                120)
+
+    @with_transaction()
+    def test_recording(self):
+        'Test recording scan'
+        pool = Pool()
+        Cdr = pool.get('asterisk.cdr')
+        Recording = pool.get('asterisk.recording')
+        User = pool.get('res.user')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        from trytond.modules.asterisk.recording import chunks
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        def record(name, age=60):
+            path = os.path.join(directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with wave.open(path, 'wb') as audio:
+                audio.setnchannels(1)
+                audio.setsampwidth(2)
+                audio.setframerate(8000)
+                audio.writeframes(b'\0\1' * 16000)
+            mtime = time.time() - age
+            os.utime(path, (mtime, mtime))
+            return path
+
+        company = create_company()
+        with set_company(company):
+            user, = User.create([{
+                        'name': 'Agent',
+                        'login': 'agent',
+                        'internal_number': '100',
+                        }])
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'recording_path': directory,
+                        }])
+            path = record('2021/03/01/out-100-1614592800.1.wav', age=120)
+            record('2021/03/01/in-100-1614592900.2.wav')
+            # Still written by MixMonitor
+            record('2021/03/01/in-100-1614593000.3.wav', age=0)
+            record('notes.txt')
+            cdr, = Cdr.store_cdrs(configuration, [{
+                        'source': '100',
+                        'destination': '600100200',
+                        'channel': 'SIP/100-00000001',
+                        'uniqueid': '1614592800.1',
+                        }])
+
+            self.assertEqual(Recording.scan(configuration), 2)
+            self.assertEqual(configuration.recording_mtime,
+                os.stat(path.replace('out-100-1614592800.1',
+                        'in-100-1614592900.2')).st_mtime)
+            recording, = Recording.search([('uniqueid', '=', '1614592800.1')])
+            self.assertEqual(recording.cdr, cdr)
+            self.assertEqual(recording.user, user)
+            self.assertEqual(recording.duration, 2)
+            self.assertEqual(recording.format, 'wav')
+            self.assertEqual(recording.mimetype, 'audio/x-wav')
+
+            # Only the new recordings are indexed
+            self.assertEqual(Recording.scan(configuration), 0)
+            self.assertEqual(Recording.scan(configuration, settle_time=0), 1)
+
+            # The CDR imported after the recording is linked
+            other, = Recording.search([('uniqueid', '=', '1614592900.2')])
+            self.assertIsNone(other.cdr)
+            cdr2, = Cdr.store_cdrs(configuration, [{
+                        'source': '600100200',
+                        'destination': '100',
+                        'uniqueid': '1614592900.2',
+                        }])
+            self.assertEqual(other.cdr, cdr2)
+            self.assertEqual(other.user, user)
+
+            with open(path, 'rb') as file:
+                content = file.read()
+            self.assertEqual(recording.read_chunk(10, 100), content[10:110])
+            self.assertEqual(b''.join(chunks(path, 5, size=1000)),
+                content[5:])
+            self.assertEqual(list(chunks(path, len(content))), [])
+
+    @with_transaction()
+    def test_user_extension(self):
+        'Test user extensions'
+        pool = Pool()
+        Extension = pool.get('res.user.extension')
+        User = pool.get('res.user')
+
+        company = create_company()
+        other_company = create_company('Other Company')
+        with set_company(company):
+            user1, user2 = User.create([{
+                        'name': 'Agent 1',
+                        'login': 'agent1',
+                        'internal_number': '100, 101',
+                        'asterisk_chan_type': 'SIP',
+                        }, {
+                        'name': 'Agent 2',
+                        'login': 'agent2',
+                        }])
+            self.assertEqual(user1.internal_number, '100, 101')
+            self.assertEqual(User.search([('internal_number', '=', '101')]),
+                [user1])
+            self.assertEqual(Extension.lookup('101'), (user1.id, 'SIP/101'))
+            self.assertEqual(User.extension_users(), {
+                    '100': user1.id,
+                    '101': user1.id,
+                    })
+            # The map is computed once
+            self.assertIs(Extension.get_map(), Extension.get_map())
+
+            Extension.create([{
+                        'user': user2.id,
+                        'number': '200',
+                        'chan_type': 'IAX2',
+                        'priority': 20,
+                        }, {
+                        'user': user2.id,
+                        'number': '201',
+                        'priority': 10,
+                        }])
+            self.assertEqual(user2.get_asterisk_extensions(),
+                [('201', None), ('200', 'IAX2/200')])
+            User.write([user2], {'asterisk_chan_type': 'SIP'})
+            self.assertEqual(user2.get_asterisk_extensions(),
+                [('201', 'SIP/201'), ('200', 'IAX2/200')])
+            self.assertEqual(Extension.lookup('201'), (user2.id, 'SIP/201'))
+
+            # The same numbers can not be set to several users
+            with self.assertRaises(UserError):
+                User.write([user1, user2], {'internal_number': '300'})
+            User.write([user1, user2], {'internal_number': None})
+            self.assertEqual(User.extension_users(), {})
+
+        # The extensions are unique by company
+        with set_company(other_company):
+            user3, = User.create([{
+                        'name': 'Agent 3',
+                        'login': 'agent3',
+                        'internal_number': '100',
+                        'asterisk_chan_type': 'SIP',
+                        }])
+            self.assertEqual(User.extension_users(), {'100': user3.id})
+            self.assertEqual(Extension.lookup('100', company.id), None)
+            self.assertEqual(user3.get_asterisk_extensions(company.id), [])
+
+            with self.assertRaises(Exception):
+                Extension.create([{'user': user2.id, 'number': '100'}])
+            Transaction().rollback()
+
+    @with_transaction()
+    def test_call_history(self):
+        'Test call history'
+        pool = Pool()
+        Call = pool.get('asterisk.call')
+        Cdr = pool.get('asterisk.cdr')
+        Party = pool.get('party.party')
+        User = pool.get('res.user')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+
+        company = create_company()
+        with set_company(company):
+            user, = User.create([{
+                        'name': 'Agent',
+                        'login': 'agent',
+                        'internal_number': '100',
+                        }])
+            party, = Party.create([{
+                        'name': 'Customer',
+                        'contact_mechanisms': [('create', [{
+                                        'type': 'phone',
+                                        'value': '+34 600 100 200',
+                                        }])],
+                        }])
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'country_prefix': '34',
+                        'international_prefix': '00',
+                        }])
+            now = datetime.datetime.utcnow().replace(microsecond=0)
+            old = now - datetime.timedelta(days=60)
+            Cdr.store_cdrs(configuration, [{
+                        'source': '100',
+                        'destination': '600100200',
+                        'start': old,
+                        'answer': old,
+                        'billsec': 60,
+                        }, {
+                        'source': '600100200',
+                        'destination': '100',
+                        'start': now,
+                        'billsec': 0,
+                        }, {
+                        # Calls without user nor party are not kept
+                        'source': '600999999',
+                        'destination': '999',
+                        'start': now,
+                        }])
+
+            incoming, outgoing = Call.search([])
+            self.assertEqual(outgoing.direction, 'outgoing')
+            self.assertEqual(outgoing.number, '600100200')
+            self.assertEqual(outgoing.user, user)
+            self.assertEqual(outgoing.party, party)
+            self.assertTrue(outgoing.answered)
+            self.assertEqual(outgoing.duration, 60)
+            self.assertEqual(incoming.direction, 'incoming')
+            self.assertEqual(incoming.number, '600100200')
+            self.assertFalse(incoming.answered)
+
+            party = Party(party.id)
+            self.assertEqual(party.asterisk_call_count, 2)
+            self.assertEqual(party.asterisk_last_call, now)
+            self.assertEqual(party.asterisk_calls, (incoming, outgoing))
+            party_copy, = Party.copy([party])
+            self.assertIsNone(party_copy.asterisk_call_count)
+
+            self.assertEqual(Call.prune(company,
+                    now - datetime.timedelta(days=30)), 1)
+            self.assertEqual(Call.search([]), [incoming])
+            # The summary includes the pruned calls
+            party = Party(party.id)
+            self.assertEqual(party.asterisk_call_count, 2)
+
+    @with_transaction()
+    def test_route_rules(self):
+        'Test route rules'
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        RouteRule = pool.get('asterisk.route.rule')
+
+        company = create_company()
+        with set_company(company):
+            ast_server, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'country_prefix': '33',
+                        'national_prefix': '0',
+                        'international_prefix': '00',
+                        'out_prefix': '9',
+                        'national_format_allowed': True,
+                        }])
+            RouteRule.create([{
+                        'name': 'Spain',
+                        'prefix': '34',
+                        'out_prefix': '7',
+                        }, {
+                        'name': 'Spain premium',
+                        'prefix': '34803',
+                        'action': 'block',
+                        }, {
+                        'name': 'Paris',
+                        'prefix': '331',
+                        'out_prefix': '8',
+                        }, {
+                        'name': 'Emergency',
+                        'kind': 'number',
+                        'prefix': '112',
+                        'no_out_prefix': True,
+                        }])
+            result = Configuration.reformat_numbers([
+                    '+34 600 10 02 00',
+                    '0034 803 100 200',
+                    '01 41 98 12 42',
+                    '+33 6 12 34 56 78',
+                    '112',
+                    '+44 20 7946 0000',
+                    ], ast_server)
+            self.assertEqual([n for n, _ in result], [
+                    '70034600100200', None, '80141981242', '90612345678',
+                    '112', '900442079460000'])
+            self.assertTrue(result[1][1])
+
+            rule, = RouteRule.search([('prefix', '=', '34803')])
+            RouteRule.write([rule], {'action': 'route'})
+            self.assertEqual(
+                Configuration.reformat_number('0034803100200', ast_server),
+                '90034803100200')
+            rule, = RouteRule.search([('prefix', '=', '112')])
+            RouteRule.write([rule], {'no_out_prefix': False})
+            self.assertEqual(
+                Configuration.reformat_number('112', ast_server), '9112')
+            self.assertIs(RouteRule.get_table(ast_server.id),
+                RouteRule.get_table(ast_server.id))
+
+            with self.assertRaises(UserError):
+                RouteRule.create([{
+                            'name': 'Invalid',
+                            'prefix': '+1',
+                            }])
+
+    def test_transport(self):
+        'Test AMI and ARI transports'
+        from trytond.modules.asterisk.transport import (AsyncAMIClient,
+            AsyncARIClient, async_client, frame_action)
+        from .fake_ami import FakeAMIServer
+
+        self.assertEqual(frame_action('Ping', action_id='1-1'),
+            b'Action: Ping\r\nActionID: 1-1\r\n\r\n')
+        self.assertEqual(frame_action('Hangup', [('Channel', 'SIP/100-1')]),
+            b'Action: Hangup\r\nChannel: SIP/100-1\r\n\r\n')
+        self.assertIsInstance(
+            async_client('pbx', 5038, 'tryton', 'secret'), AsyncAMIClient)
+        self.assertIsInstance(
+            async_client('pbx', 5038, 'tryton', 'secret', transport='ari'),
+            AsyncARIClient)
+
+        async def run():
+            server = await FakeAMIServer().start()
+            client = AsyncAMIClient('127.0.0.1', server.port, 'tryton',
+                'secret', max_backoff=0.1)
+            task = asyncio.ensure_future(client.run(lambda m: None))
+            await asyncio.wait_for(client.connected.wait(), 5)
+            responses = await client.send_actions(
+                [('Ping', None), ('Hangup', [('Channel', 'SIP/300-1')]),
+                    ('Ping', None)])
+            client.stop()
+            task.cancel()
+            await server.stop()
+            return responses
+
+        responses = asyncio.run(run())
+        self.assertEqual([r.success for r in responses], [True, False, True])
+
+        channel = {
+            'id': '1.1',
+            'name': 'PJSIP/100-00000001',
+            'state': 'Ringing',
+            'caller': {'number': '100', 'name': ''},
+            'connected': {'number': '600100200', 'name': 'Customer'},
+            'dialplan': {'context': 'default', 'exten': '100'},
+            }
+        message, = AsyncARIClient.translate({
+                'type': 'ChannelStateChange',
+                'channel': channel,
+                })
+        self.assertEqual(message['Event'], 'Newstate')
+        self.assertEqual(message['ChannelState'], '5')
+        self.assertEqual(message['ConnectedLineNum'], '600100200')
+        self.assertNotIn('Linkedid', message)
+        message, = AsyncARIClient.translate({
+                'type': 'ChannelDestroyed',
+                'channel': channel,
+                'cause': 16,
+                'cause_txt': 'Normal Clearing',
+                })
+        self.assertEqual((message['Event'], message['Cause-txt']),
+            ('Hangup', 'Normal Clearing'))
+        message, = AsyncARIClient.translate({
+                'type': 'Dial',
+                'peer': channel,
+                'dialstatus': 'ANSWER',
+                })
+        self.assertEqual((message['Event'], message['DestUniqueid']),
+            ('DialEnd', '1.1'))
+        self.assertEqual(AsyncARIClient.translate({'type': 'StasisStart'}),
+            [])
+
+    @with_transaction()
+    def test_wallboard(self):
+        'Test wallboard'
+        pool = Pool()
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        Wallboard = pool.get('asterisk.wallboard')
+        from trytond.modules.asterisk.wallboard import WallboardState
+
+        state = WallboardState()
+        state.on_event({'Event': 'Newchannel', 'Uniqueid': '1.1',
+                'Channel': 'SIP/100-1', 'ChannelStateDesc': 'Ring'}, 10,
+            now=100)
+        state.on_event({'Event': 'Newchannel', 'Uniqueid': '1.2',
+                'Channel': 'SIP/300-1', 'ChannelStateDesc': 'Ring'}, None,
+            now=100)
+        state.on_event({'Event': 'Newstate', 'Uniqueid': '1.1',
+                'ChannelStateDesc': 'Up', 'ConnectedLineNum': '600100200'},
+            now=105)
+        state.on_event({'Event': 'QueueCallerJoin', 'Uniqueid': '2.1',
+                'Queue': 'sales'}, now=102)
+        state.on_event({'Event': 'QueueCallerJoin', 'Uniqueid': '2.2',
+                'Queue': 'sales'}, now=104)
+        # The events are coalesced in one change by agent and queue
+        self.assertEqual(state.changes(), {
+                'agents': {10: {'state': 'talking', 'since': 105,
+                        'number': '600100200', 'calls': 1}},
+                'queues': {'sales': {'waiting': 2, 'since': 102}},
+                })
+        self.assertIsNone(state.changes())
+
+        state.on_event({'Event': 'QueueCallerLeave', 'Uniqueid': '2.1',
+                'Queue': 'sales'}, now=110)
+        state.on_event({'Event': 'Hangup', 'Uniqueid': '2.2'}, now=111)
+        state.on_event({'Event': 'Hangup', 'Uniqueid': '1.2'}, now=111)
+        self.assertEqual(state.changes(), {'queues': {'sales': None}})
+        self.assertEqual(list(state.snapshot()['agents']), [10])
+
+        company = create_company()
+        with set_company(company):
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'ip_address': 'pbx.example.com',
+                        }])
+            snapshot = Wallboard.get_snapshot()
+            self.assertEqual(snapshot['sequence'], 0)
+            # The channel can not be guessed from the configuration
+            channel = snapshot['channel']
+            self.assertNotEqual(channel,
+                'asterisk.wallboard:%s' % configuration.id)
+            self.assertEqual(len(channel), len('asterisk.wallboard:') + 32)
+
+            with mock.patch('trytond.modules.asterisk.wallboard.Bus'
+                    '.publish') as publish:
+                self.assertEqual(Wallboard.publish(configuration, None,
+                        state.snapshot(), reset=True), 1)
+                state.on_event({'Event': 'Hangup', 'Uniqueid': '1.1'})
+                self.assertEqual(Wallboard.publish(configuration,
+                        state.changes(), state.snapshot()), 2)
+            self.assertEqual([c[0][0] for c in publish.call_args_list],
+                [channel, channel])
+            snapshot = Wallboard.get_snapshot()
+            self.assertEqual((snapshot['sequence'], snapshot['agents']),
+                (2, {}))
+            self.assertEqual(snapshot['channel'], channel)
+
+    def test_pool(self):
+        'Test AMI session pool'
+        from trytond.modules.asterisk.ami import AMIError, AMIPool
+        from .fake_ami import FakeAMIServer
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = asyncio.run_coroutine_threadsafe(
+            FakeAMIServer().start(), loop).result(5)
+        key = ('db', 1)
+        params = ('127.0.0.1', server.port, 'tryton', 'secret')
+        pool = AMIPool(size=1, health_interval=3600)
+        try:
+            with pool.session(key, *params) as session:
+                self.assertEqual(pool.occupancy(),
+                    {('127.0.0.1:%s' % server.port, 'idle'): 0,
+                        ('127.0.0.1:%s' % server.port, 'in_use'): 1})
+            # The released session is reused
+            with pool.session(key, *params) as other:
+                self.assertIs(other, session)
+                # Above the size of the pool the session is closed
+                with pool.session(key, *params) as extra:
+                    self.assertIsNot(extra, session)
+            self.assertFalse(session.connected)
+            self.assertEqual(pool._idle[key], [extra])
+
+            # A broken session is not returned to the pool
+            with self.assertRaises(AMIError):
+                with pool.session(key, *params) as session:
+                    self.assertIs(session, extra)
+                    raise AMIError('Broken')
+            self.assertFalse(session.connected)
+            self.assertEqual(pool._idle[key], [])
+
+            # Other parameters discard the idle sessions
+            with pool.session(key, *params) as session:
+                pass
+            with pool.session(key, 'localhost', *params[1:]) as other:
+                self.assertIsNot(other, session)
+            self.assertFalse(session.connected)
+
+            pool.invalidate(('db',))
+            self.assertEqual(pool.occupancy(), {})
+            self.assertFalse(other.connected)
+        finally:
+            asyncio.run_coroutine_threadsafe(server.stop(), loop).result(5)
+            loop.call_soon_threadsafe(loop.stop)
+
+    @with_transaction()
+    def test_dial_slow_answer(self):
+        'Test click2dial of channels answering after the AMI timeout'
+        from trytond.modules.asterisk import ami
+        from .fake_ami import FakeAMIServer
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        Party = pool.get('party.party')
+        User = pool.get('res.user')
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = asyncio.run_coroutine_threadsafe(
+            FakeAMIServer().start(), loop).result(5)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        self.addCleanup(lambda: asyncio.run_coroutine_threadsafe(
+                server.stop(), loop).result(5))
+
+        company = create_company()
+        with set_company(company):
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'ip_address': '127.0.0.1',
+                        'port': server.port,
+                        'login': 'tryton',
+                        'password': 'secret',
+                        'context': 'from-internal',
+                        'wait_time': 1,
+                        'extension_priority': 1,
+                        'country_prefix': '34',
+                        'international_prefix': '00',
+                        }])
+            endpoint, = configuration.get_endpoints()
+            self.addCleanup(ami.pool.invalidate,
+                (Transaction().database.name, configuration.id))
+            user, = User.create([{
+                        'name': 'Agent',
+                        'login': 'agent',
+                        'internal_number': '100, 101',
+                        'asterisk_chan_type': 'SIP',
+                        'company': company.id,
+                        'companies': [('add', [company.id])],
+                        }])
+            party, = Party.create([{'name': 'Customer'}])
+
+            with mock.patch.object(ami, 'TIMEOUT', 0.5), \
+                    Transaction().set_user(user.id):
+                # The response waits for the answer up to the wait time
+                server.answer_delays['SIP/100'] = 1
+                Configuration.dial(party, '+34 600 100 200')
+                self.assertEqual([a['Channel'] for a in server.actions
+                        if a['Action'] == 'Originate'], ['SIP/100'])
+
+                # A channel answering too late is not a server failure
+                del server.actions[:]
+                server.answer_delays['SIP/100'] = 3
+                Configuration.dial(party, '+34 600 100 200')
+                self.assertEqual([a['Channel'] for a in server.actions
+                        if a['Action'] == 'Originate'],
+                    ['SIP/100', 'SIP/101'])
+                self.assertTrue(ami.pool.health(endpoint.key).available)
+
+    @with_transaction()
+    def test_dial_async(self):
+        'Test asynchronous click2dial against fake AMI server'
+        from trytond.modules.asterisk import ami
+        from .fake_ami import FakeAMIServer
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        CallAttempt = pool.get('asterisk.call.attempt')
+        Party = pool.get('party.party')
+        User = pool.get('res.user')
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = asyncio.run_coroutine_threadsafe(
+            FakeAMIServer().start(), loop).result(5)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        self.addCleanup(lambda: asyncio.run_coroutine_threadsafe(
+                server.stop(), loop).result(5))
+
+        company = create_company()
+        with set_company(company):
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'ip_address': '127.0.0.1',
+                        'port': server.port,
+                        'login': 'tryton',
+                        'password': 'secret',
+                        'context': 'from-internal',
+                        'wait_time': 15,
+                        'extension_priority': 1,
+                        'country_prefix': '34',
+                        'international_prefix': '00',
+                        'originate_async': True,
+                        }])
+            self.addCleanup(ami.pool.invalidate,
+                (Transaction().database.name, configuration.id))
+            user, = User.create([{
+                        'name': 'Agent',
+                        'login': 'agent',
+                        'internal_number': '100, 101',
+                        'asterisk_chan_type': 'SIP',
+                        'company': company.id,
+                        'companies': [('add', [company.id])],
+                        }])
+            party, = Party.create([{'name': 'Customer'}])
+
+            def next_result():
+                "Process the next OriginateResponse in this transaction"
+                _, attempt_id, message, _ = CallAttempt._results.get(
+                    timeout=5)
+                self.assertEqual(message['Event'], 'OriginateResponse')
+                CallAttempt.process_result(attempt_id, message)
+                return CallAttempt(attempt_id)
+
+            # The results are not written by the background thread as the
+            # attempts are not committed
+            server.originate_reasons['SIP/100'] = '5'
+            with mock.patch.object(CallAttempt, '_start_writer'), \
+                    Transaction().set_user(user.id):
+                attempt = CallAttempt(Configuration.dial(party,
+                        '+34 600 100 200'))
+                self.assertEqual((attempt.state, attempt.channel),
+                    ('pending', 'SIP/100'))
+
+                # The busy channel is followed by the next one
+                attempt = next_result()
+                self.assertEqual(
+                    (attempt.state, attempt.reason, attempt.channel),
+                    ('pending', 'Busy', 'SIP/101'))
+                attempt = next_result()
+                self.assertEqual((attempt.state, attempt.reason),
+                    ('success', None))
+
+                server.originate_reasons['SIP/101'] = '3'
+                attempt = CallAttempt(Configuration.dial(party,
+                        '+34 600 100 200'))
+                next_result()
+                attempt = next_result()
+                self.assertEqual((attempt.state, attempt.reason),
+                    ('failed', 'No answer'))
+
+    @with_transaction()
+    def test_dial_ring_all(self):
+        'Test ring all click2dial against fake AMI server'
+        from trytond.modules.asterisk import ami
+        from .fake_ami import FakeAMIServer
+        pool = Pool()
+        Configuration = pool.get('asterisk.configuration')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = asyncio.run_coroutine_threadsafe(
+            FakeAMIServer().start(), loop).result(5)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        self.addCleanup(lambda: asyncio.run_coroutine_threadsafe(
+                server.stop(), loop).result(5))
+
+        company = create_company()
+        with set_company(company):
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'ip_address': '127.0.0.1',
+                        'port': server.port,
+                        'login': 'tryton',
+                        'password': 'secret',
+                        'context': 'from-internal',
+                        'wait_time': 15,
+                        'extension_priority': 1,
+                        }])
+            self.addCleanup(ami.pool.invalidate,
+                (Transaction().database.name, configuration.id))
+            channels = ['SIP/100', 'SIP/101', 'SIP/102']
+
+            def hangups():
+                return sorted(a['Channel'].rsplit('-', 1)[0]
+                    for a in server.actions if a['Action'] == 'Hangup')
+
+            # The first channel to answer wins and the others are hung up
+            server.answer_delays.update({'SIP/100': 2, 'SIP/102': 2})
+            self.assertTrue(Configuration._dial_ring_all('600100200',
+                    'Agent', channels, configuration))
+            time.sleep(0.2)
+            self.assertEqual(hangups(), ['SIP/100', 'SIP/102'])
+            self.assertEqual([n.rsplit('-', 1)[0]
+                    for n in server.channels.values()], ['SIP/101'])
+
+            # When all the channels fail the group finishes without winner
+            server.channels.clear()
+            server.answer_delays.clear()
+            del server.actions[:]
+            for channel in channels:
+                server.originate_reasons[channel] = '3'
+            group = Configuration._ring_group('600100200', 'Agent',
+                channels, configuration)
+            self.assertTrue(group.wait(5))
+            self.assertIsNone(group.channel)
+            self.assertEqual(group.result['Reason'], '3')
+            self.assertFalse(Configuration._dial_ring_all('600100200',
+                    'Agent', channels, configuration))
+            self.assertEqual(hangups(), [])
+
+    @with_transaction()
+    def test_phone_backfill(self):
+        'Test phone backfill'
+        pool = Pool()
+        Party = pool.get('party.party')
+        ContactMechanism = pool.get('party.contact_mechanism')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        Queue = pool.get('ir.queue')
+        PhoneBackfill = pool.get('asterisk.phone.backfill', type='wizard')
+        table = ContactMechanism.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            ConfigurationCompany.create([{
+                        'company': company.id,
+                        'country_prefix': '33',
+                        'national_prefix': '0',
+                        'international_prefix': '00',
+                        }])
+            party1, party2, party3 = Party.create([{
+                        'name': 'Party %s' % i,
+                        'contact_mechanisms': [('create', [{
+                                        'type': 'phone',
+                                        'value': value,
+                                        }])],
+                        } for i, value in enumerate([
+                            '01 41 98 12 42', '600 100 200',
+                            '600 100 201'], 1)])
+            cursor.execute(*table.update(
+                    [table.asterisk_number, table.asterisk_number_reversed],
+                    [Null, Null]))
+
+            session_id, _, _ = PhoneBackfill.create()
+            backfill = PhoneBackfill(session_id)
+            backfill.start.batch_size = 2
+            backfill.transition_backfill()
+            # A task is queued for each batch
+            self.assertEqual(len(Queue.search([('name', '=', 'asterisk')])),
+                2)
+
+            ContactMechanism.backfill_asterisk_numbers(
+                ContactMechanism.search([]))
+            self.assertEqual(sorted(m.asterisk_number
+                    for m in ContactMechanism.search([])),
+                ['33141981242', '33600100200', '33600100201'])
+
+            # The numbers are matched on their last digits at once
+            self.assertEqual(ContactMechanism.match_numbers(
+                    ['+1 600100200', '+1 600100201', '+1 141981242']), {
+                    '+1 600100200': [party2.id],
+                    '+1 600100201': [party3.id],
+                    '+1 141981242': [party1.id],
+                    })
+
+    @with_transaction()
+    def test_import_cdr_timezone(self):
+        'Test import CDR timezone and rotation'
+        pool = Pool()
+        Company = pool.get('company.company')
+        Cdr = pool.get('asterisk.cdr')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        table = Company.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        # The timezones are available only with pytz
+        cursor.execute(*table.update([table.timezone], ['Europe/Madrid'],
+                where=table.id == company.id))
+        with set_company(company):
+            directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, directory)
+            path = os.path.join(directory, 'Master.csv')
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'cdr_path': path,
+                        }])
+            line = ('"","101","600100200","from-internal","",'
+                '"SIP/101-00000001","","Dial","","%s","","%s",0,0,'
+                '"NO ANSWER","DOCUMENTATION","%s",""\n')
+            with open(path, 'w') as file:
+                file.write(line % ('2021-03-01 10:00:00',
+                        '2021-03-01 10:00:10', '1'))
+
+            self.assertEqual(Cdr.import_file(configuration), 1)
+            cdr, = Cdr.search([])
+            # Asterisk writes the local time of the company
+            self.assertEqual(cdr.start, datetime.datetime(2021, 3, 1, 9))
+            self.assertEqual(cdr.end,
+                datetime.datetime(2021, 3, 1, 9, 0, 10))
+
+            # A rotated file bigger than the offset is read from the start
+            rotated = os.path.join(directory, 'Master.csv.new')
+            with open(rotated, 'w') as file:
+                for uniqueid in ['2', '3']:
+                    file.write(line % ('2021-07-01 10:00:00',
+                            '2021-07-01 10:00:10', uniqueid))
+            os.replace(rotated, path)
+            configuration = ConfigurationCompany(configuration.id)
+            self.assertEqual(Cdr.import_file(configuration), 2)
+            self.assertEqual(sorted(c.start for c in Cdr.search([
+                            ('uniqueid', '!=', '1'),
+                            ])), [datetime.datetime(2021, 7, 1, 8)] * 2)
+
+    def test_recording_scan_directory(self):
+        'Test recording scan of nested directories'
+        from trytond.modules.asterisk.recording import _scan_directory
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        now = time.time()
+
+        def touch(name, age):
+            path = os.path.join(directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'wb').close()
+            mtime = now - age
+            os.utime(path, (mtime, mtime))
+            return path
+
+        def set_age(name, seconds):
+            mtime = now - seconds
+            os.utime(os.path.join(directory, name), (mtime, mtime))
+
+        old = touch('2021/02/28/in-100-1614506400.1.wav', 3600)
+        new = touch('2021/03/01/in-100-1614592800.2.wav', 60)
+        # The parents of the new day are not modified by its files
+        for name, seconds in [('2021/02/28', 3600), ('2021/03', 3600),
+                ('2021/02', 3600), ('2021', 3600)]:
+            set_age(name, seconds)
+
+        paths = [e.path for e in _scan_directory(directory, now - 600)]
+        self.assertIn(new, paths)
+        if os.stat(os.path.dirname(old)).st_nlink == 2:
+            # The old leaf directory is skipped
+            self.assertNotIn(old, paths)
+        self.assertEqual(sorted(e.path
+                for e in _scan_directory(directory, now - 7200)),
+            sorted([old, new]))
+
+    @with_transaction()
+    def test_recording_route(self):
+        'Test recording route'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Recording = pool.get('asterisk.recording')
+        User = pool.get('res.user')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        from werkzeug.exceptions import NotFound
+        from trytond.modules.asterisk.routes import recording as route
+
+        # The function without the decorators opening the transaction
+        route = route.__wrapped__.__wrapped__
+        fd, path = tempfile.mkstemp(suffix='.wav')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(b'RIFF')
+        group = ModelData.get_id('asterisk', 'group_asterisk')
+        company_a = create_company('Company A')
+        company_b = create_company('Company B')
+        users = {}
+        for company in [company_a, company_b]:
+            with set_company(company):
+                configuration, = ConfigurationCompany.create([{
+                            'company': company.id,
+                            }])
+                users[company], = User.create([{
+                            'name': company.rec_name,
+                            'login': company.rec_name,
+                            'groups': [('add', [group])],
+                            }])
+        recording, = Recording.create([{
+                    'configuration': ConfigurationCompany.search([
+                            ('company', '=', company_a.id),
+                            ])[0].id,
+                    'company': company_a.id,
+                    'name': 'in-100-1614592800.1.wav',
+                    'path': path,
+                    }])
+        request = mock.Mock(range=None, method='GET')
+
+        with Transaction().set_user(users[company_a].id):
+            response = route(request, pool, recording.id)
+            self.assertEqual(b''.join(response.response), b'RIFF')
+        # The recordings of the other companies are not found
+        with Transaction().set_user(users[company_b].id):
+            with self.assertRaises(NotFound):
+                route(request, pool, recording.id)
+
+    @with_transaction()
+    def test_campaign_reset_lines(self):
+        'Test campaign reset of the interrupted lines'
+        pool = Pool()
+        Campaign = pool.get('asterisk.campaign')
+        Line = pool.get('asterisk.campaign.line')
+
+        company = create_company()
+        with set_company(company):
+            campaign, = Campaign.create([{
+                        'name': 'Campaign',
+                        'trunk': 'SIP/trunk',
+                        'ring_timeout': 30,
+                        }])
+            now = datetime.datetime.utcnow()
+            interrupted, dialing, pending = Line.create([{
+                        'campaign': campaign.id,
+                        'number': number,
+                        } for number in ['600100200', '600100201',
+                        '600100202']])
+            Line.write([interrupted], {
+                    'state': 'dialing',
+                    'dial_date': now - datetime.timedelta(minutes=5),
+                    }, [dialing], {
+                    'state': 'dialing',
+                    'dial_date': now - datetime.timedelta(seconds=10),
+                    })
+            Campaign.write([campaign], {'state': 'running'})
+
+            Campaign._reset_lines(company.id)
+            # The line may be dialed by the dialer of another process
+            self.assertEqual([l.state for l in [interrupted, dialing,
+                            pending]], ['pending', 'dialing', 'pending'])
+
+    def test_call_attempt_pending_result(self):
+        'Test call attempt result kept until the attempt is committed'
+        from trytond.modules.asterisk.call import CallAttempt, RESULT_EXPIRY
+
+        message = {'Event': 'OriginateResponse', 'Response': 'Success'}
+        now = time.monotonic()
+        with mock.patch('trytond.modules.asterisk.call.Transaction'), \
+                mock.patch.object(CallAttempt, 'process_result',
+                    return_value=False) as process_result:
+            # The transaction of the dial is not yet committed
+            self.assertFalse(CallAttempt._write_result('db', 1, message, now))
+            self.assertTrue(CallAttempt._write_result('db', 1, message,
+                    now - RESULT_EXPIRY - 1))
+            process_result.return_value = True
+            self.assertTrue(CallAttempt._write_result('db', 1, message, now))
+            process_result.assert_called_with(1, message)
+
+    def test_event_listener_invalid_event(self):
+        'Test event listener with an event which can not be stored'
+        from trytond.modules.asterisk.listener import EventListener
+
+        stored = []
+
+        class Listener(EventListener):
+            def store(self, values, cdrs=None, queue_events=None):
+                if any(v['event'] == 'Invalid' for v in values):
+                    raise ValueError('Invalid event')
+                stored.extend(values)
+
+        async def run():
+            listener = Listener('db', 1, 1, None, flush_interval=0.01,
+                store_retries=3)
+            listener.buffer = [{'event': e}
+                for e in ['Newchannel', 'Invalid', 'Hangup']]
+            task = asyncio.ensure_future(listener.flush())
+            await asyncio.sleep(0.2)
+            listener.buffer.append({'event': 'Newstate'})
+            await asyncio.sleep(0.1)
+            task.cancel()
+            self.assertEqual(listener.buffer, [])
+
+        with self.assertLogs('trytond.modules.asterisk.listener', 'ERROR'):
+            asyncio.run(run())
+        # Only the invalid event is dropped
+        self.assertEqual([v['event'] for v in stored],
+            ['Newchannel', 'Hangup', 'Newstate'])
+
+    @with_transaction()
+    def test_presence_unreachable(self):
+        'Test presence does not wait for an unreachable server'
+        from trytond.modules.asterisk import ami, presence
+        pool = Pool()
+        User = pool.get('res.user')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+
+        # Find a port where nothing listens
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        company = create_company()
+        with set_company(company):
+            configuration, = ConfigurationCompany.create([{
+                        'company': company.id,
+                        'ip_address': '127.0.0.1',
+                        'port': port,
+                        'login': 'tryton',
+                        'password': 'secret',
+                        }])
+            key = (Transaction().database.name, configuration.id)
+            self.addCleanup(presence.trackers.clear)
+            self.addCleanup(ami.pool.invalidate, key)
+            user, = User.create([{
+                        'name': 'Agent 1',
+                        'login': 'agent1',
+                        'internal_number': '100',
+                        'asterisk_chan_type': 'SIP',
+                        }])
+
+            with mock.patch.object(presence, '_start') as start:
+                start_time = time.time()
+                self.assertEqual(User.get_presences([user.id]),
+                    {user.id: None})
+                self.assertEqual(User(user.id).asterisk_presence, None)
+                self.assertLess(time.time() - start_time, 1)
+                # Only one tracker is started at a time
+                start.assert_called_once()
+            presence.starting.discard(key)
+
+            with self.assertLogs('trytond.modules.asterisk.presence',
+                    'WARNING'):
+                presence._start(key, configuration.get_endpoints())
+            self.assertNotIn(key, presence.trackers)
+            self.assertNotIn(key, presence.starting)
+
+    @with_transaction()
+    def test_server_rule(self):
+        'Test servers of the other companies are not readable'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        User = pool.get('res.user')
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        Server = pool.get('asterisk.configuration.server')
+
+        group = ModelData.get_id('asterisk', 'group_asterisk')
+        company_a = create_company('Company A')
+        company_b = create_company('Company B')
+        users = {}
+        for company in [company_a, company_b]:
+            with set_company(company):
+                configuration, = ConfigurationCompany.create([{
+                            'company': company.id,
+                            }])
+                users[company], = User.create([{
+                            'name': company.rec_name,
+                            'login': company.rec_name,
+                            'groups': [('add', [group])],
+                            }])
+                if company == company_a:
+                    server, = Server.create([{
+                                'configuration': configuration.id,
+                                'ip_address': '10.0.0.1',
+                                'port': 5038,
+                                'login': 'tryton',
+                                'password': 'secret',
+                                }])
+
+        with Transaction().set_user(users[company_a].id), \
+                Transaction().set_context(_check_access=True):
+            self.assertEqual(Server.search([]), [server])
+        with Transaction().set_user(users[company_b].id), \
+                Transaction().set_context(_check_access=True):
+            self.assertEqual(Server.search([]), [])
+            with self.assertRaises(AccessError):
+                Server.read([server.id], ['password'])
+
 
 del ModuleTestCase
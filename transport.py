@@ -0,0 +1,831 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import asyncio
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+from trytond.config import config
+
+from . import metrics
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+__all__ = ['AMIError', 'AMIResolveError', 'AMITimeout', 'AMIMessage',
+    'AMIParser', 'AMIResolver', 'AMISession', 'AsyncAMIClient',
+    'AsyncARIClient', 'frame_action', 'async_client']
+
+logger = logging.getLogger(__name__)
+
+# The client used by the event listener: ami or ari
+TRANSPORT = config.get('asterisk', 'transport', default='ami')
+ARI_PORT = config.getint('asterisk', 'ari_port', default=8088)
+ARI_APP = config.get('asterisk', 'ari_app', default='tryton')
+MAX_BACKOFF = config.getint('asterisk', 'max_backoff', default=60)
+TIMEOUT = config.getfloat('asterisk', 'timeout', default=10)
+CONNECT_TIMEOUT = config.getfloat('asterisk', 'connect_timeout', default=2)
+DNS_TTL = config.getint('asterisk', 'dns_ttl', default=300)
+DNS_NEGATIVE_TTL = config.getint('asterisk', 'dns_negative_ttl', default=10)
+
+
+class AMIError(Exception):
+    pass
+
+
+class AMIResolveError(AMIError):
+    pass
+
+
+class AMITimeout(AMIError):
+    pass
+
+
+class AMIMessage(dict):
+    'A response or an event received from the Asterisk Manager Interface'
+
+    @property
+    def is_event(self):
+        return 'Event' in self
+
+    @property
+    def is_response(self):
+        # Some events like OriginateResponse have a Response key
+        return 'Response' in self and 'Event' not in self
+
+    @property
+    def success(self):
+        return self.get('Response') in ('Success', 'Pong', 'Goodbye')
+
+    def __str__(self):
+        return '\n'.join('%s: %s' % i for i in self.items())
+
+
+def frame_action(action, fields=None, action_id=None):
+    "Return the bytes sent for the action with the (key, value) fields"
+    lines = ['Action: %s' % action]
+    if action_id is not None:
+        lines.append('ActionID: %s' % action_id)
+    lines.extend('%s: %s' % (k, v) for k, v in (fields or []))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+
+
+class AMIParser(object):
+    '''
+    Incremental parser of the AMI protocol.
+
+    Data is buffered until a complete frame, terminated by an empty line, is
+    available. The greeting line sent by Asterisk on connection is stored as
+    banner.
+    '''
+    terminator = b'\r\n\r\n'
+
+    def __init__(self):
+        self.banner = None
+        self._buffer = b''
+
+    def feed(self, data):
+        self._buffer += data
+        if self.banner is None:
+            if b'\r\n' not in self._buffer:
+                return []
+            banner, self._buffer = self._buffer.split(b'\r\n', 1)
+            self.banner = banner.decode('utf-8', 'replace')
+        *frames, self._buffer = self._buffer.split(self.terminator)
+        return [self.parse(f) for f in frames if f]
+
+    @staticmethod
+    def parse(frame):
+        message = AMIMessage()
+        for line in frame.decode('utf-8', 'replace').split('\r\n'):
+            key, sep, value = line.partition(':')
+            if not sep:
+                continue
+            key, value = key.strip(), value.strip()
+            if key in message:
+                message[key] += '\n' + value
+            else:
+                message[key] = value
+        return message
+
+
+class AMIResolver(object):
+    '''
+    Process wide cache of the addresses of the Asterisk servers.
+
+    The addresses are kept for ttl seconds. Once expired, the last known
+    addresses are still returned while they are resolved again in the
+    background, and they are kept when the resolver fails. A host which has
+    never been resolved is remembered as failing for negative_ttl seconds.
+    '''
+
+    def __init__(self, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL,
+            getaddrinfo=socket.getaddrinfo, clock=time.monotonic):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.getaddrinfo = getaddrinfo
+        self.clock = clock
+        self._lock = threading.Lock()
+        # The addresses or the error and the expiration of each host and port
+        self._entries = {}
+        # The event set when the running resolution of the key ends
+        self._pending = {}
+
+    def resolve(self, host, port):
+        "Return the getaddrinfo result of a stream socket to host and port"
+        with self._lock:
+            entry = self._entries.get((host, port))
+        if entry is not None:
+            addresses, error, expires = entry
+            if expires > self.clock():
+                if addresses:
+                    return addresses
+                raise AMIResolveError(error)
+            elif addresses:
+                # Do not wait for the resolver on the dialing path
+                self.refresh(host, port, wait=False)
+                return addresses
+        addresses, error, _ = self.refresh(host, port)
+        if not addresses:
+            raise AMIResolveError(error)
+        return addresses
+
+    def refresh(self, host, port, wait=True):
+        '''
+        Resolve host and port again and return the entry. The resolution runs
+        in the background when wait is False.
+        '''
+        key = (host, port)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if owner:
+            if wait:
+                self._resolve(key, pending)
+            else:
+                threading.Thread(target=self._resolve, args=(key, pending),
+                    name='asterisk-ami-resolver', daemon=True).start()
+                return None
+        elif not wait:
+            return None
+        pending.wait()
+        with self._lock:
+            return self._entries.get(key)
+
+    def _resolve(self, key, pending):
+        host, port = key
+        try:
+            with metrics.AMI_DURATION.time(operation='resolve',
+                    server='%s:%s' % key):
+                addresses = self.getaddrinfo(host, port, socket.AF_UNSPEC,
+                    socket.SOCK_STREAM)
+        except (socket.error, UnicodeError) as e:
+            metrics.AMI_ERRORS.inc(category='resolve', server='%s:%s' % key)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[0]:
+                    logger.warning('Unable to resolve %s, keeping the last '
+                        'known addresses: %s', host, e)
+                    self._entries[key] = (entry[0], str(e),
+                        self.clock() + self.negative_ttl)
+                else:
+                    logger.warning('Unable to resolve %s: %s', host, e)
+                    self._entries[key] = (None, str(e),
+                        self.clock() + self.negative_ttl)
+        else:
+            with self._lock:
+                self._entries[key] = (addresses, None,
+                    self.clock() + self.ttl)
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+
+    def prefetch(self, host, port, margin=0):
+        "Resolve in the background if the addresses expire within margin"
+        with self._lock:
+            entry = self._entries.get((host, port))
+        if entry is None or entry[2] <= self.clock() + margin:
+            self.refresh(host, port, wait=False)
+
+    def invalidate(self, host=None):
+        "Forget the addresses of host or of all the hosts"
+        with self._lock:
+            for key in list(self._entries):
+                if host is None or key[0] == host:
+                    del self._entries[key]
+
+
+class AMISession(object):
+    'An authenticated connection to the Asterisk Manager Interface'
+    _action_ids = itertools.count(1)
+
+    def __init__(self, host, port, login, password, timeout=TIMEOUT,
+            events='off', connect_timeout=CONNECT_TIMEOUT, resolver=None):
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.resolver = resolver
+        self.events_mask = events
+        self.sock = None
+        self.parser = None
+        self.events = deque(maxlen=1000)
+        self._messages = deque()
+        self.last_used = time.time()
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    @property
+    def server(self):
+        return '%s:%s' % (self.host, self.port)
+
+    def connect(self):
+        server = self.server
+        dns = self.resolver or resolver
+        addresses = dns.resolve(self.host, self.port)
+        error = None
+        with metrics.AMI_DURATION.time(operation='connect', server=server):
+            for af, socktype, proto, _, sockaddr in addresses:
+                sock = socket.socket(af, socktype, proto)
+                sock.settimeout(self.connect_timeout)
+                try:
+                    sock.connect(sockaddr)
+                except socket.error as e:
+                    sock.close()
+                    error = e
+                    continue
+                sock.settimeout(self.timeout)
+                self.sock = sock
+                break
+            else:
+                metrics.AMI_ERRORS.inc(category='connect', server=server)
+                # The server may have moved to another address
+                dns.refresh(self.host, self.port, wait=False)
+                raise AMIError(str(error))
+        self.parser = AMIParser()
+        self._messages.clear()
+        try:
+            with metrics.AMI_DURATION.time(operation='login', server=server):
+                response = self.send_action('Login', [
+                        ('Events', self.events_mask),
+                        ('Username', self.login),
+                        ('Secret', self.password),
+                        ], timeout=self.connect_timeout)
+        except (socket.error, AMIError):
+            metrics.AMI_ERRORS.inc(category='login', server=server)
+            self.close(logoff=False)
+            raise
+        if not response.success:
+            metrics.AMI_ERRORS.inc(category='authentication', server=server)
+            self.close(logoff=False)
+            raise AMIError(response.get('Message', str(response)))
+        self.last_used = time.time()
+
+    def next_action_id(self):
+        return '%s-%s' % (os.getpid(), next(self._action_ids))
+
+    def write_action(self, action, fields=None, action_id=None):
+        if action_id is None:
+            action_id = self.next_action_id()
+        self.sock.sendall(frame_action(action, fields, action_id))
+        return action_id
+
+    def send_action(self, action, fields=None, timeout=None):
+        action_id = self.write_action(action, fields)
+        return self.read_response(action_id, timeout=timeout)
+
+    def receive(self, timeout=None):
+        "Return the messages parsed from the next data received"
+        if timeout is not None:
+            self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(4096)
+        finally:
+            if timeout is not None and self.sock:
+                self.sock.settimeout(self.timeout)
+        if not data:
+            self.close(logoff=False)
+            metrics.AMI_ERRORS.inc(category='connection_lost',
+                server=self.server)
+            raise AMIError('Connection closed by the Asterisk server')
+        return self.parser.feed(data)
+
+    def read_response(self, action_id, timeout=None):
+        """Return the response to action_id as soon as it is received.
+        Events are kept in the events queue and responses to other actions
+        are discarded."""
+        deadline = time.time() + (timeout or self.timeout)
+        while True:
+            while self._messages:
+                message = self._messages.popleft()
+                if message.is_event:
+                    self.events.append(message)
+                elif message.get('ActionID') == action_id:
+                    return message
+                else:
+                    logger.debug('Discarding AMI response: %s', message)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                metrics.AMI_ERRORS.inc(category='timeout', server=self.server)
+                raise AMITimeout('No response to AMI action %s' % action_id)
+            try:
+                self._messages.extend(self.receive(timeout=remaining))
+            except socket.timeout:
+                continue
+
+    def send_actions(self, actions, timeout=None):
+        '''
+        Send the (action, fields) at once and return their responses in the
+        same order, so the server does not wait for a round trip between
+        them. The responses not received before the timeout are None and the
+        session is closed as it would receive them later.
+        '''
+        action_ids = [self.write_action(a, f) for a, f in actions]
+        pending = set(action_ids)
+        responses = {}
+        deadline = time.time() + (timeout or self.timeout)
+        while pending:
+            while self._messages and pending:
+                message = self._messages.popleft()
+                if message.is_event:
+                    self.events.append(message)
+                elif message.get('ActionID') in pending:
+                    pending.discard(message['ActionID'])
+                    responses[message['ActionID']] = message
+                else:
+                    logger.debug('Discarding AMI response: %s', message)
+            remaining = deadline - time.time()
+            if not pending:
+                break
+            elif remaining <= 0:
+                metrics.AMI_ERRORS.inc(category='timeout', server=self.server)
+                self.close(logoff=False)
+                break
+            try:
+                self._messages.extend(self.receive(timeout=remaining))
+            except socket.timeout:
+                continue
+        self.last_used = time.time()
+        return [responses.get(i) for i in action_ids]
+
+    def originate(self, fields, timeout=None):
+        self.last_used = time.time()
+        with metrics.AMI_DURATION.time(operation='originate',
+                server=self.server):
+            return self.send_action('Originate', fields, timeout=timeout)
+
+    def ping(self):
+        with metrics.AMI_DURATION.time(operation='ping', server=self.server):
+            return self.send_action('Ping').success
+
+    def close(self, logoff=True):
+        # The session may be closed by another thread at the same time
+        sock, self.sock = self.sock, None
+        if sock is None:
+            return
+        try:
+            if logoff:
+                with metrics.AMI_DURATION.time(operation='logoff',
+                        server=self.server):
+                    sock.sendall(b'Action: Logoff\r\n\r\n')
+            sock.close()
+        except socket.error:
+            pass
+
+
+resolver = AMIResolver()
+
+
+class AsyncAMIClient(object):
+    '''
+    asyncio client of the Asterisk Manager Interface.
+
+    run() connects and logs in, reconnecting with an exponential backoff when
+    the connection is lost, and passes each event to on_event. on_connect is
+    awaited after each successful login.
+    '''
+
+    def __init__(self, host, port, login, password, events='call',
+            timeout=TIMEOUT, max_backoff=MAX_BACKOFF):
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.events = events
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self._connected = None
+        self._writer = None
+        self._futures = {}
+        self._callbacks = {}
+        self._action_id = 0
+        self._stopped = False
+
+    @property
+    def server(self):
+        return '%s:%s' % (self.host, self.port)
+
+    def next_action_id(self):
+        self._action_id += 1
+        return '%s-%s' % (os.getpid(), self._action_id)
+
+    async def send_action(self, action, fields=None, callback=None,
+            _writer=None):
+        '''Send the action and return its response.
+        The callback is called with each event carrying the ActionID of the
+        action until it returns True.'''
+        writer = _writer or self._writer
+        if writer is None:
+            raise AMIError('Not connected to %s:%s' % (self.host, self.port))
+        action_id = self.next_action_id()
+        future = self._futures[action_id] = (
+            asyncio.get_event_loop().create_future())
+        if callback:
+            self._callbacks[action_id] = callback
+        writer.write(frame_action(action, fields, action_id))
+        await writer.drain()
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._callbacks.pop(action_id, None)
+            raise AMITimeout('No response to AMI action %s' % action_id)
+        finally:
+            self._futures.pop(action_id, None)
+
+    async def send_actions(self, actions):
+        '''
+        Send the (action, fields) at once and return their responses in the
+        same order. The responses not received before the timeout are None.
+        '''
+        writer = self._writer
+        if writer is None:
+            raise AMIError('Not connected to %s:%s' % (self.host, self.port))
+        loop = asyncio.get_event_loop()
+        action_ids = []
+        for action, fields in actions:
+            action_id = self.next_action_id()
+            self._futures[action_id] = loop.create_future()
+            writer.write(frame_action(action, fields, action_id))
+            action_ids.append(action_id)
+        futures = [self._futures[i] for i in action_ids]
+        try:
+            await writer.drain()
+            await asyncio.wait(futures, timeout=self.timeout)
+        finally:
+            for action_id in action_ids:
+                self._futures.pop(action_id, None)
+        return [f.result() if f.done() and not f.exception() else None
+            for f in futures]
+
+    @property
+    def connected(self):
+        "Event set while the client is logged in"
+        if self._connected is None:
+            self._connected = asyncio.Event()
+        return self._connected
+
+    async def run(self, on_event, on_connect=None):
+        delay = 1
+        while not self._stopped:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port),
+                    self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning('AMI connection to %s:%s failed: %s',
+                    self.host, self.port, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+                continue
+            reading = asyncio.ensure_future(
+                self._read(reader, on_event))
+            reading.add_done_callback(lambda f: self._fail_pending())
+            try:
+                response = await self.send_action('Login', [
+                        ('Events', self.events),
+                        ('Username', self.login),
+                        ('Secret', self.password),
+                        ], _writer=writer)
+                if not response.success:
+                    raise AMIError(response.get('Message', str(response)))
+                delay = 1
+                self._writer = writer
+                self.connected.set()
+                logger.info('Connected to AMI %s:%s', self.host, self.port)
+                if on_connect:
+                    await on_connect(self)
+                await reading
+            except (OSError, AMIError) as e:
+                logger.warning('AMI connection to %s:%s lost: %s',
+                    self.host, self.port, e)
+            finally:
+                self.connected.clear()
+                self._writer = None
+                if reading.done() and not reading.cancelled():
+                    reading.exception()
+                reading.cancel()
+                writer.close()
+                self._fail_pending()
+            if not self._stopped:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    async def _read(self, reader, on_event):
+        parser = AMIParser()
+        server = self.server
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                raise AMIError('Connection closed by the Asterisk server')
+            for message in parser.feed(data):
+                action_id = message.get('ActionID')
+                if message.is_response:
+                    future = self._futures.get(action_id)
+                    if future and not future.done():
+                        future.set_result(message)
+                    continue
+                if message.is_event:
+                    metrics.AMI_EVENTS.inc(event=message['Event'],
+                        server=server)
+                callback = self._callbacks.get(action_id)
+                if callback:
+                    if callback(message):
+                        self._callbacks.pop(action_id, None)
+                    continue
+                on_event(message)
+
+    def _fail_pending(self):
+        for future in self._futures.values():
+            if not future.done():
+                future.set_exception(AMIError('Connection lost'))
+        self._futures.clear()
+        self._callbacks.clear()
+
+    def stop(self):
+        self._stopped = True
+        if self._writer:
+            self._writer.close()
+
+
+# Channel states of ARI and their AMI code
+ARI_STATES = {
+    'Down': '0',
+    'Rsrvd': '1',
+    'OffHook': '2',
+    'Dialing': '3',
+    'Ring': '4',
+    'Ringing': '5',
+    'Up': '6',
+    'Busy': '7',
+    'Dialing Offhook': '8',
+    'Pre-ring': '9',
+    }
+# ARI event type and the AMI event sent for its channel
+ARI_EVENTS = {
+    'ChannelCreated': 'Newchannel',
+    'ChannelStateChange': 'Newstate',
+    'ChannelDestroyed': 'Hangup',
+    }
+# Fields of the AMI Originate and their ARI parameter
+ORIGINATE_PARAMS = {
+    'Channel': 'endpoint',
+    'Exten': 'extension',
+    'Context': 'context',
+    'Priority': 'priority',
+    'CallerId': 'callerId',
+    'Timeout': 'timeout',
+    'ChannelId': 'channelId',
+    }
+
+
+def ari_channel(channel):
+    "Return the AMI keys of the ARI channel"
+    caller = channel.get('caller') or {}
+    connected = channel.get('connected') or {}
+    dialplan = channel.get('dialplan') or {}
+    values = {
+        'Uniqueid': channel.get('id'),
+        'Linkedid': channel.get('linkedid'),
+        'Channel': channel.get('name'),
+        'ChannelState': ARI_STATES.get(channel.get('state')),
+        'ChannelStateDesc': channel.get('state'),
+        'CallerIDNum': caller.get('number'),
+        'CallerIDName': caller.get('name'),
+        'ConnectedLineNum': connected.get('number'),
+        'ConnectedLineName': connected.get('name'),
+        'Exten': dialplan.get('exten'),
+        'Context': dialplan.get('context'),
+        }
+    # The missing keys keep the value known by the listener
+    return {k: str(v) for k, v in values.items() if v is not None}
+
+
+class AsyncARIClient(object):
+    '''
+    asyncio client of the Asterisk REST Interface with the interface of
+    AsyncAMIClient.
+
+    The events of the WebSocket are translated into the AMI events of the
+    channels and the actions used by the listener are sent to the REST API.
+    It requires aiohttp.
+    '''
+
+    def __init__(self, host, port, login, password, events=None,
+            timeout=TIMEOUT, max_backoff=MAX_BACKOFF, app=ARI_APP):
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.app = app
+        self._connected = None
+        self._session = None
+        self._ws = None
+        self._stopped = False
+
+    @property
+    def server(self):
+        return '%s:%s' % (self.host, self.port)
+
+    def url(self, path, scheme='http'):
+        return '%s://%s:%s%s' % (scheme, self.host, self.port, path)
+
+    @property
+    def connected(self):
+        "Event set while the client is subscribed to the events"
+        if self._connected is None:
+            self._connected = asyncio.Event()
+        return self._connected
+
+    @staticmethod
+    def translate(event):
+        "Return the AMI messages of the ARI event"
+        type_ = event.get('type')
+        if type_ in ARI_EVENTS:
+            message = AMIMessage(Event=ARI_EVENTS[type_])
+            message.update(ari_channel(event.get('channel') or {}))
+            if type_ == 'ChannelDestroyed':
+                message['Cause'] = str(event.get('cause', ''))
+                message['Cause-txt'] = event.get('cause_txt', '')
+            return [message]
+        elif type_ == 'Dial':
+            status = event.get('dialstatus')
+            message = AMIMessage(Event='DialEnd' if status else 'DialBegin')
+            message.update(ari_channel(event.get('caller') or {}))
+            peer = ari_channel(event.get('peer') or {})
+            message['DestChannel'] = peer.get('Channel', '')
+            message['DestUniqueid'] = peer.get('Uniqueid', '')
+            if status:
+                message['DialStatus'] = status
+            return [message]
+        return []
+
+    async def run(self, on_event, on_connect=None):
+        if aiohttp is None:
+            raise AMIError('The ARI transport requires aiohttp')
+        delay = 1
+        server = self.server
+        while not self._stopped:
+            session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self.login, self.password),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            try:
+                ws = await session.ws_connect(
+                    self.url('/ari/events', scheme='ws'), params={
+                        'app': self.app,
+                        'subscribeAll': 'true',
+                        })
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning('ARI connection to %s failed: %s', server, e)
+                await session.close()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+                continue
+            try:
+                delay = 1
+                self._session, self._ws = session, ws
+                self.connected.set()
+                logger.info('Connected to ARI %s', server)
+                if on_connect:
+                    await on_connect(self)
+                async for data in ws:
+                    if data.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    for message in self.translate(json.loads(data.data)):
+                        metrics.AMI_EVENTS.inc(event=message['Event'],
+                            server=server)
+                        on_event(message)
+            except (aiohttp.ClientError, ValueError, AMIError) as e:
+                logger.warning('ARI connection to %s lost: %s', server, e)
+            finally:
+                self.connected.clear()
+                self._session = self._ws = None
+                await ws.close()
+                await session.close()
+            if not self._stopped:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    async def _request(self, method, path, **kwargs):
+        "Return the status and the decoded body of the request"
+        if self._session is None:
+            raise AMIError('Not connected to %s' % self.server)
+        try:
+            async with self._session.request(
+                    method, self.url(path), **kwargs) as response:
+                if response.content_type == 'application/json':
+                    data = await response.json()
+                else:
+                    data = await response.text()
+                return response.status, data
+        except asyncio.TimeoutError:
+            raise AMITimeout('No response to ARI request %s' % path)
+        except aiohttp.ClientError as e:
+            raise AMIError(str(e))
+
+    @staticmethod
+    def _response(status, data, **values):
+        if status >= 400:
+            if isinstance(data, dict):
+                data = data.get('message', '')
+            return AMIMessage(Response='Error', Message=str(data))
+        return AMIMessage(Response='Success', **values)
+
+    async def send_action(self, action, fields=None, callback=None):
+        '''Send the action and return its response.
+        The events of CoreShowChannels are passed to the callback.'''
+        if action == 'Ping':
+            status, data = await self._request('GET', '/ari/asterisk/info')
+            return self._response(status, data, Ping='Pong')
+        elif action == 'Originate':
+            return await self._originate(fields or [])
+        elif action == 'CoreShowChannels':
+            status, data = await self._request('GET', '/ari/channels')
+            response = self._response(status, data)
+            if response.success and callback:
+                for channel in data:
+                    message = AMIMessage(Event='CoreShowChannel')
+                    message.update(ari_channel(channel))
+                    callback(message)
+                callback(AMIMessage(Event='CoreShowChannelsComplete',
+                        ListItems=str(len(data))))
+            return response
+        return AMIMessage(Response='Error',
+            Message='Action %s is not supported by ARI' % action)
+
+    async def _originate(self, fields):
+        params, variables = {}, {}
+        for key, value in fields:
+            if key == 'Variable':
+                name, _, value = str(value).partition('=')
+                variables[name] = value
+            elif key in ORIGINATE_PARAMS:
+                params[ORIGINATE_PARAMS[key]] = str(value)
+        if 'timeout' in params:
+            # AMI waits milliseconds and ARI seconds
+            params['timeout'] = str(int(params['timeout']) // 1000)
+        status, data = await self._request('POST', '/ari/channels',
+            params=params, json={'variables': variables})
+        uniqueid = data.get('id', '') if isinstance(data, dict) else ''
+        return self._response(status, data, Uniqueid=uniqueid)
+
+    async def send_actions(self, actions):
+        "Send the (action, fields) concurrently and return their responses"
+        responses = await asyncio.gather(
+            *(self.send_action(a, f) for a, f in actions),
+            return_exceptions=True)
+        return [None if isinstance(r, Exception) else r for r in responses]
+
+    def stop(self):
+        self._stopped = True
+        if self._ws:
+            asyncio.ensure_future(self._ws.close())
+
+
+def async_client(host, port, login, password, events='call',
+        transport=None):
+    "Return the asyncio client of the transport, ami by default"
+    transport = transport or TRANSPORT
+    if transport == 'ari':
+        return AsyncARIClient(host, ARI_PORT, login, password, events=events)
+    elif transport == 'ami':
+        return AsyncAMIClient(host, port, login, password, events=events)
+    raise ValueError('Unknown Asterisk transport: %s' % transport)
@@ -1,46 +1,387 @@
 #This file is part asterisk module for Tryton.
 #The COPYRIGHT file at the top level of this repository contains
 #the full copyright notices and license terms.
-from trytond.model import fields
+import logging
+import uuid
+
+from sql import Null
+from sql.functions import CurrentTimestamp
+
+from trytond import backend
+from trytond.bus import Bus
+from trytond.cache import Cache
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model import ModelView, ModelSQL, Unique, fields
 from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+from . import ami
+from . import presence
+
+__all__ = ['User', 'UserExtension']
+
+logger = logging.getLogger(__name__)
+
+CHAN_TYPES = [
+    (None, ''),
+    ('SIP', 'SIP'),
+    ('IAX2', 'IAX2'),
+    ('DAHDI', 'DAHDI'),
+    ('Zap', 'Zap'),
+    ('Skinny', 'Skinny'),
+    ('MGCP', 'MGCP'),
+    ('mISDN', 'mISDN'),
+    ('H323', 'H323'),
+    ]
+
+# The extension maps of the companies of each database with the token of
+# its cache
+_maps = {}
+# The map of a company without extension
+_EMPTY_MAP = {
+    'extensions': {},
+    'users': {},
+    'numbers': {},
+    }
+
+
+class UserExtension(ModelSQL, ModelView):
+    'User Extension'
+    __name__ = 'res.user.extension'
+    user = fields.Many2One('res.user', 'User', required=True,
+        ondelete='CASCADE', select=True)
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE', select=True)
+    number = fields.Char('Extension', required=True)
+    chan_type = fields.Selection(CHAN_TYPES, 'Asterisk channel type',
+        help="The channel type of the user if empty.")
+    priority = fields.Integer('Priority', required=True,
+        help="The extensions with the lowest priority are called first.")
+    _map_cache = Cache('res.user.extension.map', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(UserExtension, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('company_number_uniq', Unique(t, t.company, t.number),
+                'The extension is already used by another user of the '
+                'company.'),
+            ]
+        cls._order.insert(0, ('priority', 'ASC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        User = pool.get('res.user')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        TableHandler = backend.TableHandler
+        created = not TableHandler.table_exist(cls._table)
+
+        super(UserExtension, cls).__register__(module_name)
+
+        # Migration from 6.1: the internal numbers were a text field
+        user_h = User.__table_handler__(module_name)
+        if created and user_h.column_exist('internal_number'):
+            table = cls.__table__()
+            user = User.__table__()
+            cursor.execute(*user.select(user.id, user.company,
+                    user.internal_number,
+                    where=(user.internal_number != Null)
+                    & (user.company != Null)))
+            seen = set()
+            values = []
+            for user_id, company, internal_number in cursor.fetchall():
+                for i, number in enumerate(
+                        internal_number.replace(' ', '').split(',')):
+                    if number and (company, number) not in seen:
+                        seen.add((company, number))
+                        values.append([user_id, company, number,
+                                (i + 1) * 10, 0, CurrentTimestamp()])
+            if values:
+                cursor.execute(*table.insert([table.user, table.company,
+                            table.number, table.priority, table.create_uid,
+                            table.create_date], values))
+
+    @staticmethod
+    def default_priority():
+        return 10
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def _build_maps(cls):
+        maps = {}
+        # The maps are shared by all the users
+        with Transaction().set_context(_check_access=False):
+            extensions = cls.search([
+                    ('user.active', '=', True),
+                    ], order=[('priority', 'ASC'), ('id', 'ASC')])
+        for extension in extensions:
+            user = extension.user
+            chan_type = extension.chan_type or user.asterisk_chan_type
+            channel = ('%s/%s' % (chan_type, extension.number)
+                if chan_type else None)
+            map_ = maps.setdefault(extension.company.id, {
+                    'extensions': {},
+                    'users': {},
+                    'numbers': {},
+                    })
+            map_['extensions'][extension.number] = (user.id, channel)
+            map_['users'].setdefault(user.id, []).append(
+                (extension.number, channel))
+            map_['numbers'][extension.number] = user.id
+        return maps
+
+    @classmethod
+    def get_map(cls, company=None):
+        '''
+        Return the extension map of the company, by default the one of the
+        context:
+            extensions: the user and the channel of each number
+            users: the numbers and channels of each user by priority
+            numbers: the user of each number
+        The maps are shared by the transactions so they must not be
+        modified. They are computed again when an extension is modified in
+        any process.
+        '''
+        if company is None:
+            company = Transaction().context.get('company')
+        database_name = Transaction().database.name
+        token = cls._map_cache.get('token')
+        cached = _maps.get(database_name)
+        if token is not None and cached and cached[0] == token:
+            maps = cached[1]
+        else:
+            maps = cls._build_maps()
+            token = uuid.uuid4().hex
+            cls._map_cache.set('token', token)
+            _maps[database_name] = (token, maps)
+        return maps.get(company, _EMPTY_MAP)
+
+    @classmethod
+    def lookup(cls, number, company=None):
+        "Return the user and the channel of the number or None"
+        return cls.get_map(company)['extensions'].get(number)
 
-__all__ = ['User']
+    @classmethod
+    def create(cls, vlist):
+        extensions = super(UserExtension, cls).create(vlist)
+        cls._map_cache.clear()
+        return extensions
+
+    @classmethod
+    def write(cls, *args):
+        super(UserExtension, cls).write(*args)
+        cls._map_cache.clear()
+
+    @classmethod
+    def delete(cls, extensions):
+        super(UserExtension, cls).delete(extensions)
+        cls._map_cache.clear()
 
 
 class User(metaclass=PoolMeta):
     __name__ = "res.user"
 
-    internal_number = fields.Char('Internal number',
-        help="User's internal phone number. You can deffine more than one "
-            "separetd by coma ','. It try to send the call to each number "
-            "until you pick up one of defined phone or arrive the end.")
+    extensions = fields.One2Many('res.user.extension', 'user', 'Extensions',
+        help="User's internal phone numbers. The call is sent to each "
+        "number until one of them picks up.")
+    internal_number = fields.Function(fields.Char('Internal number',
+            help="User's internal phone numbers separated by coma ','."),
+        'get_internal_number', setter='set_internal_number',
+        searcher='search_internal_number')
+    asterisk_presence = fields.Function(fields.Selection(presence.PRESENCES,
+            'Presence',
+            help="The state of the user's phone on the Asterisk server."),
+        'get_asterisk_presence')
     callerid = fields.Char('Caller ID',
         help="Caller ID used for the calls initiated by this user.")
-    asterisk_chan_type = fields.Selection([
-            (None, ''),
-            ('SIP', 'SIP'),
-            ('IAX2', 'IAX2'),
-            ('DAHDI', 'DAHDI'),
-            ('Zap', 'Zap'),
-            ('Skinny', 'Skinny'),
-            ('MGCP', 'MGCP'),
-            ('mISDN', 'mISDN'),
-            ('H323', 'H323'),
-            ], 'Asterisk channel type',
+    asterisk_chan_type = fields.Selection(CHAN_TYPES, 'Asterisk channel type',
             help="Asterisk channel type, as used in the Asterisk dialplan. "
                 "If the user has a regular IP phone, the channel type is "
                 "'SIP'.")
+    asterisk_ring_strategy = fields.Selection([
+            ('sequential', 'Sequential'),
+            ('ring_all', 'Ring all'),
+            ], 'Ring strategy',
+            help="Sequential: try each internal number until one of them "
+                "picks up.\n"
+                "Ring all: ring all the internal numbers at once and hang up "
+                "the others when one of them picks up.")
     asterisk_server = fields.Function(fields.Many2One('asterisk.configuration',
             'Asterisk server',
             help="Asterisk server on which the user's phone is connected."),
             getter='get_asterisk_server')
 
+    @classmethod
+    def __setup__(cls):
+        super(User, cls).__setup__()
+        cls.__rpc__.update({
+                'get_presences': RPC(readonly=True),
+                })
+
+    @staticmethod
+    def default_asterisk_ring_strategy():
+        return 'sequential'
+
+    @classmethod
+    def extension_users(cls, company=None):
+        '''
+        Return a dictionary with the user id of each internal number of the
+        company, by default the one of the context. It must not be modified.
+        '''
+        Extension = Pool().get('res.user.extension')
+        return Extension.get_map(company)['numbers']
+
+    def get_asterisk_extensions(self, company=None):
+        '''
+        Return the internal numbers and their channel by priority in the
+        company, by default the one of the context
+        '''
+        Extension = Pool().get('res.user.extension')
+        return Extension.get_map(company)['users'].get(self.id, [])
+
+    def _internal_number_company(self):
+        "Return the company of the internal numbers"
+        if self.company:
+            return self.company.id
+        return Transaction().context.get('company')
+
+    def get_internal_number(self, name):
+        company = self._internal_number_company()
+        return ', '.join(e.number for e in self.extensions
+            if e.company.id == company) or None
+
+    @classmethod
+    def set_internal_number(cls, users, name, value):
+        Extension = Pool().get('res.user.extension')
+        numbers = [n for n in (value or '').replace(' ', '').split(',') if n]
+        if numbers and len(users) > 1:
+            raise UserError(gettext(
+                    'asterisk.internal_number_several_users'))
+        to_delete = []
+        to_create = []
+        for user in users:
+            company = user._internal_number_company()
+            to_delete.extend(e for e in user.extensions
+                if e.company.id == company)
+            to_create.extend({
+                    'user': user.id,
+                    'company': company,
+                    'number': n,
+                    'priority': (i + 1) * 10,
+                    } for i, n in enumerate(numbers))
+        Extension.delete(to_delete)
+        Extension.create(to_create)
+
+    @classmethod
+    def search_internal_number(cls, name, clause):
+        return [('extensions.number',) + tuple(clause[1:])]
+
+    @classmethod
+    def write(cls, *args):
+        Extension = Pool().get('res.user.extension')
+        actions = iter(args)
+        clear = any(set(values) & {'asterisk_chan_type', 'active'}
+            for _, values in zip(actions, actions))
+        super(User, cls).write(*args)
+        if clear:
+            Extension._map_cache.clear()
+
+    @classmethod
+    def delete(cls, users):
+        Extension = Pool().get('res.user.extension')
+        super(User, cls).delete(users)
+        # The extensions are deleted by the database
+        Extension._map_cache.clear()
+
     def get_asterisk_server(self, name=None):
         ConfigurationCompany = Pool().get('asterisk.configuration.company')
         if self.company:
-            confs = ConfigurationCompany.search([
-                    ('company', '=', self.company.id),
-                    ], limit=1)
-            if confs:
-                return confs[0].id
+            values = ConfigurationCompany.get_company_values(self.company.id)
+            if values:
+                return values['id']
         return None
+
+    @classmethod
+    def get_asterisk_presence(cls, users, name):
+        pool = Pool()
+        ConfigurationCompany = pool.get('asterisk.configuration.company')
+        database_name = Transaction().database.name
+        result = {u.id: None for u in users}
+        companies = {}
+        for user in users:
+            if user.company and user.get_asterisk_extensions(user.company.id):
+                companies.setdefault(user.company.id, []).append(user)
+        for company, company_users in companies.items():
+            ast_server = ConfigurationCompany.get_company_configuration(
+                company)
+            if not ast_server:
+                continue
+            try:
+                states = presence.tracker((database_name, ast_server.id),
+                    ast_server.get_endpoints())
+            except ami.AMIError as e:
+                logger.warning('Unable to get the presence of the Asterisk '
+                    'server %s: %s', ast_server.name, e)
+                continue
+            if states is None:
+                # The presences are unknown until the tracker is started
+                continue
+            for user in company_users:
+                result[user.id] = states.get(
+                    user.get_asterisk_extensions(company))
+        return result
+
+    @classmethod
+    def get_presences(cls, ids):
+        "Return the presence of the users in one call"
+        users = cls.browse(ids)
+        return cls.get_asterisk_presence(users, 'asterisk_presence')
+
+    @classmethod
+    def incoming_call_messages(cls, calls):
+        '''
+        Return the bus channel and message notifying each incoming call.
+        A call is a dictionary with the user, the calling number and name.
+        '''
+        pool = Pool()
+        ContactMechanism = pool.get('party.contact_mechanism')
+        Party = pool.get('party.party')
+        matches = ContactMechanism.match_numbers(
+            {c['number'] for c in calls if c.get('number')})
+        parties = {p.id: p for p in Party.browse(
+                list({ids[0] for ids in matches.values() if ids}))}
+        result = []
+        for call in calls:
+            party_ids = matches.get(call.get('number'))
+            party = parties[party_ids[0]] if party_ids else None
+            party_name = party.display_name if party else None
+            caller = (party_name or call.get('name') or call.get('number')
+                or '')
+            result.append(('user:%s' % call['user'], {
+                        'type': 'notification',
+                        'title': gettext('asterisk.incoming_call',
+                            caller=caller),
+                        'body': call.get('number'),
+                        'priority': 1,
+                        'asterisk_call': {
+                            'uniqueid': call.get('uniqueid'),
+                            'extension': call.get('extension'),
+                            'number': call.get('number'),
+                            'party': party.id if party else None,
+                            'party_name': party_name,
+                            },
+                        }))
+        return result
+
+    @classmethod
+    def notify_incoming_calls(cls, calls):
+        "Send the notification of the calls to the client of their user"
+        for channel, message in cls.incoming_call_messages(calls):
+            Bus.publish(channel, message)
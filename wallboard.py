@@ -0,0 +1,266 @@
+#This file is part asterisk module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''
+Wallboard of the supervisors: the agents on call and the callers waiting in
+the queues of each company configuration.
+
+The event listener keeps the wallboard in memory and, at most every
+wallboard_interval seconds, stores its snapshot and sends the agents and
+queues changed meanwhile to the bus with a sequence number. So the clients
+load the snapshot once and apply the changes whatever the number of
+clients and agents.
+'''
+import json
+import time
+import uuid
+
+from trytond.bus import Bus
+from trytond.config import config
+from trytond.model import ModelSQL, Unique, fields
+from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+__all__ = ['EVENTS', 'WallboardState', 'Wallboard']
+
+# Seconds between the publications of the changes
+INTERVAL = config.getfloat('asterisk', 'wallboard_interval', default=1)
+# The events of the Asterisk Manager Interface which change the wallboard
+EVENTS = {'Newchannel', 'Newstate', 'CoreShowChannel', 'Hangup',
+    'QueueCallerJoin', 'QueueCallerLeave', 'QueueCallerAbandon'}
+# The state of the call of an agent for the state of its channel
+CALL_STATES = {
+    'Ring': 'dialing',
+    'Ringing': 'ringing',
+    'Up': 'talking',
+    }
+# The state shown for an agent with several calls
+PRIORITY = ['talking', 'ringing', 'dialing']
+# The changes are replaced by a reset above this size as PostgreSQL limits
+# the size of the notifications
+MAX_CHANGES_SIZE = 7000
+
+
+def _duration(value):
+    "Return the seconds of a duration like 01:02:03"
+    try:
+        hours, minutes, seconds = (int(v) for v in value.split(':'))
+    except (AttributeError, ValueError):
+        return 0
+    return hours * 3600 + minutes * 60 + seconds
+
+
+class WallboardState(object):
+    'The wallboard of a configuration kept in memory by the listener'
+
+    def __init__(self):
+        # The user, state, start and number of the calls of the agents
+        self.calls = {}
+        self.user_calls = {}
+        # The start of the waiting of the callers of each queue
+        self.waiting = {}
+        self.agents = {}
+        self.queues = {}
+        self._agents = set()
+        self._queues = set()
+        # The clients must reload the snapshot
+        self.stale = True
+        self.publisher = None
+
+    def on_event(self, message, user=None, now=None):
+        "Update the calls with the event, user is the agent of its channel"
+        name = message.get('Event')
+        uniqueid = message.get('Uniqueid')
+        if now is None:
+            now = int(time.time())
+        if name in {'Newchannel', 'Newstate', 'CoreShowChannel'}:
+            call = self.calls.get(uniqueid)
+            if call is None:
+                if user is None:
+                    return
+                call = self.calls[uniqueid] = {'user': user}
+                self.user_calls.setdefault(user, set()).add(uniqueid)
+            state = CALL_STATES.get(message.get('ChannelStateDesc'),
+                'dialing')
+            if state != call.get('state'):
+                call['state'] = state
+                call['since'] = now
+                if name == 'CoreShowChannel':
+                    call['since'] -= _duration(message.get('Duration'))
+            number = message.get('ConnectedLineNum')
+            if number and number != '<unknown>':
+                call['number'] = number
+            self._agents.add(call['user'])
+        elif name == 'Hangup':
+            call = self.calls.pop(uniqueid, None)
+            if call is not None:
+                self.user_calls[call['user']].discard(uniqueid)
+                self._agents.add(call['user'])
+            for queue, callers in self.waiting.items():
+                if callers.pop(uniqueid, None) is not None:
+                    self._queues.add(queue)
+        elif name == 'QueueCallerJoin':
+            queue = message.get('Queue')
+            self.waiting.setdefault(queue, {})[uniqueid] = now
+            self._queues.add(queue)
+        elif name in {'QueueCallerLeave', 'QueueCallerAbandon'}:
+            queue = message.get('Queue')
+            if self.waiting.get(queue, {}).pop(uniqueid, None) is not None:
+                self._queues.add(queue)
+
+    def agent(self, user):
+        "Return the values of the agent or None if not on call"
+        calls = [self.calls[u] for u in self.user_calls.get(user, ())]
+        if not calls:
+            self.user_calls.pop(user, None)
+            return None
+        call = min(calls,
+            key=lambda c: (PRIORITY.index(c['state']), c['since']))
+        return {
+            'state': call['state'],
+            'since': call['since'],
+            'number': call.get('number'),
+            'calls': len(calls),
+            }
+
+    def queue(self, name):
+        "Return the values of the queue or None if no caller waits"
+        callers = self.waiting.get(name)
+        if not callers:
+            self.waiting.pop(name, None)
+            return None
+        return {
+            'waiting': len(callers),
+            'since': min(callers.values()),
+            }
+
+    def changes(self):
+        '''
+        Return the agents and the queues changed since the previous call,
+        with None for the removed ones, or None if nothing changed.
+        '''
+        result = {}
+        for key, changed, values, get in [
+                ('agents', self._agents, self.agents, self.agent),
+                ('queues', self._queues, self.queues, self.queue),
+                ]:
+            for name in changed:
+                value = get(name)
+                if value == values.get(name):
+                    continue
+                result.setdefault(key, {})[name] = value
+                if value is None:
+                    del values[name]
+                else:
+                    values[name] = value
+            changed.clear()
+        return result or None
+
+    def snapshot(self):
+        return {
+            'agents': dict(self.agents),
+            'queues': dict(self.queues),
+            }
+
+
+class Wallboard(ModelSQL):
+    'Asterisk Wallboard'
+    __name__ = 'asterisk.wallboard'
+    configuration = fields.Many2One('asterisk.configuration.company',
+        'Configuration', required=True, readonly=True, ondelete='CASCADE')
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True)
+    sequence = fields.Integer('Sequence', readonly=True,
+        help="The sequence number of the last changes sent to the bus.")
+    token = fields.Char('Token', required=True, readonly=True,
+        help="The secret part of the bus channel of the changes as any "
+        "user can listen to the channels.")
+    snapshot = fields.Text('Snapshot', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Wallboard, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('configuration_uniq', Unique(t, t.configuration),
+                'There is already a wallboard for this configuration.'),
+            ]
+        cls.__rpc__.update({
+                'get_snapshot': RPC(readonly=False),
+                })
+
+    @staticmethod
+    def default_sequence():
+        return 0
+
+    @staticmethod
+    def default_token():
+        return uuid.uuid4().hex
+
+    @property
+    def channel(self):
+        "The bus channel of the changes"
+        return 'asterisk.wallboard:%s' % self.token
+
+    @classmethod
+    def _get_wallboard(cls, configuration):
+        "Return the wallboard of the configuration, created if needed"
+        wallboards = cls.search([
+                ('configuration', '=', configuration.id),
+                ], limit=1)
+        if wallboards:
+            wallboard, = wallboards
+        else:
+            with Transaction().set_context(_check_access=False):
+                wallboard, = cls.create([{
+                            'configuration': configuration.id,
+                            'company': configuration.company.id,
+                            }])
+        return wallboard
+
+    @classmethod
+    def publish(cls, configuration, changes, snapshot, reset=False):
+        '''
+        Store the snapshot of the configuration and send the changes to the
+        bus with the next sequence number. A reset asks the clients to
+        reload the snapshot.
+        '''
+        wallboard = cls._get_wallboard(configuration)
+        wallboard.sequence += 1
+        wallboard.snapshot = json.dumps(snapshot, separators=(',', ':'))
+        wallboard.save()
+
+        message = {
+            'type': 'asterisk.wallboard',
+            'sequence': wallboard.sequence,
+            }
+        if (not reset and changes
+                and len(json.dumps(changes)) <= MAX_CHANGES_SIZE):
+            message.update(changes)
+        else:
+            message['reset'] = True
+        Bus.publish(wallboard.channel, message)
+        return wallboard.sequence
+
+    @classmethod
+    def get_snapshot(cls):
+        '''
+        Return the wallboard of the configuration of the company with the
+        bus channel of its changes. The changes with a sequence number lower
+        or equal to the one of the snapshot are already applied.
+        The channel is only known from here as its name is secret.
+        '''
+        ConfigurationCompany = Pool().get('asterisk.configuration.company')
+        ast_server = ConfigurationCompany.get_company_configuration()
+        if not ast_server:
+            return None
+        wallboard = cls._get_wallboard(ast_server)
+        result = {
+            'channel': wallboard.channel,
+            'sequence': wallboard.sequence,
+            'agents': {},
+            'queues': {},
+            }
+        result.update(json.loads(wallboard.snapshot or '{}'))
+        return result